@@ -3,36 +3,1257 @@ import threading
 import uuid
 import re
 import concurrent.futures
+import fcntl
 import time
-import requests
-from flask import Flask, request, jsonify, send_from_directory, Response
+import json
+import glob
+import heapq
+import itertools
+import queue
+import shutil
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import quote, urlsplit, urlunsplit, parse_qsl, urlencode
+from flask import Flask, request, jsonify, send_from_directory, send_file, Response, redirect, url_for
 from flask_socketio import SocketIO, emit
 from flask_cors import CORS
-import yt_dlp
+from werkzeug.exceptions import HTTPException
+from werkzeug.middleware.proxy_fix import ProxyFix
+import faststart
+import ranged_proxy
+import archive_stream
+import pipe_stream
+import cancellation
+from concurrency import AdaptiveConcurrency, DiskAdmission, TokenBucket
+import task_state as task_state_backend
+from job_journal import JobJournal
+from download_index import DownloadIndex
+from channel_index import ChannelIndex
+from thumbnail_cache import ThumbnailCache, ThumbnailNotFound, VARIANTS as THUMBNAIL_VARIANTS, pick_thumbnail, variant_for_width
+import metrics
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret!'
+# Behind Render's HTTPS proxy: external URLs (thumbnail links) take the client's scheme and host
+app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 CORS(app)
 # Use 'threading' async_mode for standard OS threads (avoids DNS patching issues)
 socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
 
 # Concurrency Control
-MAX_CONCURRENT_DOWNLOADS = 5
-# Use native threading Semaphore
-download_semaphore = threading.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+# Starting download slot count shared by /api/download and /api/batch_download (see Adaptive Concurrency)
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get('MAX_CONCURRENT_DOWNLOADS', 5))
+PRIORITY_SINGLE = 0
+PRIORITY_BATCH = 1
+# Queue positions are recomputed and pushed to clients at most this often, and only the ones that moved
+QUEUE_UPDATE_INTERVAL = float(os.environ.get('QUEUE_UPDATE_INTERVAL', 0.5))
 
 DOWNLOAD_FOLDER = 'downloads'
-if os.path.exists(DOWNLOAD_FOLDER):
+
+# Job Journal
+# Downloads interrupted by a restart are re-queued on boot and continue from their temp files
+JOB_JOURNAL_DIR = os.environ.get('JOB_JOURNAL_DIR', 'journal')
+job_journal = JobJournal(JOB_JOURNAL_DIR)
+recovered_jobs = job_journal.recover()
+
+def is_resumable_partial(filename, partials):
+    """Whether a file belongs to an unfinished job (its .part, fragments, or already finished streams)"""
+    for path in partials:
+        stem = os.path.basename(path)
+        if stem.endswith('.part'):
+            stem = stem[:-len('.part')]
+        if filename.startswith(stem):
+            return True
+    return False
+
+# Metrics
+# Scraped from /metrics. Gauges and cache counters are read from the owning objects at scrape time.
+metrics_registry = metrics.Registry()
+stage_seconds = metrics_registry.histogram(
+    'ytdown_stage_seconds', 'Time spent per stage: extract, queue_wait, download, merge, rename, optimize, publish, serve, cancel', ['stage'])
+downloaded_bytes = metrics_registry.counter('ytdown_downloaded_bytes_total', 'Bytes fetched from upstream by downloads')
+served_bytes = metrics_registry.counter('ytdown_served_bytes_total', 'Bytes sent to clients', ['endpoint'])
+task_outcome_total = metrics_registry.counter('ytdown_tasks_total', 'Finished download tasks by outcome', ['outcome'])
+errors_total = metrics_registry.counter('ytdown_errors_total', 'Errors by where they surfaced', ['stage'])
+reclaimed_bytes = metrics_registry.counter('ytdown_cancel_reclaimed_bytes_total', 'Bytes of partial files removed after cancels')
+
+# Optional client-supplied trace id, echoed on the response and carried in the task's progress events
+TRACE_HEADER = 'X-Trace-Id'
+TRACE_ID_PATTERN = re.compile(r'^[\w.:-]{1,128}$')
+task_traces = {}  # task_id -> trace id
+
+def request_trace_id():
+    trace_id = request.headers.get(TRACE_HEADER) or request.args.get('traceId')
+    return trace_id if trace_id and TRACE_ID_PATTERN.match(trace_id) else None
+
+def metered(endpoint, chunks):
+    """Counts a streamed response body's bytes and its time to completion"""
+    start = time.monotonic()
     try:
-        # Clear folder on startup
-        for f in os.listdir(DOWNLOAD_FOLDER):
-            full_path = os.path.join(DOWNLOAD_FOLDER, f)
-            if os.path.isfile(full_path):
-                os.remove(full_path)
+        for chunk in chunks:
+            served_bytes.inc(len(chunk), endpoint=endpoint)
+            yield chunk
+    finally:
+        # Close the wrapped generator now so its own cleanup runs when the client goes away
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+        stage_seconds.observe(time.monotonic() - start, stage='serve')
+
+# Startup
+# Last run's downloads are moved aside in one rename and deleted by the janitor thread, so a full
+# folder doesn't hold up serving. yt_dlp is imported on first use, or by the pool warm-up once
+# STARTUP_WARMUP_DELAY has given the server time to bind its port.
+STALE_DOWNLOADS_PREFIX = DOWNLOAD_FOLDER + '.stale-'
+STARTUP_WARMUP_DELAY = float(os.environ.get('STARTUP_WARMUP_DELAY', 1))
+# Cached downloads outlive restarts: their keys are recorded here (see download_index.py) and the
+# wipe leaves their files in place. DOWNLOAD_CACHE_INDEX='' keeps the cache in memory only.
+DOWNLOAD_CACHE_INDEX = os.environ.get('DOWNLOAD_CACHE_INDEX', DOWNLOAD_FOLDER + '.cache.db')
+download_index = DownloadIndex(DOWNLOAD_CACHE_INDEX) if DOWNLOAD_CACHE_INDEX else None
+
+def clear_download_folder():
+    """Starts from an empty download folder, except cached downloads and what unfinished jobs will resume from"""
+    if not os.path.exists(DOWNLOAD_FOLDER):
+        os.makedirs(DOWNLOAD_FOLDER)
+        return
+    try:
+        pending_partials = job_journal.pending_partials()
+        cached = download_index.filenames() if download_index else set()
+
+        def kept(f):
+            return f in cached or is_resumable_partial(f, pending_partials)
+
+        try:
+            stale = f"{STALE_DOWNLOADS_PREFIX}{uuid.uuid4().hex[:8]}"
+            os.rename(DOWNLOAD_FOLDER, stale)
+        except OSError:
+            # A mount point can't be renamed; delete file by file as before
+            for f in os.listdir(DOWNLOAD_FOLDER):
+                full_path = os.path.join(DOWNLOAD_FOLDER, f)
+                if os.path.isfile(full_path) and not kept(f):
+                    os.remove(full_path)
+            return
+        os.makedirs(DOWNLOAD_FOLDER)
+        if pending_partials or cached:
+            for f in os.listdir(stale):
+                if os.path.isfile(os.path.join(stale, f)) and kept(f):
+                    os.rename(os.path.join(stale, f), os.path.join(DOWNLOAD_FOLDER, f))
     except Exception as e:
         print(f"Error clearing cache: {e}")
-else:
-    os.makedirs(DOWNLOAD_FOLDER)
+
+# Every worker holds a shared lock on WORKER_LOCK_PATH while it runs. Booting workers take turns
+# on the .boot lock, and one that can lock it exclusively has no live siblings: the folder is only
+# wiped then, so a worker (re)starting next to others doesn't pull files from under them.
+WORKER_LOCK_PATH = DOWNLOAD_FOLDER + '.lock'
+worker_lock = open(WORKER_LOCK_PATH, 'a')
+
+def clear_download_folder_once():
+    with open(WORKER_LOCK_PATH + '.boot', 'a') as boot:
+        fcntl.flock(boot.fileno(), fcntl.LOCK_EX)
+        try:
+            fcntl.flock(worker_lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            clear_download_folder()
+        except BlockingIOError:
+            print("Other workers are running; keeping the download folder")
+        fcntl.flock(worker_lock.fileno(), fcntl.LOCK_SH)
+
+def remove_stale_download_folders():
+    for path in glob.glob(glob.escape(STALE_DOWNLOADS_PREFIX) + '*'):
+        shutil.rmtree(path, ignore_errors=True)
+
+clear_download_folder_once()
+
+# YoutubeDL Pool
+YDL_BASE_OPTS = {
+    'quiet': True,
+    'nocolor': True,
+    'force_ipv4': True,
+    'extractor_args': {'youtube': {'player_client': ['android', 'web']}},  # Bypass bot detection
+}
+
+# Seconds a single format probe may run before it's reported as timed out (see Format Probing).
+# Probe sockets time out after the same, so a hung extraction also gives its probe worker back.
+PROBE_DEADLINE = float(os.environ.get('PROBE_DEADLINE', 30))
+
+# Option profiles that pooled instances are built from; per-request bits are applied as overrides
+YDL_PROFILES = {
+    'flat': {**YDL_BASE_OPTS, 'extract_flat': 'in_playlist'},
+    'video': dict(YDL_BASE_OPTS),
+    'formats': {
+        **YDL_BASE_OPTS,
+        'noplaylist': True,
+        'extract_flat': False,
+        'skip_download': True,
+        'extractor_args': {'youtube': {'player_client': ['android']}},
+        # Read at construction, when the pooled instance builds its HTTP handlers
+        'socket_timeout': PROBE_DEADLINE,
+    },
+    'download': {
+        **YDL_BASE_OPTS,
+        'noplaylist': True,
+        # Unique per video and format, so two cache keys never share a file; rename_output gives it the title
+        'outtmpl': os.path.join(DOWNLOAD_FOLDER, '%(title)s.%(id)s.%(format_id)s.%(ext)s'),
+        # Pick up .part files left by a previous run instead of starting from byte zero
+        'continuedl': True,
+        # Merged MP4s come out with moov up front, so optimize_video has nothing to do
+        'postprocessor_args': {'merger+ffmpeg': ['-movflags', '+faststart']},
+    },
+}
+YDL_POOL_MAX_IDLE = int(os.environ.get('YDL_POOL_MAX_IDLE', 8))
+
+class _PooledYDL:
+    """A YoutubeDL plus the slot its single progress hook forwards to"""
+    def __init__(self, profile):
+        self.profile = profile
+        self.progress_hook = None
+        self._merge_started = None
+        opts = dict(YDL_PROFILES[profile], progress_hooks=[self._on_progress], postprocessor_hooks=[self._on_postprocess])
+        self.ydl = load_yt_dlp().YoutubeDL(opts)
+        self._urlopen = self.ydl.urlopen
+        self.ydl.urlopen = self._tracked_urlopen
+
+    def _tracked_urlopen(self, req):
+        # Every HTTP response yt-dlp opens for a task can be interrupted by its cancel token
+        token = cancellation.current()
+        if token is not None:
+            token.raise_if_cancelled()
+        response = self._urlopen(req)
+        if token is not None:
+            token.track_response(response)
+        return response
+
+    def _on_progress(self, d):
+        if self.progress_hook:
+            self.progress_hook(d)
+
+    def _on_postprocess(self, d):
+        if d.get('postprocessor') != 'Merger':
+            return
+        if d['status'] == 'started':
+            self._merge_started = time.monotonic()
+            token = cancellation.current()
+            if token is not None:
+                token.raise_if_cancelled()
+                token.track_file(d.get('info_dict', {}).get('filepath'))
+        elif d['status'] == 'finished' and self._merge_started is not None:
+            stage_seconds.observe(time.monotonic() - self._merge_started, stage='merge')
+            self._merge_started = None
+
+def _track_ydl_subprocesses(yt_dlp):
+    """Registers the subprocesses yt-dlp starts (merger, ffmpeg downloader) with the current cancel token"""
+    popen_init = yt_dlp.utils.Popen.__init__
+
+    def __init__(self, *args, **kwargs):
+        popen_init(self, *args, **kwargs)
+        token = cancellation.current()
+        if token is not None:
+            token.track_process(self)
+
+    # Patched on the class: yt-dlp's modules import Popen by name
+    yt_dlp.utils.Popen.__init__ = __init__
+
+_yt_dlp = None
+_yt_dlp_lock = threading.Lock()
+
+def load_yt_dlp():
+    """The yt_dlp module, imported on first use; its extractor table is the bulk of startup time"""
+    global _yt_dlp
+    if _yt_dlp is None:
+        with _yt_dlp_lock:
+            if _yt_dlp is None:
+                import yt_dlp
+                _track_ydl_subprocesses(yt_dlp)
+                _yt_dlp = yt_dlp
+    return _yt_dlp
+
+class YoutubeDLPool:
+    """
+    Reusable YoutubeDL instances per option profile, so extractor setup,
+    cookie jar and HTTP handlers are paid once instead of per request.
+    An instance is used by one thread at a time between checkout and return.
+    """
+    def __init__(self, max_idle):
+        self.max_idle = max_idle
+        self._idle = {profile: [] for profile in YDL_PROFILES}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+
+    def warm(self, profile, count=1):
+        for _ in range(count):
+            pooled = _PooledYDL(profile)
+            with self._lock:
+                self.created += 1
+                self._idle[profile].append(pooled)
+
+    @contextmanager
+    def checkout(self, profile, overrides=None, progress_hook=None, cancel_token=None):
+        with self._lock:
+            pooled = self._idle[profile].pop() if self._idle[profile] else None
+            if pooled:
+                self.reused += 1
+            else:
+                self.created += 1
+        if pooled is None:
+            pooled = _PooledYDL(profile)
+
+        ydl = pooled.ydl
+        params = ydl.params
+        saved = {k: params[k] for k in (overrides or {}) if k in params}
+        saved_selector = ydl.format_selector
+        params.update(overrides or {})
+        if overrides and overrides.get('format'):
+            # YoutubeDL compiles the format spec at construction, so rebuild it for this request
+            ydl.format_selector = ydl.build_format_selector(params['format'])
+        pooled.progress_hook = progress_hook
+        healthy = False
+        try:
+            with cancellation.bound(cancel_token):
+                yield ydl
+            healthy = True
+        finally:
+            pooled.progress_hook = None
+            ydl.format_selector = saved_selector
+            for k in (overrides or {}):
+                if k in saved:
+                    params[k] = saved[k]
+                else:
+                    params.pop(k, None)
+            with self._lock:
+                # Instances that raised mid-request may be in an odd state; don't reuse them
+                keep = healthy and len(self._idle[profile]) < self.max_idle
+                if keep:
+                    self._idle[profile].append(pooled)
+                else:
+                    self.discarded += 1
+            if not keep:
+                ydl.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'created': self.created,
+                'reused': self.reused,
+                'discarded': self.discarded,
+                'idle': {profile: len(idle) for profile, idle in self._idle.items()}
+            }
+
+ydl_pool = YoutubeDLPool(YDL_POOL_MAX_IDLE)
+
+def warm_ydl_pool():
+    # Off the import path: requests arriving before this finishes import yt_dlp themselves
+    time.sleep(STARTUP_WARMUP_DELAY)
+    try:
+        for profile in ('flat', 'video', 'formats'):
+            ydl_pool.warm(profile)
+    except Exception as e:
+        print(f"YoutubeDL pool warm-up error: {e}")
+
+threading.Thread(target=warm_ydl_pool, name="ydl-pool-warmup", daemon=True).start()
+
+# Metadata Cache
+METADATA_CACHE_TTL = int(os.environ.get('METADATA_CACHE_TTL', 600))
+METADATA_CACHE_NEGATIVE_TTL = int(os.environ.get('METADATA_CACHE_NEGATIVE_TTL', 30))
+METADATA_CACHE_MAX_ENTRIES = int(os.environ.get('METADATA_CACHE_MAX_ENTRIES', 512))
+
+# Query params that don't change what yt-dlp extracts
+TRACKING_PARAMS = {'si', 'feature', 'pp', 'ab_channel', 'utm_source', 'utm_medium', 'utm_campaign'}
+
+def normalize_url(url):
+    """Canonical form of a YouTube URL so equivalent links share a cache entry"""
+    parts = urlsplit(url.strip())
+    netloc = parts.netloc.lower()
+    if netloc in ('youtube.com', 'm.youtube.com', 'music.youtube.com'):
+        netloc = 'www.youtube.com'
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in TRACKING_PARAMS]
+    path = parts.path.rstrip('/') or '/'
+    return urlunsplit((parts.scheme.lower() or 'https', netloc, path, urlencode(sorted(query)), ''))
+
+class _Flight:
+    """An extraction in progress that concurrent identical requests wait on"""
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+class MetadataCache:
+    """
+    Shared LRU cache for extract_info results with TTL, negative caching of
+    failed extractions and single-flight coalescing of identical requests.
+    on_evict(value) runs for every value that is dropped, whether by LRU,
+    expiry or invalidate(), for values that hold resources.
+    """
+    def __init__(self, max_entries, ttl, negative_ttl, on_evict=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.on_evict = on_evict
+        self._entries = OrderedDict()  # key -> (expires_at, value, error)
+        self._inflight = {}  # key -> _Flight
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get_or_extract(self, key, extract):
+        dropped = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                expires_at, value, error = entry
+                if expires_at > time.time():
+                    self._entries.move_to_end(key)
+                    if error is not None:
+                        self.negative_hits += 1
+                        raise Exception(error)
+                    self.hits += 1
+                    return value
+                dropped.append(self._entries.pop(key)[1])
+
+            flight = self._inflight.get(key)
+            if flight:
+                self.coalesced += 1
+                leader = False
+            else:
+                self.misses += 1
+                flight = _Flight()
+                self._inflight[key] = flight
+                leader = True
+
+        self._dispose(dropped)
+        dropped = []
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise Exception(flight.error)
+            return flight.value
+
+        try:
+            flight.value = extract()
+        except Exception as e:
+            flight.error = str(e)
+        finally:
+            with self._lock:
+                now = time.time()
+                ttl = self.ttl if flight.error is None else self.negative_ttl
+                self._entries[key] = (now + ttl, flight.value, flight.error)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    dropped.append(self._entries.popitem(last=False)[1][1])
+                    self.evictions += 1
+                if self.on_evict:
+                    # Expired entries nobody asks for again would otherwise hold their resources until LRU reaches them
+                    for stale_key in [k for k, (expires_at, _, _) in self._entries.items() if expires_at <= now]:
+                        dropped.append(self._entries.pop(stale_key)[1])
+                del self._inflight[key]
+            flight.event.set()
+            self._dispose(dropped)
+
+        if flight.error is not None:
+            raise Exception(flight.error)
+        return flight.value
+
+    def invalidate(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry:
+            self._dispose([entry[1]])
+
+    def _dispose(self, values):
+        if not self.on_evict:
+            return
+        for value in values:
+            if value is not None:
+                try:
+                    self.on_evict(value)
+                except Exception as e:
+                    print(f"Cache eviction error: {e}")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses + self.coalesced
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'inflight': len(self._inflight),
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'hit_ratio': round((self.hits + self.negative_hits + self.coalesced) / lookups, 4) if lookups else 0.0
+            }
+
+metadata_cache = MetadataCache(METADATA_CACHE_MAX_ENTRIES, METADATA_CACHE_TTL, METADATA_CACHE_NEGATIVE_TTL)
+
+def extract_info_cached(url, profile, overrides=None):
+    """extract_info on a pooled instance through the shared metadata cache, keyed by URL plus the option set"""
+    url = normalize_url(url)
+    key = (url, profile, json.dumps(overrides or {}, sort_keys=True, default=str))
+
+    def extract():
+        with stage_seconds.time(stage='extract'), ydl_pool.checkout(profile, overrides) as ydl:
+            return ydl.extract_info(url, download=False)
+
+    return metadata_cache.get_or_extract(key, extract)
+
+# Listing Sessions
+def resolve_listing(ydl, url):
+    """Unresolved (process=False) info for url, following redirects to the actual listing"""
+    info = ydl.extract_info(url, download=False, process=False)
+    for _ in range(3):
+        if info.get('_type') not in ('url', 'url_transparent'):
+            break
+        info = ydl.extract_info(info['url'], download=False, process=False)
+    return info
+
+LISTING_SESSION_TTL = int(os.environ.get('LISTING_SESSION_TTL', 900))
+LISTING_SESSION_MAX = int(os.environ.get('LISTING_SESSION_MAX', 64))
+
+class ListingSession:
+    """
+    Walks a channel or playlist's flat entry list lazily, once. Filtering runs
+    as entries are pulled, and pages are sliced from what has been pulled so
+    far, so page N costs only the entries not fetched yet instead of a fresh
+    extraction from the start.
+    """
+    def __init__(self, url, entry_filter=None):
+        # Owns its YoutubeDL: the entry generator keeps using it between requests
+        self.ydl = load_yt_dlp().YoutubeDL(YDL_PROFILES['flat'])
+        info = resolve_listing(self.ydl, url)
+
+        self.title = info.get('title')
+        self.is_listing = 'entries' in info
+        self.entry_filter = entry_filter
+        self.entries = []
+        self.exhausted = not self.is_listing
+        self._source = iter(info.get('entries') or [])
+        # Reentrant: page() closes the session when it runs out, and eviction closes it from outside
+        self._lock = threading.RLock()
+        if not self.is_listing:
+            self.close()
+
+    def page(self, page, page_size):
+        """Returns (entries, has_more) for a 1-based page"""
+        start = (page - 1) * page_size
+        end = start + page_size
+        with self._lock:
+            # Pull one past the page so has_more is exact
+            while not self.exhausted and len(self.entries) <= end:
+                try:
+                    entry = next(self._source)
+                except StopIteration:
+                    self.exhausted = True
+                    self.close()
+                    break
+                if entry and (self.entry_filter is None or self.entry_filter(entry)):
+                    self.entries.append(entry)
+            return self.entries[start:end], len(self.entries) > end
+
+    def close(self):
+        """Releases the YoutubeDL; pages already pulled stay readable by anyone still holding the session"""
+        with self._lock:
+            self.exhausted = True
+            self._source = iter(())
+            if self.ydl is not None:
+                self.ydl.close()
+                self.ydl = None
+
+# Sessions are shared by everyone browsing the same listing; creation is single-flight.
+# Sessions dropped from the cache are closed so their YoutubeDL and entry generator don't linger.
+listing_sessions = MetadataCache(LISTING_SESSION_MAX, LISTING_SESSION_TTL, METADATA_CACHE_NEGATIVE_TTL,
+                                 on_evict=lambda session: session.close())
+
+def entry_url(e):
+    return e.get('url') or e.get('webpage_url') or f"https://www.youtube.com/watch?v={e.get('id')}"
+
+def get_listing_session(url, tab, is_playlist):
+    # Channel tabs are already split by URL; playlists mix both and are filtered here
+    entry_filter = None
+    if is_playlist and tab == 'shorts':
+        entry_filter = lambda e: '/shorts/' in entry_url(e)
+    elif is_playlist and tab == 'videos':
+        entry_filter = lambda e: '/shorts/' not in entry_url(e)
+
+    key = (normalize_url(url), tab if is_playlist else None)
+    return key, listing_sessions.get_or_extract(key, lambda: ListingSession(url, entry_filter))
+
+def listing_video(e):
+    """Flat listing entry -> the video dict /api/info returns"""
+    v_id = e.get('id')
+    v_url = e.get('url') or e.get('webpage_url')
+    if not v_url and v_id:
+        v_url = f"https://www.youtube.com/watch?v={v_id}"
+
+    thumbnail = None
+    thumbnails = e.get('thumbnails')
+    if thumbnails and len(thumbnails) > 0:
+        thumbnail = pick_thumbnail(thumbnails, THUMBNAIL_GRID_WIDTH)
+    elif e.get('thumbnail'):
+        thumbnail = e.get('thumbnail')
+    elif v_id:
+        thumbnail = f"https://i.ytimg.com/vi/{v_id}/hqdefault.jpg"
+
+    return {
+        'id': v_id,
+        'title': e.get('title'),
+        'duration': e.get('duration'),
+        'thumbnail': thumbnail,
+        'url': v_url,
+        'is_short': '/shorts/' in (v_url or ''),
+        'max_height': 0
+    }
+
+# Thumbnails
+# Grid thumbnails go through /api/thumbnail: an on-disk cache keyed by video id and size, served
+# with long-lived cache headers and warmed a page at a time. THUMBNAIL_PROXY=0 links upstream directly.
+THUMBNAIL_PROXY = os.environ.get('THUMBNAIL_PROXY', '1') == '1'
+THUMBNAIL_CACHE_DIR = os.environ.get('THUMBNAIL_CACHE_DIR', 'thumbnails')
+THUMBNAIL_CACHE_MAX_BYTES = int(os.environ.get('THUMBNAIL_CACHE_MAX_BYTES', 256 * 1024 ** 2))
+THUMBNAIL_UPSTREAM = os.environ.get('THUMBNAIL_UPSTREAM', 'https://i.ytimg.com/vi/{id}/{variant}.jpg')
+# Widest a thumbnail is drawn in the channel grid (CSS px); the smallest variant covering it is used
+THUMBNAIL_GRID_WIDTH = int(os.environ.get('THUMBNAIL_GRID_WIDTH', 320))
+THUMBNAIL_MAX_AGE = int(os.environ.get('THUMBNAIL_MAX_AGE', 7 * 24 * 3600))
+THUMBNAIL_FETCH_WORKERS = int(os.environ.get('THUMBNAIL_FETCH_WORKERS', 16))
+THUMBNAIL_PREFETCH_MAX = 100
+# Seconds /api/thumbnails/prefetch waits for the batch before answering with what's cached
+THUMBNAIL_PREFETCH_TIMEOUT = float(os.environ.get('THUMBNAIL_PREFETCH_TIMEOUT', 15))
+VIDEO_ID = re.compile(r'[\w-]{6,20}')
+
+thumbnail_cache = ThumbnailCache(THUMBNAIL_CACHE_DIR, THUMBNAIL_UPSTREAM, THUMBNAIL_CACHE_MAX_BYTES,
+                                 workers=THUMBNAIL_FETCH_WORKERS) if THUMBNAIL_PROXY else None
+
+def proxy_thumbnails(videos):
+    """Points a page's thumbnails at the proxy and starts fetching them, so they're warm when the browser asks"""
+    if not thumbnail_cache:
+        return videos
+    variant = variant_for_width(THUMBNAIL_GRID_WIDTH)
+    ids = [video['id'] for video in videos if video.get('id') and VIDEO_ID.fullmatch(video['id'])]
+    proxied = set(ids)
+    for video in videos:
+        if video.get('id') in proxied:
+            video['thumbnail'] = url_for('thumbnail', video_id=video['id'], variant=variant, _external=True)
+    thumbnail_cache.warm(ids, variant)
+    return videos
+
+# Channel Index
+# Channel tabs are browsed, searched and summarized from a local SQLite index that's kept
+# current by delta syncs, instead of crawling the tab per browse. CHANNEL_INDEX_PATH='' disables it.
+CHANNEL_INDEX_PATH = os.environ.get('CHANNEL_INDEX_PATH', 'channel_index.db')
+# A tab is re-synced (delta) when browsed after this many seconds
+CHANNEL_SYNC_INTERVAL = int(os.environ.get('CHANNEL_SYNC_INTERVAL', 600))
+# How long a browse waits on a running sync before answering from what's indexed so far
+CHANNEL_INDEX_WAIT = float(os.environ.get('CHANNEL_INDEX_WAIT', 20))
+CHANNEL_URL = re.compile(r'youtube\.com/(@[^/?#]+|channel/[^/?#]+|c/[^/?#]+|user/[^/?#]+)')
+
+channel_index = ChannelIndex(CHANNEL_INDEX_PATH, CHANNEL_SYNC_INTERVAL) if CHANNEL_INDEX_PATH else None
+
+def fetch_channel_tab(url):
+    """(title, flat video dicts newest first) for a channel tab, pulled lazily for a sync"""
+    ydl = load_yt_dlp().YoutubeDL(YDL_PROFILES['flat'])
+    info = resolve_listing(ydl, url)
+    if 'entries' not in info:
+        ydl.close()
+        raise Exception("Not a channel listing")
+
+    def entries():
+        try:
+            for e in info['entries']:
+                if e:
+                    yield listing_video(e)
+        finally:
+            ydl.close()
+
+    return info.get('title'), entries()
+
+def channel_page(base_url, final_url, tab, page, page_size, search):
+    key = normalize_url(base_url)
+    # Searches and the histogram cover the whole tab, so they wait for the sync to finish
+    need = None if search else page * page_size + 1
+    syncing = channel_index.ensure(key, tab, lambda: fetch_channel_tab(final_url), need, CHANNEL_INDEX_WAIT)
+    videos, has_more = channel_index.page(key, tab, page, page_size, search)
+    summary = channel_index.summary(key, tab, search)
+    return {
+        'type': 'channel',
+        'title': summary['title'],
+        'url': base_url,
+        'current_tab': tab,
+        'videos': videos,
+        'stats': summary['stats'],
+        'page': page,
+        # Rows still arriving from a first crawl count as more
+        'has_more': has_more or syncing,
+        'indexed': summary['indexed'],
+        'syncing': syncing,
+        'search': search
+    }
+
+# Download Scheduler
+class _Job:
+    def __init__(self, task_id, owner, priority, seq, fn, args):
+        self.task_id = task_id
+        self.owner = owner
+        self.priority = priority
+        self.seq = seq
+        self.fn = fn
+        self.args = args
+        self.queued_at = time.monotonic()
+
+class DownloadScheduler:
+    """
+    Pool of download workers fed by per-owner priority queues.
+    Owners (socket sids) are served round-robin, so one large batch
+    cannot starve single downloads from other clients. At most `limit`
+    of the workers run jobs at once; set_limit() moves it at runtime.
+    Queue changes only mark positions stale; a publisher thread replays
+    the order once per update_interval and sends the positions that moved.
+    """
+    def __init__(self, workers, limit=None, update_interval=QUEUE_UPDATE_INTERVAL):
+        self.workers = workers
+        self.limit = limit or workers
+        self.update_interval = update_interval
+        self._stale = threading.Event()
+        self._published = {}  # task_id -> position last sent, owned by the publisher thread
+        self._running = {}  # task_id -> job currently running
+        self._queues = OrderedDict()  # owner -> heap of (priority, seq, job)
+        self._jobs = {}  # task_id -> queued job
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._threads = []
+        self._publisher = None
+        self.active = 0
+        self.dispatched = 0
+
+    def _ensure_workers(self):
+        # Called with the lock held; workers are started lazily on first submit
+        while len(self._threads) < self.workers:
+            t = threading.Thread(target=self._worker, name=f"download-worker-{len(self._threads)}", daemon=True)
+            self._threads.append(t)
+            t.start()
+        if self._publisher is None:
+            self._publisher = threading.Thread(target=self._publish_loop, name="queue-positions", daemon=True)
+            self._publisher.start()
+
+    def submit(self, task_id, owner, fn, args=(), priority=PRIORITY_BATCH):
+        """Queue a job and return its 1-based queue position"""
+        return self.submit_many(owner, [(task_id, fn, args)], priority)[task_id]
+
+    def submit_many(self, owner, jobs, priority=PRIORITY_BATCH):
+        """Queue (task_id, fn, args) jobs for one owner, returning task_id -> queue position"""
+        with self._cond:
+            for task_id, fn, args in jobs:
+                job = _Job(task_id, owner or 'anonymous', priority, next(self._seq), fn, args)
+                heapq.heappush(self._queues.setdefault(job.owner, []), (job.priority, job.seq, job))
+                self._jobs[task_id] = job
+            self._ensure_workers()
+            positions = self._positions()
+            self._cond.notify(len(jobs))
+        self._stale.set()
+        return {task_id: positions.get(task_id, (0, None))[0] for task_id, _, _ in jobs}
+
+    def cancel(self, task_id):
+        """Drop a job that has not started yet. Returns True if it was still queued."""
+        with self._cond:
+            job = self._jobs.pop(task_id, None)
+            if not job:
+                return False
+            heap = self._queues[job.owner]
+            heap.remove((job.priority, job.seq, job))
+            if heap:
+                heapq.heapify(heap)
+            else:
+                del self._queues[job.owner]
+        self._stale.set()
+        return True
+
+    def position(self, task_id):
+        with self._cond:
+            if task_id not in self._jobs:
+                return 0
+            return self._positions().get(task_id, (0, None))[0]
+
+    def _next_owner(self, heads):
+        # Lowest priority value wins; ties go to the owner served least recently
+        best = None
+        for owner, head in heads.items():
+            if best is None or head < heads[best]:
+                best = owner
+        return best
+
+    def _pick(self):
+        heads = OrderedDict((owner, heap[0][0]) for owner, heap in self._queues.items())
+        owner = self._next_owner(heads)
+        heap = self._queues.pop(owner)
+        _, _, job = heapq.heappop(heap)
+        if heap:
+            # Re-append so the owner moves to the back of the round-robin
+            self._queues[owner] = heap
+        del self._jobs[job.task_id]
+        return job
+
+    def _positions(self):
+        # Replays the dispatch order over a snapshot of the queues
+        pending = OrderedDict((owner, sorted(heap)) for owner, heap in self._queues.items())
+        cursor = {owner: 0 for owner in pending}
+        positions = {}
+        position = 1
+        while pending:
+            heads = OrderedDict((owner, items[cursor[owner]][0]) for owner, items in pending.items())
+            owner = self._next_owner(heads)
+            items = pending.pop(owner)
+            job = items[cursor[owner]][2]
+            positions[job.task_id] = (position, job.owner)
+            position += 1
+            cursor[owner] += 1
+            if cursor[owner] < len(items):
+                pending[owner] = items
+        return positions
+
+    def _publish(self, positions):
+        by_sid = {}
+        for task_id, (position, _) in positions.items():
+            if self._published.get(task_id) == position:
+                continue
+            for sid in task_sids(task_id):
+                by_sid.setdefault(sid, {})[task_id] = position
+        self._published = {task_id: position for task_id, (position, _) in positions.items()}
+        for sid, sid_positions in by_sid.items():
+            task_state.publish('queue', {'positions': sid_positions}, sid)
+
+    def _publish_loop(self):
+        while True:
+            self._stale.wait()
+            # Let a burst of submits and dispatches settle into one replay
+            time.sleep(self.update_interval)
+            self._stale.clear()
+            try:
+                with self._cond:
+                    positions = self._positions()
+                self._publish(positions)
+            except Exception as e:
+                print(f"Queue position update error: {e}")
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queues or self.active >= self.limit:
+                    self._cond.wait()
+                job = self._pick()
+                self._running[job.task_id] = job
+                self.active += 1
+                self.dispatched += 1
+            self._stale.set()
+            stage_seconds.observe(time.monotonic() - job.queued_at, stage='queue_wait')
+            try:
+                job.fn(*job.args)
+            except Exception as e:
+                print(f"Scheduler job error: {e}")
+            finally:
+                with self._cond:
+                    self.active -= 1
+                    self._running.pop(job.task_id, None)
+                    self._cond.notify()
+
+    def set_limit(self, limit):
+        with self._cond:
+            self.limit = max(1, min(limit, self.workers))
+            self._cond.notify_all()
+
+    def owner_of(self, task_id):
+        with self._cond:
+            job = self._running.get(task_id)
+            return job.owner if job else None
+
+    def placement_of(self, task_id):
+        """(owner, priority) of a running job, for handing it back to the queue where it was"""
+        with self._cond:
+            job = self._running.get(task_id)
+            return (job.owner, job.priority) if job else (None, PRIORITY_BATCH)
+
+    def demand(self):
+        """(running, queued) job counts"""
+        with self._cond:
+            return self.active, len(self._jobs)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'workers': self.workers,
+                'limit': self.limit,
+                'active': self.active,
+                'queued': len(self._jobs),
+                'dispatched': self.dispatched,
+                'owners': {owner: len(heap) for owner, heap in self._queues.items()}
+            }
+
+# Adaptive Concurrency
+# MAX_CONCURRENT_DOWNLOADS is the starting slot count; the controller moves it between the bounds
+# from measured throughput, stalls, 429s/errors and free disk. ADAPTIVE_CONCURRENCY=0 pins it.
+ADAPTIVE_CONCURRENCY = os.environ.get('ADAPTIVE_CONCURRENCY', '1') == '1'
+MIN_CONCURRENT_DOWNLOADS = int(os.environ.get('MIN_CONCURRENT_DOWNLOADS', 1))
+MAX_DOWNLOAD_SLOTS = int(os.environ.get('MAX_DOWNLOAD_SLOTS', 16)) if ADAPTIVE_CONCURRENCY else MAX_CONCURRENT_DOWNLOADS
+CONCURRENCY_INTERVAL = float(os.environ.get('CONCURRENCY_INTERVAL', 5))
+# Below this much free disk, slots are shed instead of added
+MIN_FREE_DISK_BYTES = int(os.environ.get('MIN_FREE_DISK_BYTES', 1024 ** 3))
+# When every running download is slower than this (bytes/s), upstream is throttling us
+STALL_SPEED = int(os.environ.get('STALL_SPEED', 64 * 1024))
+# Optional bandwidth caps in bytes/s, 0 = unlimited
+GLOBAL_BANDWIDTH_LIMIT = int(os.environ.get('GLOBAL_BANDWIDTH_LIMIT', 0))
+CLIENT_BANDWIDTH_LIMIT = int(os.environ.get('CLIENT_BANDWIDTH_LIMIT', 0))
+
+download_scheduler = DownloadScheduler(MAX_DOWNLOAD_SLOTS, MAX_CONCURRENT_DOWNLOADS)
+
+def free_disk_bytes():
+    return shutil.disk_usage(DOWNLOAD_FOLDER).free
+
+concurrency_controller = AdaptiveConcurrency(
+    initial=MAX_CONCURRENT_DOWNLOADS,
+    minimum=MIN_CONCURRENT_DOWNLOADS,
+    maximum=MAX_DOWNLOAD_SLOTS,
+    interval=CONCURRENCY_INTERVAL,
+    demand=download_scheduler.demand,
+    apply_limit=download_scheduler.set_limit,
+    free_bytes=free_disk_bytes,
+    min_free_bytes=MIN_FREE_DISK_BYTES,
+    stall_speed=STALL_SPEED
+)
+if ADAPTIVE_CONCURRENCY:
+    concurrency_controller.start()
+
+global_bandwidth = TokenBucket(GLOBAL_BANDWIDTH_LIMIT) if GLOBAL_BANDWIDTH_LIMIT else None
+client_bandwidth = {}  # sid -> TokenBucket
+client_bandwidth_lock = threading.Lock()
+
+def throttle_download(task_id, nbytes):
+    """Blocks the downloading thread until the bandwidth caps cover nbytes"""
+    if global_bandwidth:
+        global_bandwidth.consume(nbytes)
+    if CLIENT_BANDWIDTH_LIMIT:
+        owner = download_scheduler.owner_of(task_id)
+        if owner:
+            with client_bandwidth_lock:
+                bucket = client_bandwidth.get(owner)
+                if bucket is None:
+                    bucket = client_bandwidth[owner] = TokenBucket(CLIENT_BANDWIDTH_LIMIT)
+            bucket.consume(nbytes)
+
+# Progress Aggregation
+PROGRESS_FLUSH_INTERVAL = float(os.environ.get('PROGRESS_FLUSH_INTERVAL', 0.25))
+
+class ProgressEmitter:
+    """
+    Collects the latest progress state per task and flushes everything that
+    changed as one 'progress_batch' event per tick, so the socket event rate
+    stays bounded no matter how many downloads are running.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self._pending = {}  # task_id -> merged progress payload
+        self._lock = threading.Lock()
+        self._thread = None
+        self.updates = 0
+        self.batches = 0
+
+    def publish(self, task_id, payload):
+        with self._lock:
+            state = self._pending.get(task_id)
+            if state is None:
+                state = self._pending[task_id] = dict(payload, taskId=task_id)
+                if task_id in task_traces:
+                    state['traceId'] = task_traces[task_id]
+            else:
+                state.update(payload)
+            self.updates += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._flush_loop, name="progress-emitter", daemon=True)
+                self._thread.start()
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            self.batches += 1
+        # One batch per client, holding only the tasks it is subscribed to
+        by_sid = {}
+        for update in pending.values():
+            for sid in task_sids(update['taskId']):
+                by_sid.setdefault(sid, []).append(update)
+        for sid, updates in by_sid.items():
+            task_state.publish('progress_batch', {'updates': updates}, sid)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Progress flush error: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {'interval': self.interval, 'pending': len(self._pending), 'updates': self.updates, 'batches': self.batches}
+
+progress_emitter = ProgressEmitter(PROGRESS_FLUSH_INTERVAL)
+
+def format_speed(bytes_per_sec):
+    if not bytes_per_sec:
+        return 'N/A'
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if bytes_per_sec < 1024 or unit == 'GiB':
+            return f"{bytes_per_sec:.2f}{unit}/s"
+        bytes_per_sec /= 1024
+
+def format_eta(seconds):
+    if seconds is None:
+        return 'N/A'
+    seconds = int(seconds)
+    hours, rem = divmod(seconds, 3600)
+    minutes, secs = divmod(rem, 60)
+    return f"{hours:d}:{minutes:02d}:{secs:02d}" if hours else f"{minutes:02d}:{secs:02d}"
+
+# Download Cache
+DOWNLOAD_CACHE_MAX_BYTES = int(os.environ.get('DOWNLOAD_CACHE_MAX_BYTES', 10 * 1024 ** 3))
+
+class DownloadCache:
+    """
+    Finished downloads indexed by (video id, resolved format, post-processing
+    options). Bounded by total size with LRU eviction; files that are being
+    served hold a reference and are never evicted. Concurrent misses for the
+    same key wait on the first download instead of fetching it again. Keys
+    that end up on the same file share it: it's counted once and only
+    deleted with the last of them. With an index (DownloadIndex) entries are
+    reloaded on boot, and a miss checks it for a file another process finished.
+    """
+    def __init__(self, folder, max_bytes, index=None):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.index = index
+        self._entries = OrderedDict()  # key -> filename, least recently used first
+        self._files = {}  # filename -> {'size', 'refs', 'keys'}
+        self._inflight = {}  # key -> [on_ready callbacks]
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+        if index is not None:
+            self._load()
+
+    def _load(self):
+        with self._lock:
+            for key, filename in self.index.entries():
+                if os.path.isfile(os.path.join(self.folder, filename)):
+                    self._add_locked(key, filename)
+                else:
+                    self.index.forget(key)
+            # The budget may have shrunk since the last run
+            self._evict_locked()
+
+    def _add_locked(self, key, filename):
+        file = self._files.get(filename)
+        if file is None:
+            path = os.path.join(self.folder, filename)
+            size = os.path.getsize(path) if os.path.isfile(path) else 0
+            file = self._files[filename] = {'size': size, 'refs': 0, 'keys': set()}
+            self.total_bytes += size
+        file['keys'].add(key)
+        self._entries[key] = filename
+        return file
+
+    def claim(self, key, on_ready):
+        """
+        Returns ('hit', filename) for a cached file, ('wait', None) when another
+        task is already downloading this key (on_ready(filename, error) is called
+        when it finishes), or ('lead', None) when the caller should download it.
+        """
+        with self._lock:
+            filename = self._entries.get(key)
+            if filename is None and self.index is not None:
+                # Finished by another process sharing the folder
+                filename = self.index.lookup(key)
+                if filename and os.path.isfile(os.path.join(self.folder, filename)):
+                    self._add_locked(key, filename)
+            if filename and os.path.isfile(os.path.join(self.folder, filename)):
+                self._entries.move_to_end(key)
+                if self.index is not None:
+                    self.index.touch(key)
+                self.hits += 1
+                self.bytes_saved += self._files[filename]['size']
+                return 'hit', filename
+            if key in self._entries:
+                # Removed from disk behind our back
+                self._drop_locked(key)
+            elif filename:
+                self.index.forget(key)
+
+            if key in self._inflight:
+                self._inflight[key].append(on_ready)
+                self.coalesced += 1
+                return 'wait', None
+
+            self._inflight[key] = []
+            self.misses += 1
+            return 'lead', None
+
+    def complete(self, key, filename):
+        with self._lock:
+            if key in self._entries:
+                self._drop_locked(key)
+            file = self._add_locked(key, filename)
+            if self.index is not None:
+                self.index.record(key, filename)
+            waiters = self._inflight.pop(key, [])
+            self.bytes_saved += file['size'] * len(waiters)
+            # The waiters are about to be handed this file, so it's never the one evicted here
+            self._evict_locked(keep=filename)
+        for on_ready in waiters:
+            on_ready(filename, None)
+
+    def fail(self, key, error):
+        with self._lock:
+            waiters = self._inflight.pop(key, [])
+        for on_ready in waiters:
+            on_ready(None, error)
+
+    def withdraw(self, key, on_ready):
+        """Stops waiting on an in-flight download; False if on_ready has already been called"""
+        with self._lock:
+            waiters = self._inflight.get(key)
+            if waiters is None or on_ready not in waiters:
+                return False
+            waiters.remove(on_ready)
+            return True
+
+    def acquire(self, filename):
+        """Pin a cached file while it is being served. Returns False for uncached files."""
+        with self._lock:
+            file = self._files.get(filename)
+            if file is None:
+                return False
+            file['refs'] += 1
+            for key in file['keys']:
+                self._entries.move_to_end(key)
+            return True
+
+    def release(self, filename):
+        with self._lock:
+            file = self._files.get(filename)
+            if file is not None:
+                file['refs'] -= 1
+                self._evict_locked()
+
+    def contains(self, filename):
+        with self._lock:
+            return filename in self._files
+
+    def _drop_locked(self, key):
+        """Forgets key; returns its file's size if that was the file's last key, else 0"""
+        filename = self._entries.pop(key)
+        if self.index is not None:
+            self.index.forget(key)
+        file = self._files[filename]
+        file['keys'].discard(key)
+        if file['keys']:
+            return 0
+        del self._files[filename]
+        self.total_bytes -= file['size']
+        return file['size']
+
+    def _evictable_locked(self, key, keep=None):
+        filename = self._entries[key]
+        return filename != keep and self._files[filename]['refs'] == 0
+
+    def _evict_locked(self, keep=None):
+        for key in list(self._entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if key in self._entries and self._evictable_locked(key, keep):
+                self._remove_locked(key)
+
+    def _remove_locked(self, key):
+        filename = self._entries[key]
+        freed = self._drop_locked(key)
+        if filename not in self._files:
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.folder, filename))
+            except OSError:
+                pass
+        return freed
+
+    def evictable_bytes(self):
+        with self._lock:
+            return sum(file['size'] for file in self._files.values() if file['refs'] == 0)
+
+    def evict_bytes(self, nbytes):
+        """Evicts unpinned files, least recently used first, until nbytes are freed; returns bytes freed"""
+        freed = 0
+        with self._lock:
+            for key in list(self._entries):
+                if freed >= nbytes:
+                    break
+                if key in self._entries and self._evictable_locked(key):
+                    freed += self._remove_locked(key)
+        return freed
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'files': len(self._files),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'inflight': len(self._inflight),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'bytes_saved': self.bytes_saved
+            }
+
+download_cache = DownloadCache(DOWNLOAD_FOLDER, DOWNLOAD_CACHE_MAX_BYTES, download_index)
+
+def download_cache_key(info, opts):
+    """(video id, resolved format, post-processing options) for a probed download"""
+    postprocessing = json.dumps({
+        'merge_output_format': opts.get('merge_output_format'),
+        'postprocessors': opts.get('postprocessors', []),
+        'faststart': True
+    }, sort_keys=True, default=str)
+    return (info.get('id'), info.get('format_id'), postprocessing)
+
+# Disk Admission
+# Downloads reserve their estimated peak footprint before starting and wait (without holding a
+# slot) while it doesn't fit; cached files are evicted early to make room. DISK_ADMISSION=0 disables it.
+DISK_ADMISSION = os.environ.get('DISK_ADMISSION', '1') == '1'
+# Free space downloads may not reserve; defaults to the adaptive controller's floor
+DISK_WATERMARK_BYTES = int(os.environ.get('DISK_WATERMARK_BYTES', MIN_FREE_DISK_BYTES))
+# Peak bytes per byte of media: separate streams plus the merged file, or a file plus its remux copy
+DISK_FOOTPRINT_FACTOR = float(os.environ.get('DISK_FOOTPRINT_FACTOR', 2))
+# Media size assumed when a format reports neither a size nor a bitrate
+DISK_DEFAULT_MEDIA_BYTES = int(os.environ.get('DISK_DEFAULT_MEDIA_BYTES', 256 * 1024 ** 2))
+
+disk_admission = DiskAdmission(free_disk_bytes, DISK_WATERMARK_BYTES, evict=download_cache.evict_bytes,
+                               evictable=download_cache.evictable_bytes)
+if DISK_ADMISSION:
+    disk_admission.start()
+
+def estimate_footprint(info):
+    """Peak disk bytes for downloading a probed (format-selected) info dict"""
+    size = 0
+    for fmt in info.get('requested_formats') or [info]:
+        known = fmt.get('filesize') or fmt.get('filesize_approx')
+        if not known and fmt.get('tbr') and info.get('duration'):
+            known = fmt['tbr'] * 1000 / 8 * info['duration']
+        size += known or DISK_DEFAULT_MEDIA_BYTES
+    return int(size * DISK_FOOTPRINT_FACTOR)
 
 def sanitize_filename(filename):
     """Remove or replace characters that cause issues in URLs and filesystems"""
@@ -42,54 +1263,64 @@ def sanitize_filename(filename):
     sanitized = sanitized.strip()[:200]
     return sanitized if sanitized else 'video'
 
-def get_opts(task_id, format_id='best'):
+def get_opts(format_id='best'):
+    """Per-download overrides applied on top of the pooled 'download' profile"""
     if isinstance(format_id, int):
         fmt = f"bestvideo[height<={format_id}]+bestaudio/best[height<={format_id}]"
-        postprocessors = []
     elif format_id == 'audio':
         fmt = 'bestaudio/best'
-        postprocessors = []
     else:
         fmt = format_id
-        postprocessors = []
 
-    opts = {
-        'format': fmt,
-        'outtmpl': os.path.join(DOWNLOAD_FOLDER, '%(title)s.%(ext)s'),
-        'progress_hooks': [lambda d: progress_hook(d, task_id)],
-        'quiet': True,
-        'noplaylist': True,
-        'nocolor': True,
-        'force_ipv4': True,
-        'extractor_args': {'youtube': {'player_client': ['android', 'web']}},  # Bypass bot detection
-    }
+    opts = {'format': fmt}
     
     if format_id != 'audio':
         opts['merge_output_format'] = 'mp4'
-    
-    if postprocessors:
-        opts['postprocessors'] = postprocessors
         
     return opts
 
-def optimize_video(file_path, task_id):
+optimize_stats = {'skipped': 0, 'relocated': 0, 'remuxed': 0, 'bytes_avoided': 0}
+
+def record_optimize(task_id, mode, bytes_avoided):
+    optimize_stats[mode] += 1
+    optimize_stats['bytes_avoided'] += bytes_avoided
+    progress_emitter.publish(task_id, {'optimize': mode, 'optimize_bytes_avoided': bytes_avoided})
+
+def optimize_video(file_path, task_id, token=None):
     """
-    Manually optimize video with ffmpeg for better seeking performance.
+    Make sure the moov atom sits before the media data for better seeking performance.
+    Files that are already faststart (or not MP4) are left alone; otherwise moov is
+    moved in place, with a full ffmpeg remux only as the fallback.
     """
     try:
         if not os.path.exists(file_path):
             print(f"File not found for optimization: {file_path}")
             return file_path
-        
-        base, ext = os.path.splitext(file_path)
-        temp_output = f"{base}_optimized{ext}"
-        
-        socketio.emit('progress', {
-            'taskId': task_id,
+
+        # Bytes avoided are counted as disk I/O versus a full remux (read + write of the file)
+        layout = faststart.inspect(file_path)
+        if not faststart.needs_faststart(layout):
+            size = os.path.getsize(file_path)
+            record_optimize(task_id, 'skipped', 2 * size)
+            print(f"Already optimized: {os.path.basename(file_path)}")
+            return file_path
+
+        progress_emitter.publish(task_id, {
             'status': 'optimizing',
             'progress': 100,
             'message': 'Optimizing for smooth playback...'
         })
+
+        try:
+            written = faststart.relocate_moov(file_path, layout)
+            record_optimize(task_id, 'relocated', 2 * (layout['size'] - written))
+            print(f"Optimization complete (in place): {os.path.basename(file_path)}")
+            return file_path
+        except faststart.FaststartError as e:
+            print(f"In-place faststart not possible, remuxing: {e}")
+        
+        base, ext = os.path.splitext(file_path)
+        temp_output = f"{base}_optimized{ext}"
         
         cmd = [
             'ffmpeg',
@@ -101,14 +1332,16 @@ def optimize_video(file_path, task_id):
         ]
         
         print(f"Optimizing: {os.path.basename(file_path)}")
-        import subprocess
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        if token is not None:
+            token.track_file(temp_output)
+        result = cancellation.run_process(cmd, token)
         
         if result.returncode == 0 and os.path.exists(temp_output):
             try:
                 if os.path.exists(file_path):
                     os.remove(file_path)
                 os.rename(temp_output, file_path)
+                record_optimize(task_id, 'remuxed', 0)
                 print(f"Optimization complete: {os.path.basename(file_path)}")
                 return file_path
             except Exception as rename_error:
@@ -122,88 +1355,209 @@ def optimize_video(file_path, task_id):
                 os.remove(temp_output)
             return file_path
             
+    except cancellation.Cancelled:
+        raise
     except Exception as e:
         print(f"Optimization error: {e}")
         return file_path
 
-def progress_hook(d, task_id):
-    if task_control.get(task_id, {}).get('abort'):
-        raise Exception("Download Aborted by User")
+# Post-processing Pipeline
+# Each stage has its own workers and bounded queue, so remuxing never holds a download slot
+RENAME_WORKERS = int(os.environ.get('RENAME_WORKERS', 2))
+OPTIMIZE_WORKERS = int(os.environ.get('OPTIMIZE_WORKERS', 2))
+PUBLISH_WORKERS = int(os.environ.get('PUBLISH_WORKERS', 1))
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', 64))
+
+class PostJob:
+    """A finished download travelling through the post-processing stages"""
+    def __init__(self, task_id, path, title, cache_key, token):
+        self.task_id = task_id
+        self.path = path
+        self.title = title
+        self.cache_key = cache_key
+        self.token = token
+        self.timings = {}  # stage -> seconds
+
+class Stage:
+    def __init__(self, name, handler, workers, queue_size):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.next = None
+        self.processed = 0
+        self.total_seconds = 0.0
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def put(self, job):
+        # Blocks when the stage is saturated, pushing back on the stage before it
+        with self._lock:
+            while len(self._threads) < self.workers:
+                t = threading.Thread(target=self._worker, name=f"{self.name}-{len(self._threads)}", daemon=True)
+                self._threads.append(t)
+                t.start()
+        self.queue.put(job)
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            start = time.monotonic()
+            try:
+                if job.token.cancelled or task_state.is_aborted(job.task_id):
+                    raise cancellation.Cancelled()
+                with cancellation.bound(job.token):
+                    self.handler(job)
+            except Exception as e:
+                fail_post_job(job, e)
+                continue
+            finally:
+                elapsed = time.monotonic() - start
+                job.timings[self.name] = round(elapsed, 3)
+                stage_seconds.observe(elapsed, stage=self.name)
+                with self._lock:
+                    self.processed += 1
+                    self.total_seconds += elapsed
+            if self.next:
+                self.next.put(job)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queued': self.queue.qsize(),
+                'processed': self.processed,
+                'avg_seconds': round(self.total_seconds / self.processed, 3) if self.processed else 0.0
+            }
+
+class PostProcessPipeline:
+    def __init__(self, stages):
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next = next_stage
+
+    def submit(self, job):
+        self.stages[0].put(job)
+
+    def stats(self):
+        return {stage.name: stage.stats() for stage in self.stages}
+
+def rename_output(file_path, title=None):
+    """Moves a finished download to a filesystem/URL safe name in DOWNLOAD_FOLDER, from its title when known"""
+    base_name = os.path.basename(file_path)
+    name, ext = os.path.splitext(base_name)
+    if title:
+        name = title
+    sanitized_name = sanitize_filename(name) + ext
+    new_path = os.path.join(DOWNLOAD_FOLDER, sanitized_name)
+    
+    if os.path.abspath(file_path) != os.path.abspath(new_path):
+        counter = 1
+        while os.path.exists(new_path):
+            sanitized_name = f"{sanitize_filename(name)}_{counter}{ext}"
+            new_path = os.path.join(DOWNLOAD_FOLDER, sanitized_name)
+            counter += 1
+        
+        try:
+            os.rename(file_path, new_path)
+            print(f"Renamed: {base_name} -> {sanitized_name}")
+        except Exception as rename_err:
+            print(f"Rename error: {rename_err}")
+            new_path = file_path
+    return new_path
+
+def rename_stage(job):
+    job.path = rename_output(job.path, job.title)
+
+def optimize_stage(job):
+    job.path = optimize_video(job.path, job.task_id, job.token)
+    disk_admission.release(job.task_id)
+
+def publish_stage(job):
+    filename = os.path.basename(job.path)
+    if job.cache_key is not None:
+        download_cache.complete(job.cache_key, filename)
+    progress_emitter.publish(job.task_id, {
+        'progress': 100,
+        'status': 'finished',
+        'filename': filename,
+        'title': job.title,
+        'timings': job.timings
+    })
+    emit_to_task('complete', {'taskId': job.task_id}, job.task_id)
+    finish_task(job.task_id, filename=filename)
+    print(f"Completed download for {job.task_id} ({job.timings})")
+
+def fail_post_job(job, error):
+    if job.cache_key is not None:
+        download_cache.fail(job.cache_key, str(error))
+    if job.token.cancelled or "Aborted" in str(error):
+        print(f"Task {job.task_id} aborted")
+        job.token.track_file(job.path)
+        reclaim_cancelled(job.token)
+        finish_task(job.task_id, 'aborted')
+    else:
+        print(f"Post-processing error for {job.task_id}: {error}")
+        errors_total.inc(stage='postprocess')
+        emit_to_task('error', {'taskId': job.task_id, 'error': str(error)}, job.task_id)
+        finish_task(job.task_id, 'failed')
+
+postprocess_pipeline = PostProcessPipeline([
+    Stage('rename', rename_stage, RENAME_WORKERS, PIPELINE_QUEUE_SIZE),
+    Stage('optimize', optimize_stage, OPTIMIZE_WORKERS, PIPELINE_QUEUE_SIZE),
+    Stage('publish', publish_stage, PUBLISH_WORKERS, PIPELINE_QUEUE_SIZE),
+])
+
+def downloaded_path(result):
+    """Final on-disk path (after merging) from the info dict process_ie_result returns"""
+    for download in result.get('requested_downloads') or []:
+        if download.get('filepath'):
+            return download['filepath']
+    return result.get('filepath') or result.get('_filename')
+
+def progress_hook(d, task_id, token=None):
+    if token is not None:
+        token.raise_if_cancelled()
+    if task_state.is_aborted(task_id):
+        raise cancellation.Cancelled()
 
     try:
         if d['status'] == 'downloading':
-            p_str = d.get('_percent_str', '0%')
-            p_str = re.sub(r'\x1b\[[0-9;]*m', '', p_str).replace('%', '')
-            try:
-                progress = float(p_str)
-            except ValueError:
-                progress = 0
+            if d.get('tmpfilename'):
+                job_journal.partial(task_id, d['tmpfilename'])
+            if token is not None:
+                token.track_file(d.get('filename'))
+            # Derived from yt-dlp's numeric fields; the _*_str fields need ANSI stripping
+            downloaded = d.get('downloaded_bytes') or 0
+            total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+            elapsed = d.get('elapsed') or 0
 
-            speed = d.get('_speed_str', 'N/A')
-            speed = re.sub(r'\x1b\[[0-9;]*m', '', speed) if speed else 'N/A'
-            
-            eta = d.get('_eta_str', 'N/A')
-            eta = re.sub(r'\x1b\[[0-9;]*m', '', eta) if eta else 'N/A'
+            progress = (downloaded / total) * 100 if total else 0
+            speed = d.get('speed') or (downloaded / elapsed if elapsed else 0)
+            delta = concurrency_controller.record_progress(task_id, downloaded, speed)
+            downloaded_bytes.inc(delta)
+            disk_admission.wrote(task_id, delta)
+            throttle_download(task_id, delta)
+            eta = (total - downloaded) / speed if speed and total else None
             
-            filename = os.path.basename(d.get('filename', ''))
-            title = d.get('info_dict', {}).get('title')
-            
-            downloaded = d.get('downloaded_bytes', 0)
-            total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
-
-            socketio.emit('progress', {
-                'taskId': task_id,
-                'progress': progress,
-                'speed': speed,
-                'eta': eta,
+            progress_emitter.publish(task_id, {
+                'progress': min(progress, 100),
+                'speed': format_speed(speed),
+                'eta': format_eta(eta),
                 'status': 'downloading',
-                'filename': filename,
-                'title': title,
+                'filename': os.path.basename(d.get('filename', '')),
+                'title': d.get('info_dict', {}).get('title'),
                 'downloaded_bytes': downloaded,
                 'total_bytes': total
             })
-            # time.sleep not needed here as hook is called synchronously by yt-dlp
 
         elif d['status'] == 'finished':
-            original_file = d.get('filename')
-            if original_file and os.path.exists(original_file):
-                base_name = os.path.basename(original_file)
-                name, ext = os.path.splitext(base_name)
-                sanitized_name = sanitize_filename(name) + ext
-                new_path = os.path.join(DOWNLOAD_FOLDER, sanitized_name)
-                
-                if original_file != new_path:
-                    counter = 1
-                    while os.path.exists(new_path):
-                        sanitized_name = f"{sanitize_filename(name)}_{counter}{ext}"
-                        new_path = os.path.join(DOWNLOAD_FOLDER, sanitized_name)
-                        counter += 1
-                    
-                    try:
-                        os.rename(original_file, new_path)
-                        print(f"Renamed: {base_name} -> {sanitized_name}")
-                    except Exception as rename_err:
-                        print(f"Rename error: {rename_err}")
-                        sanitized_name = base_name
-                        new_path = original_file
-                
-                final_path = optimize_video(new_path, task_id)
-                final_filename = os.path.basename(final_path)
-                
-                socketio.emit('progress', {
-                    'taskId': task_id,
-                    'progress': 100,
-                    'status': 'finished',
-                    'filename': final_filename,
-                    'title': d.get('info_dict', {}).get('title')
-                })
-            else:
-                socketio.emit('progress', {
-                    'taskId': task_id,
-                    'progress': 100,
-                    'status': 'finished',
-                    'filename': os.path.basename(d.get('filename', 'download.mp4'))
-                })
+            # One stream is on disk; merging and post-processing report their own progress
+            progress_emitter.publish(task_id, {
+                'progress': 100,
+                'status': 'processing',
+                'title': d.get('info_dict', {}).get('title')
+            })
     except Exception as e:
         print(f"Hook Error: {e}")
 
@@ -227,120 +1581,202 @@ def get_info():
         elif filter_tab == 'shorts':
             final_url = f"{base_url}/shorts"
     
+    session_key = session = None
     try:
-        start_index = (page - 1) * PAGE_SIZE + 1
-        end_index = page * PAGE_SIZE
-        
-        ydl_opts = {
-            'quiet': True,
-            'extract_flat': 'in_playlist',
-            'nocolor': True,
-            'playliststart': start_index,
-            'playlistend': end_index,
-            'force_ipv4': True,
-            'extractor_args': {'youtube': {'player_client': ['android', 'web']}},
-        }
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(final_url, download=False)
+        if channel_index and not is_playlist and filter_tab in ('videos', 'shorts') and CHANNEL_URL.search(base_url):
+            search = (request.json.get('search') or '').strip() or None
+            result = channel_page(base_url, final_url, filter_tab, page, PAGE_SIZE, search)
+            proxy_thumbnails(result['videos'])
+            return jsonify(result)
+
+        session_key, session = get_listing_session(final_url, filter_tab, is_playlist)
+
+        if session.is_listing:
+            entries, has_more = session.page(page, PAGE_SIZE)
+            videos = proxy_thumbnails([listing_video(e) for e in entries])
+
+            stats = {'2160p': 0, '1440p': 0, '1080p': 0, '720p': 0, '480p': 0}
+
+            return jsonify({
+                'type': 'playlist' if is_playlist else 'channel',
+                'title': session.title,
+                'url': base_url,
+                'current_tab': filter_tab,
+                'videos': videos,
+                'stats': stats,
+                'page': page,
+                'has_more': has_more
+            })
+        else:
+            info = extract_info_cached(url, 'video')
             
-            if 'entries' in info:
-                entries = [e for e in info['entries'] if e]
-                if is_playlist:
-                    filtered_entries = []
-                    for e in entries:
-                        v_url = e.get('url') or e.get('webpage_url') or f"https://www.youtube.com/watch?v={e.get('id')}"
-                        is_short = '/shorts/' in (v_url or '')
-                        
-                        if filter_tab == 'shorts' and is_short:
-                            filtered_entries.append(e)
-                        elif filter_tab == 'videos' and not is_short:
-                            filtered_entries.append(e)
-                    entries = filtered_entries
-
-                videos = []
-                for e in entries:
-                    v_id = e.get('id')
-                    v_url = e.get('url') or e.get('webpage_url')
-                    if not v_url and v_id:
-                        v_url = f"https://www.youtube.com/watch?v={v_id}"
-                    
-                    thumbnail = None
-                    thumbnails = e.get('thumbnails')
-                    if thumbnails and len(thumbnails) > 0:
-                        thumbnail = thumbnails[-1].get('url')
-                    elif e.get('thumbnail'):
-                        thumbnail = e.get('thumbnail')
-                    elif v_id:
-                        thumbnail = f"https://i.ytimg.com/vi/{v_id}/hqdefault.jpg"
-                        
-                    videos.append({
-                        'id': v_id,
-                        'title': e.get('title'),
-                        'duration': e.get('duration'),
-                        'thumbnail': thumbnail,
-                        'url': v_url,
-                        'is_short': '/shorts/' in (v_url or ''),
-                        'max_height': 0
-                    })
-                
-                stats = {'2160p': 0, '1440p': 0, '1080p': 0, '720p': 0, '480p': 0}
-
-                return jsonify({
-                    'type': 'playlist' if is_playlist else 'channel',
-                    'title': info.get('title'),
-                    'url': base_url,
-                    'current_tab': filter_tab,
-                    'videos': videos,
-                    'stats': stats,
-                    'page': page,
-                    'has_more': len(entries) == PAGE_SIZE
-                })
-            else:
-                with yt_dlp.YoutubeDL({
-                    'quiet': True,
-                    'nocolor': True,
-                    'force_ipv4': True,
-                    'extractor_args': {'youtube': {'player_client': ['android', 'web']}}
-                }) as ydl_single:
-                    info = ydl_single.extract_info(url, download=False)
-                
-                formats = []
-                seen_res = set()
-                for f in info.get('formats', []):
-                     if f.get('ext') == 'mp4' and f.get('height'):
-                        res = f"{f['height']}p"
-                        if res not in seen_res:
-                            formats.append({
-                                'format_id': f['format_id'],
-                                'resolution': res,
-                                'ext': f['ext'],
-                                'filesize_approx': f.get('filesize_approx'),
-                            })
-                            seen_res.add(res)
-                
-                formats.append({
-                    'format_id': 'audio',
-                    'resolution': 'Audio Only',
-                    'ext': 'webm',
-                    'filesize_approx': None, 
-                })
+            formats = []
+            seen_res = set()
+            for f in info.get('formats', []):
+                 if f.get('ext') == 'mp4' and f.get('height'):
+                    res = f"{f['height']}p"
+                    if res not in seen_res:
+                        formats.append({
+                            'format_id': f['format_id'],
+                            'resolution': res,
+                            'ext': f['ext'],
+                            'filesize_approx': f.get('filesize_approx'),
+                        })
+                        seen_res.add(res)
+            
+            formats.append({
+                'format_id': 'audio',
+                'resolution': 'Audio Only',
+                'ext': 'webm',
+                'filesize_approx': None, 
+            })
 
-                formats.sort(key=lambda x: int(x['resolution'][:-1]) if x['resolution'][0].isdigit() else -1, reverse=True)
+            formats.sort(key=lambda x: int(x['resolution'][:-1]) if x['resolution'][0].isdigit() else -1, reverse=True)
 
-                return jsonify({
-                    'type': 'video',
-                    'title': info.get('title'),
-                    'thumbnail': info.get('thumbnail'),
-                    'duration': info.get('duration'),
-                    'formats': formats,
-                    'original_url': url
-                })
+            return jsonify({
+                'type': 'video',
+                'title': info.get('title'),
+                'thumbnail': info.get('thumbnail'),
+                'duration': info.get('duration'),
+                'formats': formats,
+                'original_url': url
+            })
 
     except Exception as e:
         print(f"Error: {e}")
+        if session is not None:
+            # A listing that failed mid-walk can't be resumed; start fresh next time
+            listing_sessions.invalidate(session_key)
         return jsonify({'error': str(e)}), 500
 
+def finish_from_cache(tid, filename, title=None):
+    progress_emitter.publish(tid, {
+        'progress': 100,
+        'status': 'finished',
+        'filename': filename,
+        'title': title,
+        'cached': True
+    })
+    emit_to_task('complete', {'taskId': tid}, tid)
+    finish_task(tid, filename=filename)
+
+def download_task(tid, link, fmt, leading_key=None):
+    """
+    Runs on a scheduler worker; the global concurrency limit is the worker count.
+    leading_key is set when the task already leads that cache key and was only
+    waiting for disk space.
+    """
+    cache_key = leading_key
+    leading = leading_key is not None
+    handed_off = False
+    outcome = 'failed'
+    token = cancel_tokens.get(tid)
+    try:
+        print(f"Starting download for {tid}")
+        if token.cancelled or task_state.is_aborted(tid):
+            print(f"Task {tid} aborted before start")
+            if leading:
+                download_cache.fail(cache_key, "Download Aborted by User")
+            outcome = 'aborted'
+            return
+
+        opts = get_opts(fmt)
+        # Resolve the concrete format through the metadata cache so identical
+        # requests map to the same cache key before anything is downloaded
+        info = extract_info_cached(link, 'download', opts)
+        if not leading:
+            cache_key = download_cache_key(info, opts)
+        # Resubmissions (after a failed shared download or a wait for disk) keep the client's place in line
+        owner, priority = download_scheduler.placement_of(tid)
+
+        def on_ready(filename, error):
+            if token.cancelled or task_state.is_aborted(tid):
+                finish_task(tid, 'aborted')
+            elif error is None:
+                finish_from_cache(tid, filename, info.get('title'))
+            else:
+                # The shared download failed; fetch it ourselves
+                download_scheduler.submit(tid, owner, download_task, (tid, link, fmt), priority=priority)
+
+        state, filename = ('lead', None) if leading else download_cache.claim(cache_key, on_ready)
+        if state == 'hit':
+            print(f"Cache hit for {tid}: {filename}")
+            finish_from_cache(tid, filename, info.get('title'))
+            return
+        if state == 'wait':
+            # on_ready owns the task from here
+            print(f"Task {tid} waiting on an in-flight download of the same file")
+            handed_off = True
+            # A cancel ends the wait now rather than when the other download finishes
+            def stop_waiting():
+                if download_cache.withdraw(cache_key, on_ready):
+                    finish_task(tid, 'aborted')
+
+            token.on_cancel(stop_waiting)
+            return
+
+        leading = True
+        if DISK_ADMISSION:
+            def on_space():
+                download_scheduler.submit(tid, owner, download_task, (tid, link, fmt, cache_key), priority=priority)
+
+            if not disk_admission.reserve(tid, estimate_footprint(info), on_space):
+                # Still the leader for cache_key; on_space hands the task back to the scheduler
+                print(f"Task {tid} waiting for disk space")
+                progress_emitter.publish(tid, {'status': 'queued', 'progress': 0, 'message': 'Waiting for disk space'})
+                leading = False
+                handed_off = True
+
+                def stop_waiting():
+                    # Still waiting for space, or admitted and back in the scheduler's queue
+                    if disk_admission.withdraw(tid) or download_scheduler.cancel(tid):
+                        download_cache.fail(cache_key, "Download Aborted by User")
+                        finish_task(tid, 'aborted')
+
+                token.on_cancel(stop_waiting)
+                return
+
+        job_journal.update(tid, 'downloading')
+        start = time.monotonic()
+        with ydl_pool.checkout('download', opts, progress_hook=lambda d: progress_hook(d, tid, token), cancel_token=token) as ydl:
+            # Reuse the probed info instead of extracting a second time
+            result = ydl.process_ie_result(ydl.sanitize_info(info), download=True)
+
+        path = downloaded_path(result)
+        token.track_file(path)
+        token.raise_if_cancelled()
+        if not path or not os.path.exists(path):
+            raise Exception("Download produced no file")
+        size = os.path.getsize(path)
+        # Parts are merged away by now; what's left to reserve for is a possible remux copy
+        disk_admission.update(tid, size * 2, size)
+        concurrency_controller.record_outcome(tid)
+
+        # Rename/optimize/publish run on the pipeline's own workers; this slot is free now
+        job = PostJob(tid, path, info.get('title'), cache_key, token)
+        job.timings['download'] = round(time.monotonic() - start, 3)
+        stage_seconds.observe(job.timings['download'], stage='download')
+        job_journal.update(tid, 'processing')
+        postprocess_pipeline.submit(job)
+        leading = False
+        handed_off = True
+    except Exception as e:
+        if leading:
+            download_cache.fail(cache_key, str(e))
+        # A killed merge or a shut-down socket surfaces as yt-dlp's own error
+        if token.cancelled or "Aborted" in str(e):
+            print(f"Task {tid} aborted")
+            outcome = 'aborted'
+            reclaim_cancelled(token)
+        else:
+            print(f"Download Error: {e}")
+            errors_total.inc(stage='download')
+            concurrency_controller.record_outcome(tid, e)
+            emit_to_task('error', {'taskId': tid, 'error': str(e)}, tid)
+    finally:
+        if not handed_off:
+            finish_task(tid, outcome)
+
 @app.route('/api/download', methods=['POST'])
 def download():
     data = request.json
@@ -350,35 +1786,83 @@ def download():
     task_id = str(uuid.uuid4())
     sid = data.get('sid')
     
-    if sid and sid in client_tasks:
-        client_tasks[sid].append(task_id)
-    task_control[task_id] = {'abort': False}
-    
-    def download_task(tid, link, fmt):
-        try:
-            print(f"Starting download for {tid}")
-            if task_control.get(tid, {}).get('abort'):
-                return
+    register_task(task_id, sid, request_trace_id())
+    job_journal.submitted(task_id, url, format_id, PRIORITY_SINGLE, sid)
 
-            opts = get_opts(tid, fmt)
-            with yt_dlp.YoutubeDL(opts) as ydl:
-                ydl.download([link])
-            socketio.emit('complete', {'taskId': tid})
-            print(f"Completed download for {tid}")
-        except Exception as e:
-            if "Aborted" in str(e):
-                print(f"Task {tid} aborted")
-            else:
-                print(f"Download Error: {e}")
-                socketio.emit('error', {'taskId': tid, 'error': str(e)})
-        finally:
-             if tid in task_control:
-                 del task_control[tid]
+    position = download_scheduler.submit(task_id, sid, download_task, (task_id, url, format_id), priority=PRIORITY_SINGLE)
+    return jsonify({'taskId': task_id, 'status': 'started', 'queuePosition': position})
+
+# Format Probing
+# One pool for every /api/batch_formats request, so concurrent batches share a global cap
+PROBE_WORKERS = int(os.environ.get('PROBE_WORKERS', 10))
+probe_executor = concurrent.futures.ThreadPoolExecutor(max_workers=PROBE_WORKERS, thread_name_prefix='probe')
+
+def fetch_max_resolution(url):
+    try:
+        # No tpool! Running in thread pool executor
+        info = extract_info_cached(url, 'formats')
+        
+        max_height = 0
+        for fmt in info.get('formats', []):
+            if fmt.get('height') and fmt.get('vcodec') != 'none':
+                max_height = max(max_height, fmt['height'])
+        if channel_index:
+            channel_index.record_heights({info.get('id'): max_height})
+        
+        resolution_label = 'Unknown'
+        if max_height >= 2160: resolution_label = '4K'
+        elif max_height >= 1440: resolution_label = '2K'
+        elif max_height >= 1080: resolution_label = '1080p'
+        elif max_height >= 720: resolution_label = '720p'
+        elif max_height >= 480: resolution_label = '480p'
+        elif max_height > 0: resolution_label = '360p'
+        
+        return {
+            'url': url,
+            'maxHeight': max_height,
+            'maxResolution': resolution_label
+        }
+    except Exception as e:
+        print(f"Error fetching formats for {url}: {e}")
+        return {
+            'url': url,
+            'maxHeight': 0,
+            'maxResolution': 'Unknown',
+            'error': str(e)
+        }
+
+def iter_probe_results(urls):
+    """
+    Yields (index, result) as probes finish. A probe running longer than
+    PROBE_DEADLINE is reported as timed out; closing the generator (e.g. the
+    client went away) cancels every probe that hasn't started yet.
+    """
+    started = {}
+
+    def probe(index, url):
+        started[index] = time.monotonic()
+        return fetch_max_resolution(url)
+
+    pending = {probe_executor.submit(probe, i, url): i for i, url in enumerate(urls)}
+    try:
+        while pending:
+            done, _ = concurrent.futures.wait(pending, timeout=1, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
 
-    # Use native threading instead of socketio.start_background_task for gunicorn compatibility
-    thread = threading.Thread(target=download_task, args=(task_id, url, format_id), daemon=True)
-    thread.start()
-    return jsonify({'taskId': task_id, 'status': 'started'})
+            now = time.monotonic()
+            for future, index in list(pending.items()):
+                if index in started and now - started[index] > PROBE_DEADLINE:
+                    del pending[future]
+                    yield index, {
+                        'url': urls[index],
+                        'maxHeight': 0,
+                        'maxResolution': 'Unknown',
+                        'error': 'Timed out'
+                    }
+    finally:
+        for future in pending:
+            future.cancel()
 
 @app.route('/api/batch_formats', methods=['POST'])
 def batch_formats():
@@ -387,59 +1871,84 @@ def batch_formats():
     
     if not urls:
         return jsonify({'error': 'No URLs provided'}), 400
-    
-    # Simple direct function
-    def fetch_max_resolution(url):
-        try:
-            opts = {
-                'quiet': True,
-                'nocolor': True,
-                'noplaylist': True,
-                'extract_flat': False,
-                'skip_download': True,
-                'skip_download': True,
-                'extractor_args': {'youtube': {'player_client': ['android']}},
-                'force_ipv4': True,
-            }
-            # No tpool! Running in thread pool executor
-            with yt_dlp.YoutubeDL(opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-            
-            max_height = 0
-            for fmt in info.get('formats', []):
-                if fmt.get('height') and fmt.get('vcodec') != 'none':
-                    max_height = max(max_height, fmt['height'])
-            
-            resolution_label = 'Unknown'
-            if max_height >= 2160: resolution_label = '4K'
-            elif max_height >= 1440: resolution_label = '2K'
-            elif max_height >= 1080: resolution_label = '1080p'
-            elif max_height >= 720: resolution_label = '720p'
-            elif max_height >= 480: resolution_label = '480p'
-            elif max_height > 0: resolution_label = '360p'
-            
-            # Artificial delay to prove async works? No.
-            return {
-                'url': url,
-                'maxHeight': max_height,
-                'maxResolution': resolution_label
-            }
-        except Exception as e:
-            print(f"Error fetching formats for {url}: {e}")
-            return {
-                'url': url,
-                'maxHeight': 0,
-                'maxResolution': 'Unknown',
-                'error': str(e)
-            }
-    
-    # Use standard ThreadPoolExecutor instead of Eventlet GreenPool
-    results = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        results = list(executor.map(fetch_max_resolution, urls))
+
+    # Streaming: one NDJSON line per URL in completion order, so a slow video doesn't hold the grid
+    if data.get('stream') or 'application/x-ndjson' in request.headers.get('Accept', ''):
+        def generate():
+            for index, result in iter_probe_results(urls):
+                yield json.dumps(dict(result, index=index)) + '\n'
+
+        return Response(generate(), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+
+    results = [None] * len(urls)
+    for index, result in iter_probe_results(urls):
+        results[index] = result
     
     return jsonify({'formats': results})
 
+# Batch Archives
+# Seconds /api/batch_archive waits for the next item of a batch before giving up on the rest
+BATCH_ARCHIVE_ITEM_TIMEOUT = float(os.environ.get('BATCH_ARCHIVE_ITEM_TIMEOUT', 3600))
+# How long batches and task outcomes are remembered after they're created/recorded
+BATCH_RETENTION_SECONDS = int(os.environ.get('BATCH_RETENTION_SECONDS', 6 * 3600))
+
+class TaskOutcomes:
+    """Terminal outcome and output filename of recent tasks, waitable by archive streams"""
+    def __init__(self, retention):
+        self.retention = retention
+        self._outcomes = {}  # task_id -> (outcome, filename, recorded_at)
+        self._cond = threading.Condition()
+
+    def record(self, task_id, outcome, filename=None):
+        with self._cond:
+            now = time.time()
+            self._outcomes[task_id] = (outcome, filename, now)
+            for tid in [t for t, (_, _, at) in self._outcomes.items() if now - at > self.retention]:
+                del self._outcomes[tid]
+            self._cond.notify_all()
+
+    def iter_completed(self, task_ids, timeout):
+        """
+        Yields (task_id, outcome, filename) for each task as it completes, in
+        completion order. Tasks still pending after timeout idle seconds are
+        yielded with outcome 'timeout'.
+        """
+        pending = list(task_ids)
+        while pending:
+            with self._cond:
+                if not self._cond.wait_for(lambda: any(tid in self._outcomes for tid in pending), timeout):
+                    results = None
+                else:
+                    results = [(tid,) + self._outcomes[tid][:2] for tid in pending if tid in self._outcomes]
+            if results is None:
+                for tid in pending:
+                    yield tid, 'timeout', None
+                return
+            for result in results:
+                pending.remove(result[0])
+                yield result
+
+class BatchRegistry:
+    def __init__(self, retention):
+        self.retention = retention
+        self._batches = {}  # batch_id -> (task_ids, created_at)
+        self._lock = threading.Lock()
+
+    def register(self, batch_id, task_ids):
+        with self._lock:
+            now = time.time()
+            self._batches[batch_id] = (list(task_ids), now)
+            for bid in [b for b, (_, at) in self._batches.items() if now - at > self.retention]:
+                del self._batches[bid]
+
+    def get(self, batch_id):
+        with self._lock:
+            batch = self._batches.get(batch_id)
+            return list(batch[0]) if batch else None
+
+task_outcomes = TaskOutcomes(BATCH_RETENTION_SECONDS)
+batches = BatchRegistry(BATCH_RETENTION_SECONDS)
+
 @app.route('/api/batch_download', methods=['POST'])
 def batch_download():
     data = request.json
@@ -449,62 +1958,345 @@ def batch_download():
     task_ids = []
     sid = data.get('sid')
     
+    fmt = quality_cap if quality_cap else 'best'
+    batch_id = str(uuid.uuid4())
+    trace_id = request_trace_id()
+    jobs = []
     for url in urls:
         task_id = str(uuid.uuid4())
         task_ids.append(task_id)
         
-        if sid and sid in client_tasks:
-            client_tasks[sid].append(task_id)
-        task_control[task_id] = {'abort': False}
-        
-        def download_task(tid, link, q_cap):
-            socketio.emit('progress', {'taskId': tid, 'status': 'queued', 'progress': 0})
-            
-            with download_semaphore:
-                if task_control.get(tid, {}).get('abort'):
-                    print(f"Task {tid} aborted before start")
-                    return
+        register_task(task_id, sid, trace_id)
+        job_journal.submitted(task_id, url, fmt, PRIORITY_BATCH, sid, sync=False)
+        jobs.append((task_id, download_task, (task_id, url, fmt)))
+    job_journal.sync()
+    batches.register(batch_id, task_ids)
 
-                try:
-                    fmt = q_cap if q_cap else 'best'
-                    opts = get_opts(tid, fmt)
-                    
-                    with yt_dlp.YoutubeDL(opts) as ydl:
-                        ydl.download([link])
-                    socketio.emit('complete', {'taskId': tid})
-                except Exception as e:
-                    if "Aborted" in str(e):
-                        print(f"Task {tid} aborted properly")
-                    else:
-                        socketio.emit('error', {'taskId': tid, 'error': str(e)})
-                finally:
-                    if tid in task_control:
-                        del task_control[tid]
+    # Queued in the scheduler instead of parking a thread per URL
+    positions = download_scheduler.submit_many(sid, jobs)
+    for task_id in task_ids:
+        progress_emitter.publish(task_id, {'status': 'queued', 'progress': 0, 'queue_position': positions[task_id]})
+
+    return jsonify({'taskIds': task_ids, 'batchId': batch_id, 'status': 'batch_started', 'queuePositions': positions})
+
+@app.route('/api/batch_archive/<batch_id>', methods=['GET'])
+def batch_archive(batch_id):
+    """
+    The batch's files as one ZIP (stored) or TAR, written as each download
+    completes. Failed items are left out and listed in errors.txt at the end.
+    """
+    task_ids = batches.get(batch_id)
+    if task_ids is None:
+        return jsonify({'error': 'Unknown batch'}), 404
+    archive_format = request.args.get('format', 'zip')
+    if archive_format not in ('zip', 'tar'):
+        return jsonify({'error': 'format must be zip or tar'}), 400
+
+    def entries():
+        failures = []
+        for task_id, outcome, filename in task_outcomes.iter_completed(task_ids, BATCH_ARCHIVE_ITEM_TIMEOUT):
+            if outcome != 'finished' or not filename:
+                failures.append(f"{task_id}: {outcome}")
+                continue
+            path = os.path.join(DOWNLOAD_FOLDER, filename)
+            # Pinned before the existence check so the cache can't evict it mid-read
+            pinned = download_cache.acquire(filename)
+            try:
+                if not os.path.isfile(path):
+                    failures.append(f"{task_id}: {filename} is no longer available")
+                    continue
+                touch_file(filename)
+                yield filename, path
+            finally:
+                if pinned:
+                    download_cache.release(filename)
+        if failures:
+            with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as report:
+                report.write('\n'.join(failures) + '\n')
+            try:
+                yield 'errors.txt', report.name
+            finally:
+                os.remove(report.name)
+
+    stream = archive_stream.zip_stream(entries()) if archive_format == 'zip' else archive_stream.tar_stream(entries())
+    return Response(metered('archive', stream), headers={
+        'Content-Disposition': f'attachment; filename="batch-{batch_id[:8]}.{archive_format}"',
+        'Content-Type': 'application/zip' if archive_format == 'zip' else 'application/x-tar',
+        'X-Accel-Buffering': 'no',
+    })
+
+@app.route('/api/thumbnail/<video_id>/<variant>', methods=['GET'])
+def thumbnail(video_id, variant):
+    if not thumbnail_cache or not VIDEO_ID.fullmatch(video_id) or variant not in THUMBNAIL_VARIANTS:
+        return jsonify({'error': 'Unknown thumbnail'}), 404
+    try:
+        path = thumbnail_cache.get(video_id, variant)
+    except ThumbnailNotFound as e:
+        return jsonify({'error': str(e)}), 404
+    # Keyed by id and size, so the bytes behind a URL never change
+    response = send_file(os.path.abspath(path), mimetype='image/jpeg', max_age=THUMBNAIL_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/api/thumbnails/prefetch', methods=['POST'])
+def prefetch_thumbnails():
+    """Fetches a page of thumbnails in parallel and returns their proxy URLs once cached"""
+    if not thumbnail_cache:
+        return jsonify({'error': 'Thumbnail proxy is disabled'}), 404
+    data = request.json or {}
+    ids = [video_id for video_id in data.get('ids') or [] if isinstance(video_id, str) and VIDEO_ID.fullmatch(video_id)]
+    if not ids:
+        return jsonify({'error': 'ids required'}), 400
+    variant = data.get('variant') or variant_for_width(int(data.get('width') or THUMBNAIL_GRID_WIDTH))
+    if variant not in THUMBNAIL_VARIANTS:
+        return jsonify({'error': f"variant must be one of {', '.join(THUMBNAIL_VARIANTS)}"}), 400
+
+    futures = thumbnail_cache.warm(ids[:THUMBNAIL_PREFETCH_MAX], variant)
+    concurrent.futures.wait(futures.values(), timeout=THUMBNAIL_PREFETCH_TIMEOUT)
+    thumbnails = {}
+    failed = []
+    for video_id, future in futures.items():
+        if future.done() and future.result():
+            thumbnails[video_id] = url_for('thumbnail', video_id=video_id, variant=variant, _external=True)
+        else:
+            failed.append(video_id)
+    return jsonify({'variant': variant, 'thumbnails': thumbnails, 'failed': failed})
+
+@app.route('/api/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        'metadata': metadata_cache.stats(),
+        'downloads': download_cache.stats(),
+        'ydl_pool': ydl_pool.stats(),
+        'optimize': dict(optimize_stats),
+        'pipeline': postprocess_pipeline.stats(),
+        'tasks': task_state.stats(),
+        'journal': job_journal.stats(),
+        'stream_connections': ranged_proxy.budget_stats(),
+        'channel_index': channel_index.stats() if channel_index else None,
+        'thumbnails': thumbnail_cache.stats() if thumbnail_cache else None,
+        'disk_admission': dict(disk_admission.stats(), enabled=DISK_ADMISSION),
+        'concurrency': dict(concurrency_controller.stats(), adaptive=ADAPTIVE_CONCURRENCY, scheduler=download_scheduler.stats())
+    })
+
+@app.route('/api/queue', methods=['GET'])
+def queue_status():
+    task_id = request.args.get('taskId')
+    if task_id:
+        return jsonify({'taskId': task_id, 'queuePosition': download_scheduler.position(task_id)})
+    return jsonify(download_scheduler.stats())
+
+def disk_usage_bytes():
+    total = 0
+    for entry in os.scandir(DOWNLOAD_FOLDER):
+        if entry.is_file(follow_symlinks=False):
+            total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+metrics_registry.counter('ytdown_cache_hits_total', 'Cache hits, coalesced lookups included', ['cache'], fn=lambda: {
+    ('metadata',): metadata_cache.hits + metadata_cache.negative_hits + metadata_cache.coalesced,
+    ('download',): download_cache.hits + download_cache.coalesced,
+    ('thumbnail',): thumbnail_cache.hits + thumbnail_cache.coalesced if thumbnail_cache else 0,
+})
+metrics_registry.counter('ytdown_cache_misses_total', 'Cache misses', ['cache'], fn=lambda: {
+    ('metadata',): metadata_cache.misses,
+    ('download',): download_cache.misses,
+    ('thumbnail',): thumbnail_cache.misses if thumbnail_cache else 0,
+})
+metrics_registry.gauge('ytdown_threads', 'Live threads in this process', fn=lambda: {(): threading.active_count()})
+metrics_registry.gauge('ytdown_download_tasks', 'Download jobs by scheduler state', ['state'], fn=lambda: dict(
+    zip([('active',), ('queued',)], download_scheduler.demand())))
+metrics_registry.gauge('ytdown_download_slots', 'Current download slot limit', fn=lambda: {(): download_scheduler.limit})
+metrics_registry.gauge('ytdown_postprocess_queued', 'Jobs waiting per post-processing stage', ['stage'], fn=lambda: {
+    (stage.name,): stage.queue.qsize() for stage in postprocess_pipeline.stages})
+metrics_registry.gauge('ytdown_disk_used_bytes', 'Bytes in the download folder', fn=lambda: {(): disk_usage_bytes()})
+metrics_registry.gauge('ytdown_disk_free_bytes', 'Free bytes on the download volume', fn=lambda: {(): free_disk_bytes()})
+metrics_registry.gauge('ytdown_disk_reserved_bytes', 'Disk reserved by running downloads and not written yet', fn=lambda: {
+    (): disk_admission.stats()['outstanding']})
+metrics_registry.gauge('ytdown_disk_waiting_tasks', 'Downloads waiting for disk space', fn=lambda: {(): disk_admission.stats()['waiting']})
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.after_request
+def echo_trace_id(response):
+    trace_id = request_trace_id()
+    if trace_id:
+        response.headers[TRACE_HEADER] = trace_id
+    return response
+
+# Task State
+# Task registry, abort flags, sid ownership and event fan-out. The default keeps them in this
+# process; TASK_STATE_URL=sqlite:///... or redis://... shares them between workers and hosts.
+TASK_STATE_URL = os.environ.get('TASK_STATE_URL', '')
+
+def deliver_event(event, payload, sid):
+    socketio.emit(event, payload, to=sid)
+
+task_state = task_state_backend.create_task_state(TASK_STATE_URL).start(deliver_event)
+
+# How long a disconnected client's tasks survive waiting for it to resubscribe
+RECONNECT_GRACE_PERIOD = int(os.environ.get('RECONNECT_GRACE_PERIOD', 30))
+
+# Cancellation
+# Every running download has a cancel token (see cancellation.py). With a shared TASK_STATE_URL an
+# abort can be flagged by another worker; the backend hears of it right away and the watcher fires
+# the tokens, re-reading the flags in one batch each round in case a notification was lost.
+CANCEL_POLL_INTERVAL = float(os.environ.get('CANCEL_POLL_INTERVAL', 1))
+cancel_tokens = cancellation.CancelRegistry()
+
+def reclaim_cancelled(token):
+    """Removes a cancelled task's partial and unmerged files"""
+    # A file the cache already holds is served to other tasks; only this task's own leftovers go
+    freed = token.remove_files(skip=lambda path: download_cache.contains(os.path.basename(path)))
+    if freed:
+        reclaimed_bytes.inc(freed)
+        print(f"Task {token.task_id}: removed {freed} bytes of partial files")
+
+def cancel_watch_loop():
+    while True:
+        time.sleep(CANCEL_POLL_INTERVAL)
+        try:
+            task_state.refresh_aborts()
+            for tid in cancel_tokens.live():
+                if task_state.is_aborted(tid):
+                    cancel_tokens.cancel(tid)
+        except Exception as e:
+            print(f"Cancel watcher error: {e}")
+
+if TASK_STATE_URL:
+    threading.Thread(target=cancel_watch_loop, name="cancel-watcher", daemon=True).start()
+
+def register_task(task_id, sid, trace_id=None):
+    task_state.register_task(task_id, sid)
+    if trace_id:
+        task_traces[task_id] = trace_id
+
+def finish_task(task_id, outcome='finished', filename=None):
+    """Terminal transition for a download task: shared state, the job journal and batch archives"""
+    token = cancel_tokens.lookup(task_id)
+    cancel_tokens.discard(task_id)
+    disk_admission.release(task_id)
+    # Aborted downloads never record an outcome; their progress state goes here
+    concurrency_controller.forget(task_id)
+    if token is not None and token.cancelled_at is not None:
+        stage_seconds.observe(time.monotonic() - token.cancelled_at, stage='cancel')
+    task_state.finish_task(task_id)
+    job_journal.finish(task_id, outcome)
+    task_outcomes.record(task_id, outcome, filename)
+    task_traces.pop(task_id, None)
+    task_outcome_total.inc(outcome=outcome)
+
+def task_sids(task_id):
+    return task_state.task_sids(task_id)
 
-        # Use native threading for gunicorn compatibility
-        thread = threading.Thread(target=download_task, args=(task_id, url, quality_cap), daemon=True)
-        thread.start()
+def emit_to_task(event, payload, task_id):
+    """Send an event only to the clients subscribed to this task"""
+    for sid in task_sids(task_id):
+        task_state.publish(event, payload, sid)
 
-    return jsonify({'taskIds': task_ids, 'status': 'batch_started'})
+def cancel_task(tid):
+    """
+    Aborts a task wherever it is. Queued tasks leave the scheduler; running
+    ones have their cancel token fired, which interrupts network reads, kills
+    ffmpeg and ends waits on shared downloads. Returns False for unknown or
+    finished tasks.
+    """
+    flagged = task_state.abort(tid)
+    if flagged:
+        print(f"Marked task {tid} for abortion")
+    # The token goes first: its callbacks settle tasks parked on disk space or a shared download
+    cancel_tokens.cancel(tid)
+    if download_scheduler.cancel(tid):
+        # Never started, so there is nothing to interrupt or clean up
+        finish_task(tid, 'aborted')
+        return True
+    return flagged
 
-# Track active tasks per socket to cancel them on disconnect
-client_tasks = {} # sid -> [task_ids]
-task_control = {} # task_id -> {'abort': False}
+def abort_orphaned_tasks(task_ids):
+    for tid in task_ids:
+        if not task_state.release_if_orphaned(tid):
+            # Another connection reattached in the meantime
+            continue
+        cancel_task(tid)
+
+@app.route('/api/cancel', methods=['POST'])
+def cancel():
+    """Cancels tasks by id, or every task of a batch"""
+    data = request.json or {}
+    task_ids = list(data.get('taskIds') or [])
+    if data.get('batchId'):
+        task_ids += batches.get(data['batchId']) or []
+    if not task_ids:
+        return jsonify({'error': 'taskIds or batchId required'}), 400
+    # Latest first, so queued tasks are gone before running ones free their slots
+    cancelled = {tid for tid in reversed(task_ids) if cancel_task(tid)}
+    return jsonify({'cancelled': [tid for tid in task_ids if tid in cancelled]})
 
 @socketio.on('connect')
 def handle_connect():
-    client_tasks[request.sid] = []
+    task_state.add_client(request.sid)
 
 @socketio.on('disconnect')
 def handle_disconnect():
     sid = request.sid
     print(f"Client disconnected: {sid}")
-    if sid in client_tasks:
-        for tid in client_tasks[sid]:
-             if tid in task_control:
-                 task_control[tid]['abort'] = True
-                 print(f"Marked task {tid} for abortion")
-        del client_tasks[sid]
+    task_ids = task_state.remove_client(sid)
+    with client_bandwidth_lock:
+        client_bandwidth.pop(sid, None)
+    if task_ids:
+        if RECONNECT_GRACE_PERIOD > 0:
+            timer = threading.Timer(RECONNECT_GRACE_PERIOD, abort_orphaned_tasks, args=(task_ids,))
+            timer.daemon = True
+            timer.start()
+        else:
+            abort_orphaned_tasks(task_ids)
+
+@socketio.on('subscribe')
+def handle_subscribe(data):
+    """Reattach a (re)connected client to tasks it started on an earlier connection"""
+    sid = request.sid
+    attached = [tid for tid in (data or {}).get('taskIds', []) if task_state.subscribe(tid, sid)]
+    return {'taskIds': attached}
+
+@socketio.on('unsubscribe')
+def handle_unsubscribe(data):
+    sid = request.sid
+    for tid in (data or {}).get('taskIds', []):
+        task_state.unsubscribe(tid, sid)
+    return {'taskIds': (data or {}).get('taskIds', [])}
+
+# Parallel range requests per /api/stream client
+STREAM_CONNECTIONS = int(os.environ.get('STREAM_CONNECTIONS', ranged_proxy.CONNECTIONS_PER_STREAM))
+
+STREAM_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Referer': 'https://www.youtube.com/',
+}
+
+def resolve_stream(url, format_id):
+    """(playback_url, title, filename, upstream headers) for a proxied stream"""
+    info = extract_info_cached(url, 'video', {'format': format_id})
+    playback_url = info.get('url')
+    title = sanitize_filename(info.get('title', 'video'))
+    ext = info.get('ext', 'mp4')
+    filename = f"{title}.{ext}"
+
+    if not playback_url:
+         raise Exception("No direct playback URL found")
+    return playback_url, title, filename, STREAM_HEADERS
+
+def async_redirect():
+    """Hands long-lived transfers to the async server when it's published"""
+    if ASYNC_STREAM_URL:
+        # request.path is already decoded; quote it again so a '#' or '?' in a filename stays in the path
+        target = ASYNC_STREAM_URL.rstrip('/') + quote(request.path)
+        if request.query_string:
+            target += '?' + request.query_string.decode('latin-1')
+        return redirect(target, code=307)
+    return None
 
 @app.route('/api/stream', methods=['GET'])
 def stream_video():
@@ -516,43 +2308,29 @@ def stream_video():
     if not url:
         return jsonify({'error': 'URL is required'}), 400
 
+    redirected = async_redirect()
+    if redirected:
+        return redirected
+
     try:
         # High-Speed Proxy Strategy (Thread Compatible)
-        with yt_dlp.YoutubeDL({
-            'quiet': True,
-            'format': format_id,
-            'force_ipv4': True,
-            'extractor_args': {'youtube': {'player_client': ['android', 'web']}}
-        }) as ydl:
-            info = ydl.extract_info(url, download=False)
-            playback_url = info.get('url')
-            title = sanitize_filename(info.get('title', 'video'))
-            ext = info.get('ext', 'mp4')
-            filename = f"{title}.{ext}"
-
-        if not playback_url:
-             raise Exception("No direct playback URL found")
-
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Referer': 'https://www.youtube.com/',
-        }
-        
-        req = requests.get(playback_url, stream=True, headers=headers)
-        total_size = int(req.headers.get('Content-Length', 0))
-        
-        if sid and sid in client_tasks:
-            client_tasks[sid].append(task_id)
-        task_control[task_id] = {'abort': False}
+        playback_url, title, filename, headers = resolve_stream(url, format_id)
 
-        last_emit_time = 0
+        client_range = ranged_proxy.parse_range_header(request.headers.get('Range'))
+        start, end = client_range or (0, None)
+        try:
+            # Parallel ranged fetches over pooled connections instead of one throttled stream
+            upstream = ranged_proxy.RangedStream(playback_url, headers, start, end, connections=STREAM_CONNECTIONS)
+        except ranged_proxy.RangeNotSatisfiable as e:
+            return Response(status=416, headers={'Content-Range': f"bytes */{e.total_size if e.total_size is not None else '*'}"})
+        total_size = upstream.total_size or 0
+        
+        register_task(task_id, sid, request_trace_id())
 
         def generate_proxy():
-            nonlocal last_emit_time
-            downloaded = 0
+            downloaded = upstream.start
             try:
-                socketio.emit('progress', {
-                    'taskId': task_id,
+                progress_emitter.publish(task_id, {
                     'status': 'downloading',
                     'progress': 0,
                     'title': title,
@@ -560,86 +2338,300 @@ def stream_video():
                     'total_bytes': total_size
                 })
                 
-                chunk_size = 4 * 1024 * 1024 
-                
-                for chunk in req.iter_content(chunk_size=chunk_size):
-                    if task_control.get(task_id, {}).get('abort'):
+                for chunk in upstream:
+                    if task_state.is_aborted(task_id):
                         break
                         
                     if chunk:
                         downloaded += len(chunk)
                         yield chunk
-                        
-                        current_time = time.time()
-                        if current_time - last_emit_time > 0.5:
-                            if total_size > 0:
-                                percent = (downloaded / total_size) * 100
-                                socketio.emit('progress', {
-                                    'taskId': task_id,
-                                    'progress': percent,
-                                    'status': 'downloading',
-                                    'downloaded_bytes': downloaded,
-                                    'total_bytes': total_size,
-                                    'title': title
-                                })
-                                last_emit_time = current_time
-                            # time.sleep not needed, blocking IO is fine in generator thread
+
+                        # Coalesced by the emitter, so no per-chunk throttling here
+                        if total_size > 0:
+                            progress_emitter.publish(task_id, {
+                                'progress': (downloaded / total_size) * 100,
+                                'status': 'downloading',
+                                'downloaded_bytes': downloaded,
+                                'total_bytes': total_size,
+                                'title': title
+                            })
             finally:
-                req.close()
-                socketio.emit('progress', {'taskId': task_id, 'progress': 100, 'status': 'finished'})
+                upstream.close()
+                progress_emitter.publish(task_id, {'progress': 100, 'status': 'finished'})
+                task_state.finish_task(task_id)
+                task_traces.pop(task_id, None)
 
-        return Response(generate_proxy(), headers={
+        response_headers = {
             'Content-Disposition': f'attachment; filename="{filename}"',
-            'Content-Type': req.headers.get('Content-Type', 'application/octet-stream'),
-            'Content-Length': total_size
-        })
+            'Content-Type': upstream.content_type or 'application/octet-stream',
+        }
+        if upstream.ranged:
+            response_headers['Accept-Ranges'] = 'bytes'
+        if upstream.length is not None:
+            response_headers['Content-Length'] = upstream.length
+
+        if client_range and upstream.ranged and upstream.end is not None:
+            response_headers['Content-Range'] = f"bytes {upstream.start}-{upstream.end}/{total_size or '*'}"
+            return Response(metered('stream', generate_proxy()), status=206, headers=response_headers)
+        return Response(metered('stream', generate_proxy()), headers=response_headers)
 
     except Exception as e:
         print(f"Proxy Error: {e}")
+        errors_total.inc(stage='stream')
+        return jsonify({'error': f"Streaming failed: {str(e)}"}), 500
+
+# Piped Streaming
+# Opt-in alternative to /api/download + /api/file: merged formats are muxed by ffmpeg straight
+# into the response as fragmented MP4, with no disk passes and no separate fetch afterwards
+PIPE_FORMAT = os.environ.get('PIPE_FORMAT', 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best')
+
+def resolve_pipe(url, format_id):
+    """(ffmpeg command, title, filename, estimated size) for a piped stream"""
+    info = extract_info_cached(url, 'video', {'format': format_id or PIPE_FORMAT})
+    title = sanitize_filename(info.get('title', 'video'))
+    return pipe_stream.build_command(info), title, f"{title}.mp4", pipe_stream.estimated_size(info)
+
+@app.route('/api/pipe', methods=['GET'])
+def pipe_video():
+    url = request.args.get('url')
+    format_id = request.args.get('format_id')
+    task_id = request.args.get('taskId', str(uuid.uuid4()))
+    sid = request.args.get('sid')
+
+    if not url:
+        return jsonify({'error': 'URL is required'}), 400
+
+    redirected = async_redirect()
+    if redirected:
+        return redirected
+
+    try:
+        cmd, title, filename, total_size = resolve_pipe(url, format_id)
+        pipe = pipe_stream.FfmpegPipe(cmd)
+    except Exception as e:
+        print(f"Pipe Error: {e}")
         return jsonify({'error': f"Streaming failed: {str(e)}"}), 500
 
+    register_task(task_id, sid, request_trace_id())
+
+    def generate_pipe():
+        sent = 0
+        status = 'finished'
+        try:
+            progress_emitter.publish(task_id, {
+                'status': 'downloading',
+                'progress': 0,
+                'title': title,
+                'filename': filename,
+                'total_bytes': total_size or 0
+            })
+            for chunk in pipe:
+                if task_state.is_aborted(task_id):
+                    status = 'aborted'
+                    emit_to_task('error', {'taskId': task_id, 'error': "Download Aborted by User"}, task_id)
+                    break
+                sent += len(chunk)
+                yield chunk
+                progress_emitter.publish(task_id, {
+                    # Sizes are yt-dlp's estimates, so never claim 100% before ffmpeg is done
+                    'progress': min(sent / total_size * 100, 99) if total_size else 0,
+                    'status': 'downloading',
+                    'downloaded_bytes': sent,
+                    'total_bytes': total_size or 0,
+                    'title': title
+                })
+        except Exception as e:
+            print(f"Pipe Error: {e}")
+            errors_total.inc(stage='pipe')
+            status = 'error'
+            emit_to_task('error', {'taskId': task_id, 'error': str(e)}, task_id)
+        finally:
+            pipe.close()
+            progress_emitter.publish(task_id, {'progress': 100, 'status': 'finished'} if status == 'finished' else {'status': status})
+            task_state.finish_task(task_id)
+            task_traces.pop(task_id, None)
+
+    # No Content-Length or ranges: the file is being muxed as it's sent
+    response = Response(metered('pipe', generate_pipe()), headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'Content-Type': 'video/mp4',
+        'X-Accel-Buffering': 'no',
+    })
+    # Also covers a client that goes away before the body is started
+    response.call_on_close(pipe.close)
+    return response
+
+# Finished files stay available for resumed/ranged requests until they've been idle this long
+FILE_RETENTION_SECONDS = int(os.environ.get('FILE_RETENTION_SECONDS', 3600))
+JANITOR_LOCK_PATH = DOWNLOAD_FOLDER + '.janitor.lock'
+
+def touch_file(filename):
+    """Records a use as the file's atime, which every worker's janitor sees; mtime stays put for ETags"""
+    path = os.path.join(DOWNLOAD_FOLDER, filename)
+    try:
+        os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+    except OSError:
+        pass
+
+def on_body_closed(response, callback):
+    """
+    Runs callback once when the response body is closed. send_file bodies are handed to the
+    server as-is (direct passthrough, so it can sendfile them), which bypasses call_on_close,
+    so for those the hook goes on the file wrapper itself.
+    """
+    if not response.direct_passthrough:
+        response.call_on_close(callback)
+        return
+    body = response.response
+    close_body = getattr(body, 'close', None)
+    closed = []
+
+    def close():
+        if closed:
+            return
+        closed.append(True)
+        try:
+            if close_body:
+                close_body()
+        finally:
+            callback()
+
+    body.close = close
+
 @app.route('/api/file/<path:filename>')
 def serve_file(filename):
+    redirected = async_redirect()
+    if redirected:
+        return redirected
+
     try:
         from urllib.parse import unquote
         decoded_filename = unquote(filename)
         file_path = os.path.join(DOWNLOAD_FOLDER, decoded_filename)
         
-        if not os.path.exists(file_path):
+        if not os.path.isfile(file_path):
             return jsonify({'error': f'File not found: {decoded_filename}'}), 404
-        
-        def generate():
-            with open(file_path, 'rb') as f:
-                while True:
-                    chunk = f.read(4096 * 64)
-                    if not chunk: break
-                    yield chunk
-            try:
-                os.remove(file_path)
-            except: pass
 
-        return Response(generate(), headers={
-            'Content-Disposition': f'attachment; filename="{decoded_filename}"',
-            'Content-Type': 'application/octet-stream'
-        })
+        # Pin cached files so eviction can't remove them mid-transfer
+        pinned = download_cache.acquire(decoded_filename)
+        try:
+            # send_from_directory handles Range/206, ETag/If-None-Match, Last-Modified
+            # and Content-Length, and hands the file to wsgi.file_wrapper (sendfile under gunicorn)
+            response = send_from_directory(
+                os.path.abspath(DOWNLOAD_FOLDER),
+                decoded_filename,
+                as_attachment=True,
+                download_name=decoded_filename,
+                mimetype='application/octet-stream',
+                conditional=True,
+                etag=True,
+                max_age=0
+            )
+        except Exception:
+            if pinned:
+                download_cache.release(decoded_filename)
+            raise
+
+        # Only once send_from_directory has accepted the path as inside the folder
+        touch_file(decoded_filename)
+        start = time.monotonic()
 
+        def on_close():
+            if pinned:
+                download_cache.release(decoded_filename)
+            # The file body is handed to the server (sendfile), so count what was promised
+            served_bytes.inc(response.content_length or 0, endpoint='file')
+            stage_seconds.observe(time.monotonic() - start, stage='serve')
+
+        on_body_closed(response, on_close)
+        return response
+
+    except HTTPException:
+        # send_from_directory's NotFound for paths outside the folder
+        raise
     except Exception as e:
         print(f"File serve error: {e}")
+        errors_total.inc(stage='serve')
         return jsonify({'error': str(e)}), 500
 
-if __name__ == '__main__':
-    def cleanup_loop():
-        while True:
-            time.sleep(300)
+def cleanup_loop():
+    # One janitor per host: whichever worker holds the lock sweeps, the others take over if it exits
+    lock = open(JANITOR_LOCK_PATH, 'a')
+    leading = False
+    while True:
+        if not leading:
             try:
-                now = time.time()
-                for f in os.listdir(DOWNLOAD_FOLDER):
-                    fp = os.path.join(DOWNLOAD_FOLDER, f)
-                    if os.path.isfile(fp):
-                        if now - os.path.getmtime(fp) > 3600:
-                            os.remove(fp)
-            except: pass
-    
-    # Use native threading for cleanup
-    threading.Thread(target=cleanup_loop, daemon=True).start()
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                leading = True
+                remove_stale_download_folders()
+            except BlockingIOError:
+                pass
+        time.sleep(300)
+        if not leading:
+            continue
+        try:
+            now = time.time()
+            pending_partials = job_journal.pending_partials()
+            # Other workers' cache entries are only known through the shared index
+            cached = download_index.filenames() if download_index else set()
+            for f in os.listdir(DOWNLOAD_FOLDER):
+                fp = os.path.join(DOWNLOAD_FOLDER, f)
+                # Cached downloads are bounded by the cache's own LRU budget; queued jobs still need their partials
+                if (os.path.isfile(fp) and f not in cached and not download_cache.contains(f)
+                        and not is_resumable_partial(f, pending_partials)):
+                    stat = os.stat(fp)
+                    if now - max(stat.st_mtime, stat.st_atime) > FILE_RETENTION_SECONDS:
+                        os.remove(fp)
+        except: pass
+
+# Started at import so the janitor also runs under gunicorn, now that serving no longer deletes files
+threading.Thread(target=cleanup_loop, name="download-janitor", daemon=True).start()
+
+def resume_recovered_jobs():
+    """Re-queues downloads a previous run didn't finish; clients reattach by subscribing to the task ids"""
+    for job in recovered_jobs:
+        tid = job['taskId']
+        # The journalled owner keeps the job in its client's fair-share lane
+        owner = job.get('owner')
+        register_task(tid, owner)
+        download_scheduler.submit(tid, owner, download_task, (tid, job['url'], job.get('format', 'best')), priority=job.get('priority', PRIORITY_SINGLE))
+        print(f"Resuming interrupted download {tid} ({len(job['partials'])} partial files)")
+
+resume_recovered_jobs()
+
+# Async Transfer Server
+# With ASYNC_STREAM_PORT set, /api/stream, /api/file and /api/pipe are served from an asyncio loop
+# on that port. ASYNC_STREAM_BACKEND makes it the front door: everything else is passed through to
+# gunicorn at that address, which is how the Dockerfile runs it on the one public port. Otherwise
+# ASYNC_STREAM_URL is its public address and the Flask routes redirect there. Streams fetch
+# upstream ranges in parallel like the Flask route; each one buffers up to ASYNC_STREAM_CONNECTIONS
+# parts (ASYNC_STREAM_PART_SIZE each), so set it to 1 when serving many slow clients matters more.
+ASYNC_STREAM_HOST = os.environ.get('ASYNC_STREAM_HOST', '0.0.0.0')
+ASYNC_STREAM_PORT = int(os.environ.get('ASYNC_STREAM_PORT', 0))
+ASYNC_STREAM_URL = os.environ.get('ASYNC_STREAM_URL', '')
+ASYNC_STREAM_BACKEND = os.environ.get('ASYNC_STREAM_BACKEND', '')
+ASYNC_STREAM_CONNECTIONS = int(os.environ.get('ASYNC_STREAM_CONNECTIONS', STREAM_CONNECTIONS))
+async_stream_server = None
+
+if ASYNC_STREAM_PORT:
+    import async_stream
+    async_stream_server = async_stream.AsyncStreamServer(
+        ASYNC_STREAM_HOST,
+        ASYNC_STREAM_PORT,
+        DOWNLOAD_FOLDER,
+        resolve=resolve_stream,
+        resolve_pipe=resolve_pipe,
+        register_task=register_task,
+        publish=progress_emitter.publish,
+        is_aborted=task_state.is_aborted,
+        finish_task=task_state.finish_task,
+        acquire_file=download_cache.acquire,
+        release_file=download_cache.release,
+        touch_file=touch_file,
+        emit_error=lambda task_id, error: emit_to_task('error', {'taskId': task_id, 'error': error}, task_id),
+        stream_connections=ASYNC_STREAM_CONNECTIONS,
+        backend_url=ASYNC_STREAM_BACKEND or None
+    ).start()
+
+if __name__ == '__main__':
     socketio.run(app, debug=True, port=5000)
@@ -0,0 +1,136 @@
+"""
+ZIP and TAR writers that produce an archive as a stream of bytes.
+
+Entries come from an iterable of (arcname, path) that may block between
+items, so a batch can be archived while its downloads are still finishing.
+Nothing is assembled in memory or on disk beyond one read chunk.
+
+ZIP entries are stored (no compression: the media is already compressed)
+with a data descriptor carrying the CRC, so each file is read only once.
+Zip64 records are used per entry and for the end of central directory as
+soon as a size, offset or entry count outgrows the classic 32/16-bit fields.
+TAR uses the POSIX pax format, which has no size or name length limits.
+"""
+import os
+import struct
+import tarfile
+import time
+import zlib
+
+CHUNK_SIZE = 256 * 1024
+ZIP32_LIMIT = 0xFFFFFFFF
+ZIP16_LIMIT = 0xFFFF
+
+def _dos_time(timestamp):
+    t = time.localtime(timestamp)
+    year = max(t.tm_year, 1980)
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+def _read_chunks(path):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+def unique_names(entries):
+    """Suffixes repeated arcnames (title.mp4, title_1.mp4, ...) so no entry shadows another"""
+    seen = set()
+    for arcname, path in entries:
+        name, ext = os.path.splitext(arcname)
+        candidate, counter = arcname, 1
+        while candidate in seen:
+            candidate = f"{name}_{counter}{ext}"
+            counter += 1
+        seen.add(candidate)
+        yield candidate, path
+
+def zip_stream(entries):
+    offset = 0
+    central = []
+    for arcname, path in unique_names(entries):
+        name = arcname.encode('utf-8')
+        mod_time, mod_date = _dos_time(os.path.getmtime(path))
+        size_hint = os.path.getsize(path)
+        # Zip64 is decided up front from the file's size, since the local header is written first
+        zip64 = size_hint >= ZIP32_LIMIT or offset >= ZIP32_LIMIT
+        version = 45 if zip64 else 20
+        # Bit 3: CRC and sizes follow the data; bit 11: UTF-8 names
+        flags = 0x0808
+
+        extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0) if zip64 else b''
+        local = struct.pack('<IHHHHHIIIHH', 0x04034b50, version, flags, 0, mod_time, mod_date,
+                            0, ZIP32_LIMIT if zip64 else 0, ZIP32_LIMIT if zip64 else 0, len(name), len(extra))
+        header_offset = offset
+        yield local + name + extra
+        offset += len(local) + len(name) + len(extra)
+
+        crc = 0
+        size = 0
+        for chunk in _read_chunks(path):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            yield chunk
+        offset += size
+
+        if zip64:
+            descriptor = struct.pack('<IIQQ', 0x08074b50, crc, size, size)
+        else:
+            descriptor = struct.pack('<IIII', 0x08074b50, crc, size, size)
+        yield descriptor
+        offset += len(descriptor)
+        central.append((name, version, flags, mod_time, mod_date, crc, size, header_offset))
+
+    cd_offset = offset
+    cd_size = 0
+    for name, version, flags, mod_time, mod_date, crc, size, header_offset in central:
+        # Zip64 extra carries, in this order, only the fields that overflowed
+        fields = []
+        if size >= ZIP32_LIMIT:
+            fields += [size, size]
+        if header_offset >= ZIP32_LIMIT:
+            fields.append(header_offset)
+        extra = struct.pack(f'<HH{len(fields)}Q', 0x0001, 8 * len(fields), *fields) if fields else b''
+        version = 45 if fields else version
+        record = struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | version, version, flags, 0,
+                             mod_time, mod_date, crc,
+                             ZIP32_LIMIT if size >= ZIP32_LIMIT else size,
+                             ZIP32_LIMIT if size >= ZIP32_LIMIT else size,
+                             len(name), len(extra), 0, 0, 0, 0o100644 << 16,
+                             ZIP32_LIMIT if header_offset >= ZIP32_LIMIT else header_offset)
+        yield record + name + extra
+        cd_size += len(record) + len(name) + len(extra)
+
+    count = len(central)
+    end = b''
+    if count >= ZIP16_LIMIT or cd_offset >= ZIP32_LIMIT or cd_size >= ZIP32_LIMIT:
+        zip64_end_offset = cd_offset + cd_size
+        end += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, (3 << 8) | 45, 45, 0, 0, count, count, cd_size, cd_offset)
+        end += struct.pack('<IIQI', 0x07064b50, 0, zip64_end_offset, 1)
+    end += struct.pack('<IHHHHIIH', 0x06054b50, 0, 0,
+                       min(count, ZIP16_LIMIT), min(count, ZIP16_LIMIT),
+                       min(cd_size, ZIP32_LIMIT), min(cd_offset, ZIP32_LIMIT), 0)
+    yield end
+
+def tar_stream(entries):
+    for arcname, path in unique_names(entries):
+        info = tarfile.TarInfo(arcname)
+        info.size = os.path.getsize(path)
+        info.mtime = int(os.path.getmtime(path))
+        info.mode = 0o644
+        yield info.tobuf(format=tarfile.PAX_FORMAT, encoding='utf-8')
+        written = 0
+        for chunk in _read_chunks(path):
+            # Never more than the header promised, should the file grow meanwhile
+            chunk = chunk[:info.size - written]
+            written += len(chunk)
+            yield chunk
+            if written >= info.size:
+                break
+        if written < info.size:
+            raise Exception(f"{arcname} shrank while being archived")
+        remainder = info.size % tarfile.BLOCKSIZE
+        if remainder:
+            yield b'\0' * (tarfile.BLOCKSIZE - remainder)
+    yield b'\0' * (tarfile.BLOCKSIZE * 2)
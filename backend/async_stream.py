@@ -0,0 +1,476 @@
+"""
+asyncio server for the long-lived transfer endpoints, /api/stream and /api/file.
+
+Each gthread worker thread is pinned for the whole of a transfer, so slow
+clients exhaust the pool. Here every transfer is a coroutine on one event
+loop: upstream reads pause when the client isn't keeping up (aiohttp's
+bounded read buffer plus awaiting each write), so per-stream memory stays at
+a few small chunks. It runs on its own port in a background thread of the
+Flask process and shares its task registry and progress emitter through the
+hooks it is given.
+
+/api/stream fetches upstream in parallel byte ranges like the Flask route
+(see ranged_proxy), as coroutines: with stream_connections parts of
+ASYNC_STREAM_PART_SIZE each in flight, a stream buffers at most their sum.
+stream_connections=1 relays a single upstream response chunk by chunk,
+which keeps memory per slow client smallest.
+
+With a backend_url it's the front door on the public port: every other
+request, Socket.IO's websocket included, is passed through to the WSGI
+server listening there, so transfers stay off gthreads without a second
+public address.
+"""
+import asyncio
+import collections
+import os
+import re
+import threading
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, WSMsgType, web
+
+import ranged_proxy
+
+CHUNK_SIZE = int(os.environ.get('ASYNC_STREAM_CHUNK_SIZE', 16 * 1024))
+PART_SIZE = int(os.environ.get('ASYNC_STREAM_PART_SIZE', 256 * 1024))
+# Per-connection headers that a proxy doesn't pass along
+HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailer',
+               'transfer-encoding', 'upgrade'}
+
+class FileTransfer(web.FileResponse):
+    """FileResponse that runs a release callback once the body has been sent"""
+    def __init__(self, path, release=None, **kwargs):
+        super().__init__(path, **kwargs)
+        self._release = release
+
+    async def prepare(self, request):
+        try:
+            return await super().prepare(request)
+        except RuntimeError as e:
+            # sendfile onto a transport the client already closed
+            raise ConnectionResetError(str(e)) from e
+        finally:
+            if self._release:
+                self._release()
+                self._release = None
+
+class AsyncStreamServer:
+    def __init__(self, host, port, folder, resolve, register_task, publish, is_aborted,
+                 finish_task=None, resolve_pipe=None, acquire_file=None, release_file=None, touch_file=None, emit_error=None,
+                 upstream_limit=0, stream_connections=1, part_size=PART_SIZE, backend_url=None):
+        self.host = host
+        self.port = port
+        self.folder = os.path.abspath(folder)
+        self.resolve = resolve
+        self.register_task = register_task
+        self.publish = publish
+        self.is_aborted = is_aborted
+        self.finish_task = finish_task or (lambda task_id: None)
+        self.resolve_pipe = resolve_pipe
+        self.acquire_file = acquire_file or (lambda name: False)
+        self.release_file = release_file or (lambda name: None)
+        self.touch_file = touch_file or (lambda name: None)
+        # emit_error(task_id, message) sends the task's clients the same 'error' event as the Flask routes
+        self.emit_error = emit_error or (lambda task_id, error: None)
+        self.upstream_limit = upstream_limit
+        self.stream_connections = max(1, stream_connections)
+        self.part_size = part_size
+        self.backend_url = backend_url.rstrip('/') if backend_url else None
+        self.active_streams = 0
+        self.loop = None
+        self.session = None
+        self.backend_session = None
+        self._started = threading.Event()
+        self._error = None
+
+    def start(self):
+        """Runs the event loop in a daemon thread and returns once the port is bound; raises if it can't be"""
+        thread = threading.Thread(target=self._run, name="async-stream", daemon=True)
+        thread.start()
+        self._started.wait()
+        if self._error is not None:
+            raise self._error
+        return self
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._serve())
+        except BaseException as e:
+            # e.g. the port is taken; start() re-raises it instead of waiting forever
+            self._error = e
+            for session in (self.session, self.backend_session):
+                if session is not None:
+                    self.loop.run_until_complete(session.close())
+            self.loop.close()
+            return
+        finally:
+            self._started.set()
+        self.loop.run_forever()
+
+    async def _serve(self):
+        self.session = ClientSession(
+            connector=TCPConnector(limit=self.upstream_limit),
+            # Upstream reading pauses once this much is buffered and unread
+            read_bufsize=CHUNK_SIZE,
+            timeout=ClientTimeout(total=None, sock_connect=30, sock_read=60)
+        )
+        app = web.Application()
+        app.router.add_get('/api/stream', self.handle_stream)
+        app.router.add_get('/api/file/{filename:.+}', self.handle_file)
+        if self.resolve_pipe:
+            app.router.add_get('/api/pipe', self.handle_pipe)
+        if self.backend_url:
+            # Bodies pass through as they are, compressed or not, and long polls may take their time
+            self.backend_session = ClientSession(
+                connector=TCPConnector(limit=0),
+                auto_decompress=False,
+                timeout=ClientTimeout(total=None, sock_connect=30, sock_read=None)
+            )
+            # Registered last, so it only gets what the routes above don't match
+            app.router.add_route('*', '/{tail:.*}', self.handle_backend)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        # reuse_port lets every gunicorn worker bind the same port
+        site = web.TCPSite(runner, self.host, self.port, reuse_port=True)
+        await site.start()
+        print(f"Async stream server listening on {self.host}:{self.port}")
+
+    async def handle_stream(self, request):
+        url = request.query.get('url')
+        format_id = request.query.get('format_id', 'best')
+        task_id = request.query.get('taskId') or os.urandom(16).hex()
+        sid = request.query.get('sid')
+
+        if not url:
+            return web.json_response({'error': 'URL is required'}, status=400)
+
+        loop = asyncio.get_running_loop()
+        try:
+            # yt-dlp is blocking; resolution goes through the shared metadata cache on a worker thread
+            playback_url, title, filename, headers = await loop.run_in_executor(None, self.resolve, url, format_id)
+        except Exception as e:
+            print(f"Proxy Error: {e}")
+            return web.json_response({'error': f"Streaming failed: {str(e)}"}, status=500)
+
+        if self.stream_connections > 1:
+            return await self._stream_ranged(request, task_id, sid, playback_url, title, filename, headers)
+
+        upstream_headers = dict(headers)
+        if request.headers.get('Range'):
+            upstream_headers['Range'] = request.headers['Range']
+        async with self.session.get(playback_url, headers=upstream_headers) as upstream:
+            return await self._relay(request, task_id, sid, title, filename, upstream)
+
+    def _begin_stream(self, task_id, sid, title, filename, total_size):
+        self.register_task(task_id, sid)
+        self.publish(task_id, {
+            'status': 'downloading',
+            'progress': 0,
+            'title': title,
+            'filename': filename,
+            'total_bytes': total_size
+        })
+        self.active_streams += 1
+
+    def _stream_progress(self, task_id, title, downloaded, total_size):
+        if total_size > 0:
+            self.publish(task_id, {
+                'progress': (downloaded / total_size) * 100,
+                'status': 'downloading',
+                'downloaded_bytes': downloaded,
+                'total_bytes': total_size,
+                'title': title
+            })
+
+    def _end_stream(self, task_id):
+        self.active_streams -= 1
+        self.publish(task_id, {'progress': 100, 'status': 'finished'})
+        self.finish_task(task_id)
+
+    async def _prepare(self, request, response):
+        await response.prepare(request)
+        if request.transport is not None:
+            # Writes wait for the client once this much is queued in userspace
+            request.transport.set_write_buffer_limits(high=CHUNK_SIZE)
+
+    async def _relay(self, request, task_id, sid, title, filename, upstream):
+        """Passes one upstream response through, chunk by chunk"""
+        if upstream.status == 416:
+            return web.Response(status=416, headers={'Content-Range': upstream.headers.get('Content-Range', 'bytes */*')})
+        if upstream.status >= 400:
+            return web.json_response({'error': f"Streaming failed: upstream returned {upstream.status}"}, status=502)
+
+        offset = 0
+        total_size = upstream.content_length or 0
+        content_range = upstream.headers.get('Content-Range')
+        if upstream.status == 206 and content_range:
+            match = re.match(r'bytes (\d+)-\d+/(\d+)', content_range)
+            if match:
+                offset, total_size = int(match.group(1)), int(match.group(2))
+
+        response = web.StreamResponse(status=upstream.status, headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'Content-Type': upstream.headers.get('Content-Type', 'application/octet-stream'),
+            'Accept-Ranges': 'bytes',
+        })
+        if content_range:
+            response.headers['Content-Range'] = content_range
+        if upstream.content_length is not None:
+            response.content_length = upstream.content_length
+        await self._prepare(request, response)
+
+        self._begin_stream(task_id, sid, title, filename, total_size)
+        downloaded = offset
+        try:
+            async for chunk in upstream.content.iter_chunked(CHUNK_SIZE):
+                if self.is_aborted(task_id):
+                    break
+                # Awaiting the write is the backpressure: no more upstream reads until the client drains
+                await response.write(chunk)
+                downloaded += len(chunk)
+                self._stream_progress(task_id, title, downloaded, total_size)
+        except ConnectionError:
+            # Client went away
+            pass
+        finally:
+            self._end_stream(task_id)
+        return response
+
+    async def _fetch_part(self, url, headers, part_start, part_end):
+        headers = dict(headers, Range=f'bytes={part_start}-{part_end}')
+        for attempt in range(ranged_proxy.PART_RETRIES + 1):
+            try:
+                async with self.session.get(url, headers=headers) as resp:
+                    if resp.status != 206:
+                        raise Exception(f"Range request returned {resp.status}")
+                    data = await resp.read()
+                if len(data) != part_end - part_start + 1:
+                    raise Exception("Short range response")
+                return data
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                if attempt == ranged_proxy.PART_RETRIES:
+                    raise
+
+    async def _stream_ranged(self, request, task_id, sid, playback_url, title, filename, headers):
+        """Parallel byte ranges, yielded in order, as ranged_proxy.RangedStream does for the Flask route"""
+        client_range = ranged_proxy.parse_range_header(request.headers.get('Range'))
+        start, end = client_range or (0, None)
+        first_end = start + self.part_size - 1 if end is None else min(end, start + self.part_size - 1)
+
+        # The first part tells us the total size and whether the origin honours ranges at all
+        first = await self.session.get(playback_url, headers=dict(headers, Range=f'bytes={start}-{first_end}'))
+        try:
+            match = re.search(r'/(\d+)$', first.headers.get('Content-Range', ''))
+            total_size = int(match.group(1)) if match else None
+            if first.status == 416:
+                return web.Response(status=416, headers={'Content-Range': f"bytes */{total_size if total_size is not None else '*'}"})
+            if first.status != 206 or total_size is None:
+                # Origin ignores Range: send its response through as one stream
+                return await self._relay(request, task_id, sid, title, filename, first)
+            first_data = await first.read()
+        finally:
+            first.release()
+
+        if start >= total_size:
+            return web.Response(status=416, headers={'Content-Range': f'bytes */{total_size}'})
+        if end is None or end >= total_size:
+            end = total_size - 1
+
+        response = web.StreamResponse(status=206 if client_range else 200, headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'Content-Type': first.headers.get('Content-Type', 'application/octet-stream'),
+            'Accept-Ranges': 'bytes',
+        })
+        if client_range:
+            response.headers['Content-Range'] = f'bytes {start}-{end}/{total_size}'
+        response.content_length = end - start + 1
+        await self._prepare(request, response)
+
+        self._begin_stream(task_id, sid, title, filename, total_size)
+        window = collections.deque()  # part fetches, in the order their bytes are written
+        next_start = start + len(first_data)
+        downloaded = next_start
+        try:
+            await response.write(first_data)
+            self._stream_progress(task_id, title, downloaded, total_size)
+            while True:
+                while next_start <= end and len(window) < self.stream_connections:
+                    part_end = min(next_start + self.part_size - 1, end)
+                    window.append(asyncio.ensure_future(self._fetch_part(playback_url, headers, next_start, part_end)))
+                    next_start = part_end + 1
+                if not window or self.is_aborted(task_id):
+                    break
+                data = await window.popleft()
+                await response.write(data)
+                downloaded += len(data)
+                self._stream_progress(task_id, title, downloaded, total_size)
+        except ConnectionError:
+            # Client went away
+            pass
+        except Exception as e:
+            # Headers are out, so all that's left is to cut the body short
+            print(f"Proxy Error: {e}")
+        finally:
+            for part in window:
+                part.cancel()
+            self._end_stream(task_id)
+        return response
+
+    async def handle_pipe(self, request):
+        """ffmpeg muxes straight into the response; see pipe_stream"""
+        url = request.query.get('url')
+        format_id = request.query.get('format_id')
+        task_id = request.query.get('taskId') or os.urandom(16).hex()
+        sid = request.query.get('sid')
+
+        if not url:
+            return web.json_response({'error': 'URL is required'}, status=400)
+
+        loop = asyncio.get_running_loop()
+        try:
+            cmd, title, filename, total_size = await loop.run_in_executor(None, self.resolve_pipe, url, format_id)
+            process = await asyncio.create_subprocess_exec(
+                *cmd, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+            )
+        except Exception as e:
+            print(f"Pipe Error: {e}")
+            return web.json_response({'error': f"Streaming failed: {str(e)}"}, status=500)
+
+        response = web.StreamResponse(headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'Content-Type': 'video/mp4',
+        })
+        self.register_task(task_id, sid)
+        self.publish(task_id, {
+            'status': 'downloading',
+            'progress': 0,
+            'title': title,
+            'filename': filename,
+            'total_bytes': total_size or 0
+        })
+
+        self.active_streams += 1
+        sent = 0
+        status = 'finished'
+        try:
+            await response.prepare(request)
+            while True:
+                chunk = await process.stdout.read(CHUNK_SIZE)
+                if not chunk:
+                    if await process.wait() != 0:
+                        status = 'error'
+                        self.emit_error(task_id, f"ffmpeg exited with {process.returncode}")
+                    break
+                if self.is_aborted(task_id):
+                    status = 'aborted'
+                    self.emit_error(task_id, "Download Aborted by User")
+                    break
+                await response.write(chunk)
+                sent += len(chunk)
+                self.publish(task_id, {
+                    'progress': min(sent / total_size * 100, 99) if total_size else 0,
+                    'status': 'downloading',
+                    'downloaded_bytes': sent,
+                    'total_bytes': total_size or 0,
+                    'title': title
+                })
+        except ConnectionError:
+            pass
+        finally:
+            self.active_streams -= 1
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            self.publish(task_id, {'progress': 100, 'status': 'finished'} if status == 'finished' else {'status': status})
+            self.finish_task(task_id)
+        return response
+
+    def _backend_headers(self, request):
+        headers = {name: value for name, value in request.headers.items() if name.lower() not in HOP_HEADERS}
+        forwarded_for = request.headers.get('X-Forwarded-For')
+        headers['X-Forwarded-For'] = f"{forwarded_for}, {request.remote}" if forwarded_for else (request.remote or '')
+        # Set by the proxy in front of us, if any; ProxyFix in the app trusts one hop
+        headers.setdefault('X-Forwarded-Proto', request.scheme)
+        headers.setdefault('X-Forwarded-Host', request.host)
+        return headers
+
+    async def handle_backend(self, request):
+        """Passes a request through to the WSGI server"""
+        url = self.backend_url + request.raw_path
+        headers = self._backend_headers(request)
+        if request.headers.get('Upgrade', '').lower() == 'websocket':
+            return await self._proxy_websocket(request, url, headers)
+
+        body = await request.read() if request.body_exists else None
+        try:
+            upstream = await self.backend_session.request(request.method, url, headers=headers, data=body,
+                                                          allow_redirects=False)
+        except Exception as e:
+            print(f"Backend proxy error: {e}")
+            return web.json_response({'error': 'Backend unavailable'}, status=502)
+        try:
+            response = web.StreamResponse(status=upstream.status, reason=upstream.reason)
+            for name, value in upstream.headers.items():
+                if name.lower() not in HOP_HEADERS:
+                    response.headers.add(name, value)
+            await response.prepare(request)
+            async for chunk in upstream.content.iter_any():
+                await response.write(chunk)
+            await response.write_eof()
+        except ConnectionError:
+            # Client went away
+            pass
+        finally:
+            upstream.release()
+        return response
+
+    async def _proxy_websocket(self, request, url, headers):
+        headers = {name: value for name, value in headers.items() if not name.lower().startswith('sec-websocket-')}
+        try:
+            upstream = await self.backend_session.ws_connect(url, headers=headers)
+        except Exception as e:
+            print(f"Backend proxy error: {e}")
+            return web.json_response({'error': 'Backend unavailable'}, status=502)
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+
+        async def pump(source, sink):
+            try:
+                async for message in source:
+                    if message.type == WSMsgType.TEXT:
+                        await sink.send_str(message.data)
+                    elif message.type == WSMsgType.BINARY:
+                        await sink.send_bytes(message.data)
+                    else:
+                        break
+            except (ConnectionError, RuntimeError):
+                # The other side closed first
+                pass
+
+        pumps = [asyncio.ensure_future(pump(ws, upstream)), asyncio.ensure_future(pump(upstream, ws))]
+        try:
+            await asyncio.wait(pumps, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pumps:
+                task.cancel()
+            await upstream.close()
+            await ws.close()
+        return ws
+
+    async def handle_file(self, request):
+        filename = request.match_info['filename']
+        file_path = os.path.abspath(os.path.join(self.folder, filename))
+        if os.path.dirname(file_path) != self.folder or not os.path.isfile(file_path):
+            return web.json_response({'error': f'File not found: {filename}'}, status=404)
+
+        self.touch_file(filename)
+        # Pinned so cache eviction can't remove the file mid-transfer
+        release = (lambda: self.release_file(filename)) if self.acquire_file(filename) else None
+        # FileResponse does Range/206, ETag/Last-Modified and sendfile
+        return FileTransfer(file_path, release, chunk_size=256 * 1024, headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'Content-Type': 'application/octet-stream',
+        })
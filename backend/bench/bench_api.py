@@ -0,0 +1,500 @@
+"""
+End-to-end API benchmark that runs fully offline.
+
+Three processes: a local media server (bench/fake_youtube.MediaServer)
+serving generated MP4/WebM files at --media-rate per connection, the app
+under test with YoutubeDL.extract_info replaced by fake_youtube's synthetic
+extractor, and this driver. The driver loads /api/info, /api/batch_formats,
+/api/batch_download (with a Socket.IO client following the tasks),
+/api/stream and /api/file with --concurrency parallel clients, sampling the
+server's thread count and RSS throughout.
+
+The report is JSON: per-scenario throughput and p50/p99 latency, Socket.IO
+event rate, server threads and peak RSS, and the server's own stage timings
+from /metrics. Save it with --output and pass an older report as --baseline
+to print the change per metric.
+
+    python bench/bench_api.py --output build-a.json
+    python bench/bench_api.py --server gunicorn --media-rate 2048 --baseline build-a.json
+    python bench/bench_api.py --scenarios stream,file --concurrency 64
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import requests
+import socketio
+
+import fake_youtube
+
+SCENARIOS = ('info', 'batch_formats', 'batch_download', 'stream', 'file')
+STAGE_METRIC = re.compile(r'^ytdown_stage_seconds_(sum|count)\{stage="(\w+)"\} (\S+)$')
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def proc_status(pid):
+    """(threads, rss kb) of a process, or None once it's gone"""
+    values = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                key, _, rest = line.partition(':')
+                if key in ('Threads', 'VmRSS'):
+                    values[key] = int(rest.split()[0])
+    except FileNotFoundError:
+        return None
+    return values.get('Threads', 0), values.get('VmRSS', 0)
+
+def child_pids(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(p) for p in f.read().split()]
+    except FileNotFoundError:
+        return []
+
+def run_media(port, media_bytes, rate):
+    fake_youtube.MediaServer('127.0.0.1', port, media_bytes, rate).serve_forever()
+
+def run_server(port, media_url, config):
+    os.chdir(tempfile.mkdtemp(prefix='api-bench-'))
+    if not config['verbose']:
+        sys.stdout = open(os.devnull, 'w')
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    def load_app():
+        fake_youtube.install(fake_youtube.FakeSite(
+            media_url, config['channel_size'], config['media_bytes'], config['extract_delay']))
+        import app
+        return app
+
+    if config['server'] == 'gunicorn':
+        from gunicorn.app.base import BaseApplication
+
+        class BenchServer(BaseApplication):
+            """The Dockerfile's gunicorn setup; the app is imported in the worker, as without --preload"""
+            def load_config(self):
+                settings = {'bind': f'127.0.0.1:{port}', 'worker_class': 'gthread', 'workers': 1,
+                            'threads': config['threads'], 'timeout': 1000, 'loglevel': 'warning'}
+                for key, value in settings.items():
+                    self.cfg.set(key, value)
+
+            def load(self):
+                return load_app().app
+
+        BenchServer().run()
+    else:
+        app = load_app()
+        app.socketio.run(app.app, host='127.0.0.1', port=port, allow_unsafe_werkzeug=True, log_output=False)
+
+class ServerSampler:
+    """Polls the serving process's thread count and RSS"""
+    def __init__(self, pid, interval=0.1):
+        self.pid = pid
+        self.interval = interval
+        self.threads = []
+        self.rss_kb = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _loop(self):
+        while not self._stop.is_set():
+            status = proc_status(self.pid)
+            if status:
+                self.threads.append(status[0])
+                self.rss_kb.append(status[1])
+            self._stop.wait(self.interval)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return {
+            'pid': self.pid,
+            'threads_peak': max(self.threads, default=0),
+            'threads_end': self.threads[-1] if self.threads else 0,
+            'rss_start_mb': round(self.rss_kb[0] / 1024, 1) if self.rss_kb else 0,
+            'rss_peak_mb': round(max(self.rss_kb, default=0) / 1024, 1),
+            'rss_end_mb': round(self.rss_kb[-1] / 1024, 1) if self.rss_kb else 0,
+        }
+
+class EventCounter:
+    """Socket.IO client that counts every event and follows download tasks to completion"""
+    def __init__(self, url):
+        self.client = socketio.Client(reconnection=False)
+        self.counts = {}
+        self.done = {}  # task_id -> (outcome, time)
+        self.filenames = {}  # task_id -> finished filename
+        self._cond = threading.Condition()
+        self.client.on('*', self._on_event)
+        self.client.connect(url, wait_timeout=10)
+
+    @property
+    def sid(self):
+        return self.client.get_sid()
+
+    def _on_event(self, event, data=None):
+        now = time.perf_counter()
+        with self._cond:
+            self.counts[event] = self.counts.get(event, 0) + 1
+            if event == 'progress_batch':
+                for update in data.get('updates', []):
+                    if update.get('status') == 'finished' and update.get('filename'):
+                        self.filenames[update['taskId']] = update['filename']
+            elif event in ('complete', 'error'):
+                self.done.setdefault(data['taskId'], ('finished' if event == 'complete' else 'failed', now))
+            self._cond.notify_all()
+
+    def wait_for(self, task_ids, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not all(tid in self.done for tid in task_ids):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def close(self):
+        self.client.disconnect()
+
+def summarize(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return {
+        'p50_ms': round(samples[len(samples) // 2] * 1000, 1),
+        'p99_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000, 1),
+        'mean_ms': round(statistics.mean(samples) * 1000, 1),
+    }
+
+def drive(request_fn, count, concurrency):
+    """Calls request_fn(i) for i in range(count) from concurrency threads; it returns (ttfb, bytes) or raises"""
+    latencies, ttfbs, errors = [], [], []
+    received = 0
+
+    def timed(i):
+        start = time.perf_counter()
+        try:
+            ttfb, nbytes = request_fn(i)
+            return time.perf_counter() - start, ttfb, nbytes, None
+        except Exception as e:
+            return None, None, 0, str(e)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for elapsed, ttfb, nbytes, error in pool.map(timed, range(count)):
+            if error is not None:
+                errors.append(error)
+                continue
+            latencies.append(elapsed)
+            if ttfb is not None:
+                ttfbs.append(ttfb)
+            received += nbytes
+    wall = time.perf_counter() - started
+    result = {
+        'requests': count,
+        'errors': len(errors),
+        'wall_s': round(wall, 2),
+        'requests_per_s': round(len(latencies) / wall, 1) if wall else None,
+        'latency': summarize(latencies),
+    }
+    if received:
+        result['mb_per_s'] = round(received / (1024 * 1024) / wall, 1)
+    if ttfbs:
+        result['ttfb'] = summarize(ttfbs)
+    if errors:
+        result['first_error'] = errors[0]
+    return result
+
+def read_body(response):
+    """(ttfb, bytes) for a streamed response, measured from the start of the request"""
+    response.raise_for_status()
+    first = None
+    total = 0
+    start = time.perf_counter() - response.elapsed.total_seconds()
+    for chunk in response.iter_content(64 * 1024):
+        if first is None:
+            first = time.perf_counter() - start
+        total += len(chunk)
+    return first, total
+
+class Bench:
+    def __init__(self, base_url, events, args, run_id):
+        self.base_url = base_url
+        self.events = events
+        self.args = args
+        self.run_id = run_id
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=args.concurrency)
+        self.session.mount('http://', adapter)
+
+    def video_url(self, i):
+        return f"https://www.youtube.com/watch?v={self.run_id}{i:06d}"
+
+    def post(self, path, payload):
+        response = self.session.post(self.base_url + path, json=payload, timeout=self.args.timeout)
+        response.raise_for_status()
+        return response
+
+    def info(self):
+        distinct = self.args.channels
+        page_count = max(1, self.args.channel_size // 50)
+
+        def request(i):
+            url = f"https://www.youtube.com/@bench{self.run_id}{i % distinct}"
+            # Walk each channel's pages in turn, so later pages ride the shared listing cursor
+            self.post('/api/info', {'url': url, 'page': (i // distinct) % page_count + 1})
+            return None, 0
+
+        return drive(request, self.args.requests, self.args.concurrency)
+
+    def batch_formats(self):
+        size = self.args.batch_size
+
+        def request(i):
+            urls = [self.video_url(i * size + j) for j in range(size)]
+            response = self.post('/api/batch_formats', {'urls': urls})
+            if any(r.get('error') for r in response.json()['formats']):
+                raise Exception("probe failed")
+            return None, 0
+
+        return drive(request, max(1, self.args.requests // size), self.args.concurrency)
+
+    def batch_download(self):
+        size = self.args.batch_size
+        submitted = {}  # task_id -> submit time
+
+        def request(i):
+            # Offset past the ids batch_formats used, so every download is a cache miss
+            urls = [self.video_url(10 ** 5 + i * size + j) for j in range(size)]
+            sent = time.perf_counter()
+            response = self.post('/api/batch_download', {'urls': urls, 'quality_cap': 720, 'sid': self.events.sid})
+            for task_id in response.json()['taskIds']:
+                submitted[task_id] = sent
+            return None, 0
+
+        started = time.perf_counter()
+        result = drive(request, self.args.batches, self.args.concurrency)
+        completed = self.events.wait_for(list(submitted), self.args.timeout)
+        wall = time.perf_counter() - started
+
+        durations = []
+        failed = 0
+        for task_id, sent in submitted.items():
+            outcome = self.events.done.get(task_id)
+            if outcome and outcome[0] == 'finished':
+                durations.append(outcome[1] - sent)
+            elif outcome:
+                failed += 1
+        media_bytes = fake_youtube.media_size(self.args.media_kb * 1024, '22')
+        result.update({
+            'tasks': len(submitted),
+            'tasks_finished': len(durations),
+            'tasks_failed': failed,
+            'timed_out': not completed,
+            'wall_s': round(wall, 2),
+            'tasks_per_s': round(len(durations) / wall, 2) if wall else None,
+            'mb_per_s': round(len(durations) * media_bytes / (1024 * 1024) / wall, 1) if wall else None,
+            'task_latency': summarize(durations),
+        })
+        return result
+
+    def stream(self):
+        def request(i):
+            url = self.video_url(2 * 10 ** 5 + i % self.args.channel_size)
+            response = self.session.get(self.base_url + '/api/stream', params={'url': url, 'format_id': '18'},
+                                        stream=True, timeout=self.args.timeout)
+            with response:
+                return read_body(response)
+
+        return drive(request, self.args.requests, self.args.concurrency)
+
+    def file(self):
+        filenames = sorted(set(self.events.filenames.values()))
+        if not filenames:
+            return {'skipped': 'no downloaded files; run batch_download first'}
+
+        def request(i):
+            response = self.session.get(self.base_url + '/api/file/' + quote(filenames[i % len(filenames)]),
+                                        stream=True, timeout=self.args.timeout)
+            with response:
+                return read_body(response)
+
+        return drive(request, self.args.requests, self.args.concurrency)
+
+def scrape_stages(base_url):
+    """Server-side mean time per stage from /metrics"""
+    stages = {}
+    try:
+        text = requests.get(base_url + '/metrics', timeout=10).text
+    except requests.RequestException:
+        return None
+    for line in text.splitlines():
+        match = STAGE_METRIC.match(line)
+        if match:
+            stages.setdefault(match.group(2), {})[match.group(1)] = float(match.group(3))
+    return {
+        stage: {'count': int(v.get('count', 0)), 'mean_ms': round(v['sum'] / v['count'] * 1000, 1) if v.get('count') else None}
+        for stage, v in sorted(stages.items())
+    }
+
+def build_info():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                                capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    import yt_dlp
+    return {'commit': commit, 'python': platform.python_version(), 'yt_dlp': yt_dlp.version.__version__}
+
+def wait_ready(base_url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not process.is_alive():
+            raise Exception("App server exited during startup")
+        try:
+            requests.get(base_url + '/api/queue', timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise Exception("App server did not come up")
+
+def run(args):
+    ctx = multiprocessing.get_context('spawn')
+    media_port, app_port = free_port(), free_port()
+    media_url = f"http://127.0.0.1:{media_port}"
+    base_url = f"http://127.0.0.1:{app_port}"
+    config = {
+        'server': args.server,
+        'threads': args.threads,
+        'channel_size': args.channel_size,
+        'media_bytes': args.media_kb * 1024,
+        'extract_delay': args.extract_delay / 1000,
+        'verbose': args.verbose,
+    }
+
+    media = ctx.Process(target=run_media, args=(media_port, config['media_bytes'], args.media_rate * 1024), daemon=True)
+    server = ctx.Process(target=run_server, args=(app_port, media_url, config), daemon=True)
+    media.start()
+    server.start()
+    events = None
+    try:
+        wait_ready(base_url, server)
+        # Under gunicorn the app lives in the forked worker
+        serving_pid = (child_pids(server.pid) or [server.pid])[0] if args.server == 'gunicorn' else server.pid
+        sampler = ServerSampler(serving_pid).start()
+        events = EventCounter(base_url)
+        bench = Bench(base_url, events, args, run_id=format(int(time.time()) % 0xFFFFF, '05x'))
+
+        results = {}
+        started = time.perf_counter()
+        for name in args.scenarios:
+            print(f"Running {name}...", file=sys.stderr)
+            results[name] = getattr(bench, name)()
+        wall = time.perf_counter() - started
+        server_stats = sampler.stop()
+        event_total = sum(events.counts.values())
+        return {
+            'build': build_info(),
+            'config': dict(vars(args), scenarios=list(args.scenarios)),
+            'scenarios': results,
+            'socketio': {
+                'events': event_total,
+                'events_per_s': round(event_total / wall, 1) if wall else None,
+                'by_event': dict(sorted(events.counts.items())),
+            },
+            'server': server_stats,
+            'stages': scrape_stages(base_url),
+        }
+    finally:
+        if events is not None:
+            events.close()
+        server.kill()
+        media.kill()
+        for pid in child_pids(server.pid):
+            try:
+                os.kill(pid, 9)
+            except ProcessLookupError:
+                pass
+
+def metric_paths(report):
+    """Flattened (name, value, higher_is_better) of the numbers worth comparing between builds"""
+    for name, result in (report.get('scenarios') or {}).items():
+        for key in ('requests_per_s', 'tasks_per_s', 'mb_per_s'):
+            if result.get(key) is not None:
+                yield f"{name}.{key}", result[key], True
+        for key in ('latency', 'ttfb', 'task_latency'):
+            for pct in ('p50_ms', 'p99_ms'):
+                if (result.get(key) or {}).get(pct) is not None:
+                    yield f"{name}.{key}.{pct}", result[key][pct], False
+    yield 'socketio.events_per_s', report['socketio']['events_per_s'], None
+    yield 'server.threads_peak', report['server']['threads_peak'], False
+    yield 'server.rss_peak_mb', report['server']['rss_peak_mb'], False
+
+def compare(report, baseline):
+    old = {name: value for name, value, _ in metric_paths(baseline)}
+    lines = []
+    for name, value, higher_is_better in metric_paths(report):
+        if name not in old or not old[name] or value is None:
+            continue
+        change = (value - old[name]) / old[name] * 100
+        verdict = ''
+        if higher_is_better is not None and abs(change) >= 10:
+            verdict = 'better' if (change > 0) == higher_is_better else 'WORSE'
+        lines.append(f"{name:40} {old[name]:>10} -> {value:>10}  {change:+6.1f}%  {verdict}")
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), type=lambda s: [x for x in s.split(',') if x])
+    parser.add_argument('--server', default='werkzeug', choices=['werkzeug', 'gunicorn'])
+    parser.add_argument('--threads', type=int, default=100, help='gunicorn gthread threads')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--batch-size', type=int, default=10, help='URLs per batch_formats/batch_download request')
+    parser.add_argument('--batches', type=int, default=4, help='batch_download requests')
+    parser.add_argument('--channels', type=int, default=8, help='distinct channels for /api/info')
+    parser.add_argument('--channel-size', type=int, default=200)
+    parser.add_argument('--media-kb', type=int, default=1024, help='size of the 360p format; 480p is 2x, 720p 4x')
+    parser.add_argument('--media-rate', type=int, default=0, help='KiB/s per media connection, 0 = unlimited')
+    parser.add_argument('--extract-delay', type=float, default=0, help='ms the fake extractor sleeps per extraction')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--output', help='write the JSON report here as well')
+    parser.add_argument('--baseline', help='earlier JSON report to compare against')
+    parser.add_argument('--verbose', action='store_true', help="keep the app server's output")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            print(compare(report, json.load(f)), file=sys.stderr)
@@ -0,0 +1,215 @@
+"""
+Concurrent slow-client capacity of the async transfer server, and its RSS
+per open stream.
+
+Three processes so each one's memory is measured on its own: a local origin
+serving a synthetic media file (with Range), the AsyncStreamServer under test
+proxying it, and a client process holding --clients connections open that
+each read --read-size bytes every --interval seconds. No yt-dlp, no network.
+
+    python bench/bench_async_stream.py --clients 2000 --duration 20
+    python bench/bench_async_stream.py --endpoint file --clients 2000
+    python bench/bench_async_stream.py --connections 4 --clients 2000
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, web
+
+import async_stream
+
+MEDIA_NAME = 'bench.mp4'
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def rss_kb(pid='self'):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+def run_origin(port, size, ready):
+    """Origin with Range support; it writes as fast as the proxy will take"""
+    raise_fd_limit()
+    payload = os.urandom(1024 * 1024)
+
+    async def media(request):
+        start, end = 0, size - 1
+        status = 200
+        headers = {'Content-Type': 'video/mp4', 'Accept-Ranges': 'bytes'}
+        if request.http_range.start is not None:
+            start = request.http_range.start
+            end = min(size, request.http_range.stop or size) - 1
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_length = end - start + 1
+        await response.prepare(request)
+        position = start
+        try:
+            while position <= end:
+                chunk = min(64 * 1024, end - position + 1)
+                offset = position % len(payload)
+                block = payload[offset:offset + chunk]
+                await response.write(block)
+                position += len(block)
+        except ConnectionError:
+            pass
+        return response
+
+    app = web.Application()
+    app.router.add_get('/media', media)
+    ready.set()
+    web.run_app(app, host='127.0.0.1', port=port, print=None, access_log=None, backlog=4096)
+
+def run_clients(url, clients, read_size, interval, duration, results):
+    raise_fd_limit()
+
+    async def client(session, samples):
+        start = time.perf_counter()
+        received = 0
+        try:
+            async with session.get(url) as resp:
+                if resp.status not in (200, 206):
+                    return
+                await resp.content.readexactly(1)
+                samples['ttfb'].append(time.perf_counter() - start)
+                samples['open'] += 1
+                deadline = start + duration
+                while time.perf_counter() < deadline:
+                    data = await resp.content.read(read_size)
+                    if not data:
+                        break
+                    received += len(data)
+                    await asyncio.sleep(interval)
+        except Exception:
+            samples['errors'] += 1
+        finally:
+            samples['bytes'] += received
+
+    async def main():
+        samples = {'ttfb': [], 'open': 0, 'errors': 0, 'bytes': 0}
+        connector = TCPConnector(limit=0)
+        async with ClientSession(connector=connector, timeout=ClientTimeout(total=None)) as session:
+            await asyncio.gather(*(client(session, samples) for _ in range(clients)))
+        results.put(samples)
+
+    asyncio.run(main())
+
+def summarize(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return {
+        'p50_ms': round(samples[len(samples) // 2] * 1000, 1),
+        'p99_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000, 1),
+        'mean_ms': round(statistics.mean(samples) * 1000, 1),
+    }
+
+def run(endpoint, clients, size_mb, read_size, interval, duration, connections=1):
+    fd_limit = raise_fd_limit()
+    ctx = multiprocessing.get_context('spawn')
+    size = size_mb * 1024 * 1024
+    folder = tempfile.mkdtemp(prefix='async-stream-bench-')
+
+    origin_port = free_port()
+    origin_url = f'http://127.0.0.1:{origin_port}/media'
+    ready = ctx.Event()
+    origin = ctx.Process(target=run_origin, args=(origin_port, size, ready), daemon=True)
+    origin.start()
+    ready.wait()
+    time.sleep(0.5)
+
+    if endpoint == 'file':
+        with open(os.path.join(folder, MEDIA_NAME), 'wb') as f:
+            f.truncate(size)
+
+    proxy_port = free_port()
+    server = async_stream.AsyncStreamServer(
+        '127.0.0.1', proxy_port, folder,
+        resolve=lambda url, fmt: (origin_url, 'bench', MEDIA_NAME, {}),
+        register_task=lambda tid, sid: None,
+        publish=lambda tid, payload: None,
+        is_aborted=lambda tid: False,
+        stream_connections=connections
+    ).start()
+
+    if endpoint == 'file':
+        url = f'http://127.0.0.1:{proxy_port}/api/file/{MEDIA_NAME}'
+    else:
+        url = f'http://127.0.0.1:{proxy_port}/api/stream?url=bench'
+
+    baseline = rss_kb()
+    results = ctx.Queue()
+    load = ctx.Process(target=run_clients, args=(url, clients, read_size, interval, duration, results))
+    started = time.perf_counter()
+    load.start()
+
+    peak_rss = baseline
+    peak_streams = 0
+    while load.is_alive():
+        peak_rss = max(peak_rss, rss_kb())
+        peak_streams = max(peak_streams, server.active_streams)
+        try:
+            samples = results.get(timeout=0.25)
+            break
+        except Exception:
+            samples = None
+    if samples is None:
+        samples = results.get(timeout=5)
+    load.join()
+    origin.kill()
+
+    open_streams = samples['open']
+    report = {
+        'endpoint': endpoint,
+        'clients': clients,
+        'fd_limit': fd_limit,
+        'media_mb': size_mb,
+        'client_read_bytes_per_s': round(read_size / interval) if interval else None,
+        'duration_s': round(time.perf_counter() - started, 1),
+        'streams_opened': open_streams,
+        'errors': samples['errors'],
+        'bytes_delivered_mb': round(samples['bytes'] / (1024 * 1024), 1),
+        'ttfb': summarize(samples['ttfb']),
+        'server_rss_baseline_mb': round(baseline / 1024, 1),
+        'server_rss_peak_mb': round(peak_rss / 1024, 1),
+        'server_rss_per_stream_kb': round((peak_rss - baseline) / open_streams, 1) if open_streams else None,
+    }
+    if endpoint == 'stream':
+        report['stream_connections'] = connections
+        report['peak_active_streams'] = peak_streams
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--endpoint', default='stream', choices=['stream', 'file'])
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--size-mb', type=int, default=64)
+    parser.add_argument('--read-size', type=int, default=16 * 1024)
+    parser.add_argument('--interval', type=float, default=0.1)
+    parser.add_argument('--duration', type=float, default=15)
+    parser.add_argument('--connections', type=int, default=1, help='upstream ranges fetched in parallel per stream')
+    args = parser.parse_args()
+    print(json.dumps(run(args.endpoint, args.clients, args.size_mb, args.read_size, args.interval, args.duration,
+                         args.connections), indent=2))
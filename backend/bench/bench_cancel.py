@@ -0,0 +1,175 @@
+"""
+Measures how fast a cancelled batch gives its resources back.
+
+Runs the app offline like bench_api.py, against a media server slow enough
+that every download is mid-transfer (and, at low --media-rate, blocked in a
+socket read) when the batch is cancelled through /api/cancel. From then on
+the driver polls the server process until each resource is back:
+
+    sockets   connections from the app to the media server
+    disk      bytes in the download folder (.part files)
+    tasks     running + queued jobs in the scheduler
+    children  subprocesses (ffmpeg)
+    cpu       CPU time the process burns per second
+
+and reports the seconds each one took. The run fails (exit status 1) when
+anything is still held after --bound seconds.
+
+    python bench/bench_cancel.py
+    python bench/bench_cancel.py --batch-size 40 --slots 10 --media-rate 4 --bound 1
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import requests
+
+import bench_api
+
+def media_sockets(pid, media_port):
+    """Established connections from pid's network namespace to the media server"""
+    count = 0
+    for table in ('tcp', 'tcp6'):
+        try:
+            with open(f'/proc/{pid}/net/{table}') as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    if fields[3] == '01' and int(fields[2].rsplit(':', 1)[1], 16) == media_port:
+                        count += 1
+        except FileNotFoundError:
+            pass
+    return count
+
+def folder_bytes(path):
+    total = 0
+    for entry in os.scandir(path):
+        if entry.is_file(follow_symlinks=False):
+            total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+def cpu_seconds(pid):
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def sample(pid, media_port, downloads, base_url):
+    queue = requests.get(base_url + '/api/queue', timeout=5).json()
+    return {
+        'sockets': media_sockets(pid, media_port),
+        'disk': folder_bytes(downloads),
+        'tasks': queue['active'] + queue['queued'],
+        'children': len(bench_api.child_pids(pid)),
+        'threads': bench_api.proc_status(pid)[0],
+        'cpu': cpu_seconds(pid),
+    }
+
+def run(args):
+    # Inherited by the spawned app server
+    os.environ.update({'MAX_CONCURRENT_DOWNLOADS': str(args.slots), 'ADAPTIVE_CONCURRENCY': '0', 'RECONNECT_GRACE_PERIOD': '600'})
+    ctx = multiprocessing.get_context('spawn')
+    media_port, app_port = bench_api.free_port(), bench_api.free_port()
+    media_url = f"http://127.0.0.1:{media_port}"
+    base_url = f"http://127.0.0.1:{app_port}"
+    config = {
+        'server': 'werkzeug',
+        'threads': 0,
+        'channel_size': 10,
+        'media_bytes': args.media_kb * 1024,
+        'extract_delay': 0,
+        'verbose': args.verbose,
+    }
+
+    media = ctx.Process(target=bench_api.run_media, args=(media_port, config['media_bytes'], args.media_rate * 1024), daemon=True)
+    server = ctx.Process(target=bench_api.run_server, args=(app_port, media_url, config), daemon=True)
+    media.start()
+    server.start()
+    events = None
+    try:
+        bench_api.wait_ready(base_url, server)
+        downloads = os.path.join(os.readlink(f'/proc/{server.pid}/cwd'), 'downloads')
+        idle = sample(server.pid, media_port, downloads, base_url)
+        events = bench_api.EventCounter(base_url)
+
+        urls = [f"https://www.youtube.com/watch?v=cancel{i:06d}" for i in range(args.batch_size)]
+        batch = requests.post(base_url + '/api/batch_download',
+                              json={'urls': urls, 'quality_cap': 720, 'sid': events.sid}, timeout=30).json()
+
+        # Wait until every slot is mid-download
+        deadline = time.monotonic() + 30
+        while True:
+            loaded = sample(server.pid, media_port, downloads, base_url)
+            if loaded['sockets'] >= args.slots and loaded['disk'] > 0 or time.monotonic() > deadline:
+                break
+            time.sleep(0.05)
+        time.sleep(args.settle)
+        cpu_before = cpu_seconds(server.pid)
+        time.sleep(0.5)
+        cpu_rate_loaded = (cpu_seconds(server.pid) - cpu_before) / 0.5
+        loaded = sample(server.pid, media_port, downloads, base_url)
+
+        started = time.perf_counter()
+        response = requests.post(base_url + '/api/cancel', json={'batchId': batch['batchId']}, timeout=30)
+        request_s = time.perf_counter() - started
+        cancelled = response.json().get('cancelled', [])
+
+        released = {}
+        current = loaded
+        while time.perf_counter() - started < args.timeout:
+            current = sample(server.pid, media_port, downloads, base_url)
+            elapsed = time.perf_counter() - started
+            for key in ('sockets', 'disk', 'tasks', 'children'):
+                if key not in released and current[key] <= idle[key]:
+                    released[key] = round(elapsed, 3)
+            if len(released) == 4:
+                break
+            time.sleep(0.01)
+        cpu_before = cpu_seconds(server.pid)
+        time.sleep(0.5)
+        cpu_rate_after = (cpu_seconds(server.pid) - cpu_before) / 0.5
+
+        held = sorted({'sockets', 'disk', 'tasks', 'children'} - {k for k, v in released.items() if v <= args.bound})
+        return {
+            'config': vars(args),
+            'batch': {'tasks': len(batch['taskIds']), 'cancelled': len(cancelled), 'cancel_request_ms': round(request_s * 1000, 1)},
+            'idle': {k: v for k, v in idle.items() if k != 'cpu'},
+            'loaded': {k: v for k, v in loaded.items() if k != 'cpu'},
+            'after': {k: v for k, v in current.items() if k != 'cpu'},
+            'released_s': released,
+            'cpu_per_s': {'loaded': round(cpu_rate_loaded, 3), 'after': round(cpu_rate_after, 3)},
+            'stages': bench_api.scrape_stages(base_url),
+            'within_bound': not held,
+            'held': held,
+        }
+    finally:
+        if events is not None:
+            events.close()
+        server.kill()
+        media.kill()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-size', type=int, default=20)
+    parser.add_argument('--slots', type=int, default=5, help='MAX_CONCURRENT_DOWNLOADS of the app')
+    parser.add_argument('--media-kb', type=int, default=16384, help='size of the 360p format; the 720p one fetched here is 4x')
+    parser.add_argument('--media-rate', type=int, default=8,
+                        help='KiB/s per media connection; the server writes 64 KiB then sleeps, so reads stall between chunks')
+    parser.add_argument('--settle', type=float, default=1.0, help='seconds downloads run before the cancel')
+    parser.add_argument('--bound', type=float, default=2.0, help='seconds within which everything must be released')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--output', help='write the JSON report here as well')
+    parser.add_argument('--verbose', action='store_true', help="keep the app server's output")
+    args = parser.parse_args()
+
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    sys.exit(0 if report['within_bound'] else 1)
+
+if __name__ == '__main__':
+    main()
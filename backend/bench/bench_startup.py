@@ -0,0 +1,232 @@
+"""
+Cold start of the app process: import time, time to first /api/info and idle RSS.
+
+Each run starts the app in a fresh interpreter (werkzeug via socketio.run, or
+gunicorn as in the Dockerfile) in a working directory whose download folder
+holds --stale-files left over from a "previous run", with
+YoutubeDL.extract_info replaced by fake_youtube's synthetic extractor. The
+driver only uses the standard library, and the app process imports nothing
+but the app and fake_youtube, so neither preloads what the app imports
+lazily. Per run it records:
+
+    import_ms       time `import app` took in the serving process
+    listen_ms       process start until the port accepts connections
+    first_info_ms   process start until the first /api/info response
+    info_ms         latency of /api/info once warmed up
+    rss_kb          RSS of the process tree when the port opens, and idle after --settle
+    stale_cleared   whether the old download folder was emptied by then
+
+and reports the median of --runs runs, with the process's own view of
+whether yt_dlp was already loaded when the import returned.
+
+    python bench/bench_startup.py
+    python bench/bench_startup.py --server gunicorn --runs 10 --stale-files 5000
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.join(BENCH_DIR, '..')
+INFO_URL = 'https://www.youtube.com/watch?v=startup0001'
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def serve(config):
+    """Runs in the app process: imports the app, timing it, and serves it"""
+    sys.path.insert(0, BACKEND_DIR)
+    sys.path.insert(0, BENCH_DIR)
+    os.chdir(config['workdir'])
+    if not config['verbose']:
+        sys.stdout = open(os.devnull, 'w')
+    import fake_youtube
+    site = fake_youtube.FakeSite('http://127.0.0.1:9', 10)
+
+    def load_app():
+        started = time.perf_counter()
+        import app
+        import_s = time.perf_counter() - started
+        report = {'import_s': import_s, 'yt_dlp_at_import': 'yt_dlp' in sys.modules, 'modules': len(sys.modules)}
+        if hasattr(app, 'load_yt_dlp'):
+            # Installed whenever the app gets around to importing yt_dlp, before it builds a YoutubeDL
+            load_yt_dlp = app.load_yt_dlp
+
+            def load_and_install():
+                module = load_yt_dlp()
+                fake_youtube.install(site)
+                return module
+
+            app.load_yt_dlp = load_and_install
+        else:
+            fake_youtube.install(site)
+        with open(config['report'], 'w') as f:
+            json.dump(report, f)
+        return app
+
+    if config['server'] == 'gunicorn':
+        from gunicorn.app.base import BaseApplication
+
+        class StartupServer(BaseApplication):
+            """The Dockerfile's gunicorn setup; the app is imported in the worker, as without --preload"""
+            def load_config(self):
+                settings = {'bind': f"127.0.0.1:{config['port']}", 'worker_class': 'gthread', 'workers': 1,
+                            'threads': 100, 'timeout': 1000, 'loglevel': 'warning'}
+                for key, value in settings.items():
+                    self.cfg.set(key, value)
+
+            def load(self):
+                return load_app().app
+
+        StartupServer().run()
+    else:
+        import logging
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        app = load_app()
+        app.socketio.run(app.app, host='127.0.0.1', port=config['port'], allow_unsafe_werkzeug=True, log_output=False)
+
+def process_tree(pid):
+    pids = [pid]
+    for p in pids:
+        try:
+            with open(f'/proc/{p}/task/{p}/children') as f:
+                pids.extend(int(c) for c in f.read().split())
+        except FileNotFoundError:
+            pass
+    return pids
+
+def tree_rss_kb(pid):
+    total = 0
+    for p in process_tree(pid):
+        try:
+            with open(f'/proc/{p}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+        except FileNotFoundError:
+            pass
+    return total
+
+def post_info(base_url, timeout=60):
+    req = urllib.request.Request(base_url + '/api/info', data=json.dumps({'url': INFO_URL}).encode(),
+                                 headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req, timeout=timeout) as response:
+        body = json.load(response)
+    if 'error' in body:
+        raise Exception(f"/api/info failed: {body['error']}")
+    return body
+
+def make_stale_folder(workdir, files, kb):
+    folder = os.path.join(workdir, 'downloads')
+    os.makedirs(folder)
+    data = b'\0' * (kb * 1024)
+    for i in range(files):
+        with open(os.path.join(folder, f"stale video {i}.mp4"), 'wb') as f:
+            f.write(data)
+
+def stale_cleared(workdir):
+    """No file from the previous run is left, in the download folder or set aside next to it"""
+    for entry in os.listdir(workdir):
+        if entry.startswith('downloads'):
+            path = os.path.join(workdir, entry)
+            if os.path.isdir(path) and any(name.startswith('stale video') for name in os.listdir(path)):
+                return False
+    return True
+
+def run_once(args):
+    workdir = tempfile.mkdtemp(prefix='startup-bench-')
+    report_path = os.path.join(workdir, 'import.json')
+    make_stale_folder(workdir, args.stale_files, args.stale_kb)
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    config = {'server': args.server, 'port': port, 'workdir': workdir, 'report': report_path, 'verbose': args.verbose}
+
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', json.dumps(config)])
+    try:
+        deadline = started + args.timeout
+        while True:
+            if server.poll() is not None:
+                raise Exception("App server exited during startup")
+            if time.perf_counter() > deadline:
+                raise Exception("App server did not come up")
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.005)
+        listen_s = time.perf_counter() - started
+        rss_listen = tree_rss_kb(server.pid)
+
+        post_info(base_url)
+        first_info_s = time.perf_counter() - started
+
+        time.sleep(args.settle)
+        rss_idle = tree_rss_kb(server.pid)
+        info_started = time.perf_counter()
+        post_info(base_url)
+        info_s = time.perf_counter() - info_started
+
+        with open(report_path) as f:
+            imported = json.load(f)
+        return {
+            'import_ms': imported['import_s'] * 1000,
+            'listen_ms': listen_s * 1000,
+            'first_info_ms': first_info_s * 1000,
+            'info_ms': info_s * 1000,
+            'rss_kb_listen': rss_listen,
+            'rss_kb_idle': rss_idle,
+            'stale_cleared': stale_cleared(workdir),
+            'yt_dlp_at_import': imported['yt_dlp_at_import'],
+            'modules_at_import': imported['modules'],
+        }
+    finally:
+        server.kill()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def run(args):
+    runs = [run_once(args) for _ in range(args.runs)]
+    summary = {}
+    for key in runs[0]:
+        values = [r[key] for r in runs]
+        if isinstance(values[0], bool):
+            summary[key] = all(values)
+        else:
+            summary[key] = round(statistics.median(values), 1)
+    return {'config': vars(args), 'median': summary, 'runs': runs}
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == '--serve':
+        serve(json.loads(sys.argv[2]))
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', choices=('werkzeug', 'gunicorn'), default='werkzeug')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--stale-files', type=int, default=2000, help='files left in the download folder by a previous run')
+    parser.add_argument('--stale-kb', type=int, default=64, help='size of each stale file')
+    parser.add_argument('--settle', type=float, default=3.0, help='seconds after the first response before the idle sample')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--output', help='write the JSON report here as well')
+    parser.add_argument('--verbose', action='store_true', help="keep the app server's output")
+    args = parser.parse_args()
+
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
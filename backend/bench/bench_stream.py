@@ -0,0 +1,108 @@
+"""
+/api/stream throughput against a throttling origin, ranged versus single connection.
+
+Runs the app offline as in bench_api.py, against a media server that caps
+every connection at --media-rate, the way googlevideo throttles a single
+download. For each --connections setting (STREAM_CONNECTIONS of the app;
+1 is the single-connection baseline) and each number of concurrent
+--streams, the driver pulls the whole 360p file through /api/stream from
+that many clients at once and reports per-stream and aggregate throughput.
+Every response is checked for the expected length, and one request past
+the end checks the 416's Content-Range.
+
+    python bench/bench_stream.py
+    python bench/bench_stream.py --streams 1,8,16,32 --media-rate 512 --connections 1,4,8
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import bench_api
+
+def stream_once(base_url, video, timeout):
+    """(seconds, bytes) for one full /api/stream response"""
+    url = f"https://www.youtube.com/watch?v=stream{video:06d}"
+    started = time.perf_counter()
+    with requests.get(base_url + '/api/stream', params={'url': url, 'format_id': '18'}, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        received = sum(len(chunk) for chunk in response.iter_content(256 * 1024))
+    return time.perf_counter() - started, received
+
+def run_level(base_url, streams, expected, timeout):
+    with ThreadPoolExecutor(streams) as pool:
+        started = time.perf_counter()
+        results = list(pool.map(lambda i: stream_once(base_url, i, timeout), range(streams)))
+        wall = time.perf_counter() - started
+    rates = [nbytes / seconds / 1024 for seconds, nbytes in results]
+    return {
+        'streams': streams,
+        'short': sum(1 for _, nbytes in results if nbytes != expected),
+        'wall_s': round(wall, 2),
+        'per_stream_kib_s': {'median': round(statistics.median(rates)), 'min': round(min(rates))},
+        'aggregate_kib_s': round(sum(nbytes for _, nbytes in results) / wall / 1024),
+    }
+
+def check_416(base_url, size):
+    url = "https://www.youtube.com/watch?v=stream000000"
+    response = requests.get(base_url + '/api/stream', params={'url': url, 'format_id': '18'},
+                            headers={'Range': f'bytes={size + 10}-'}, timeout=30)
+    return {'status': response.status_code, 'content_range': response.headers.get('Content-Range'),
+            'expected': f'bytes */{size}'}
+
+def run_setting(args, connections):
+    # Inherited by the spawned app server
+    os.environ['STREAM_CONNECTIONS'] = str(connections)
+    ctx = multiprocessing.get_context('spawn')
+    media_port, app_port = bench_api.free_port(), bench_api.free_port()
+    media_url = f"http://127.0.0.1:{media_port}"
+    base_url = f"http://127.0.0.1:{app_port}"
+    config = {
+        'server': args.server,
+        'threads': 0 if args.server == 'werkzeug' else 200,
+        'channel_size': 10,
+        'media_bytes': args.media_kb * 1024,
+        'extract_delay': 0,
+        'verbose': args.verbose,
+    }
+
+    media = ctx.Process(target=bench_api.run_media, args=(media_port, config['media_bytes'], args.media_rate * 1024), daemon=True)
+    server = ctx.Process(target=bench_api.run_server, args=(app_port, media_url, config), daemon=True)
+    media.start()
+    server.start()
+    try:
+        bench_api.wait_ready(base_url, server)
+        levels = [run_level(base_url, streams, config['media_bytes'], args.timeout) for streams in args.streams]
+        stats = requests.get(base_url + '/api/cache_stats', timeout=10).json().get('stream_connections')
+        return {'connections': connections, 'levels': levels, 'range_416': check_416(base_url, config['media_bytes']),
+                'budget_after': stats}
+    finally:
+        server.kill()
+        media.kill()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', choices=('werkzeug', 'gunicorn'), default='werkzeug')
+    parser.add_argument('--streams', type=lambda s: [int(n) for n in s.split(',')], default=[1, 4, 8, 16])
+    parser.add_argument('--connections', type=lambda s: [int(n) for n in s.split(',')], default=[1, 4],
+                        help='STREAM_CONNECTIONS settings to compare; 1 is the single-connection baseline')
+    parser.add_argument('--media-kb', type=int, default=8192, help='size of the streamed file')
+    parser.add_argument('--media-rate', type=int, default=1024, help='KiB/s the origin allows per connection')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--output', help='write the JSON report here as well')
+    parser.add_argument('--verbose', action='store_true', help="keep the app server's output")
+    args = parser.parse_args()
+
+    report = {'config': vars(args), 'settings': [run_setting(args, connections) for connections in args.connections]}
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+Two task-state nodes on one shared backend: event routing, abort propagation
+and what is_aborted() costs on the progress-hook path.
+
+Both nodes live in this process but share state only through the backend, as
+two gunicorn workers would: a SQLite file, or Redis (fakeredis when no
+--redis-url is given, so it runs without a server). The driver checks that
+
+    routing   events published on node B reach a sid connected to node A, once
+    abort     an abort flagged on A is seen by a task running on B
+    fallback  a flag that bypassed the notification is picked up by refresh_aborts()
+
+and reports delivery and abort latencies plus the per-call cost of
+is_aborted() for a task running on the node (answered from memory) next to
+one that isn't (a storage round trip). Exits with status 1 if a check fails.
+
+    python bench/bench_task_state.py
+    python bench/bench_task_state.py --backend redis --redis-url redis://localhost:6379/15
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import task_state
+
+def make_nodes(args):
+    if args.backend == 'sqlite':
+        path = os.path.join(tempfile.mkdtemp(prefix='task-state-bench-'), 'tasks.db')
+        return task_state.SQLiteTaskState(path), task_state.SQLiteTaskState(path)
+    if args.redis_url:
+        import redis
+        clients = redis.Redis.from_url(args.redis_url), redis.Redis.from_url(args.redis_url)
+    else:
+        import fakeredis
+        server = fakeredis.FakeServer()
+        clients = fakeredis.FakeRedis(server=server), fakeredis.FakeRedis(server=server)
+    prefix = f'bench-{os.getpid()}:'
+    return tuple(task_state.RedisTaskState(client, prefix=prefix) for client in clients)
+
+def wait_for(condition, timeout):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            return False
+        time.sleep(0.001)
+    return True
+
+def summarize(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return {
+        'p50_ms': round(samples[len(samples) // 2] * 1000, 2),
+        'max_ms': round(samples[-1] * 1000, 2),
+        'mean_ms': round(statistics.mean(samples) * 1000, 2),
+    }
+
+def check_routing(node_a, node_b, received, count, timeout):
+    node_a.add_client('sid-a')
+    sent = {}
+    for i in range(count):
+        sent[i] = time.perf_counter()
+        node_b.publish('progress', {'seq': i}, 'sid-a')
+    wait_for(lambda: len(received['a']) >= count, timeout)
+    latencies = [at - sent[payload['seq']] for _, payload, _, at in received['a']]
+    return {
+        'sent': count,
+        'delivered_on_a': len(received['a']),
+        'delivered_on_b': len(received['b']),
+        'latency': summarize(latencies),
+        'ok': len(received['a']) == count and not received['b'],
+    }
+
+def check_abort(node_a, node_b, count, timeout):
+    latencies = []
+    missed = 0
+    for i in range(count):
+        tid = f'abort-{i}'
+        node_b.register_task(tid, None)
+        started = time.perf_counter()
+        if not node_a.abort(tid) or not wait_for(lambda: node_b.is_aborted(tid), timeout):
+            missed += 1
+        else:
+            latencies.append(time.perf_counter() - started)
+        node_b.finish_task(tid)
+    return {'tasks': count, 'missed': missed, 'latency': summarize(latencies), 'ok': missed == 0}
+
+def flag_silently(node, tid):
+    """Sets the abort flag in storage without the notification, like one lost in transit"""
+    if isinstance(node, task_state.SQLiteTaskState):
+        with node._db() as db:
+            db.execute('UPDATE tasks SET abort = 1 WHERE task_id = ?', (tid,))
+    else:
+        node.redis.hset(node._key('task', tid), 'abort', 1)
+
+def check_fallback(node_a, node_b):
+    tid = 'fallback'
+    node_b.register_task(tid, None)
+    flag_silently(node_a, tid)
+    before = node_b.is_aborted(tid)
+    node_b.refresh_aborts()
+    after = node_b.is_aborted(tid)
+    node_b.finish_task(tid)
+    return {'before_refresh': before, 'after_refresh': after, 'ok': not before and after}
+
+def time_calls(fn, calls):
+    started = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return round((time.perf_counter() - started) / calls * 1e6, 2)
+
+def is_aborted_cost(node_a, node_b, calls):
+    tid = 'hook'
+    node_b.register_task(tid, None)
+    try:
+        return {
+            'running_here_us': time_calls(lambda: node_b.is_aborted(tid), calls),
+            'running_elsewhere_us': time_calls(lambda: node_a.is_aborted(tid), calls),
+        }
+    finally:
+        node_b.finish_task(tid)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', choices=('sqlite', 'redis'), default='sqlite')
+    parser.add_argument('--redis-url', help='real Redis to use instead of fakeredis')
+    parser.add_argument('--events', type=int, default=200)
+    parser.add_argument('--aborts', type=int, default=50)
+    parser.add_argument('--calls', type=int, default=20000, help='is_aborted() calls per timing')
+    parser.add_argument('--timeout', type=float, default=5)
+    args = parser.parse_args()
+
+    node_a, node_b = make_nodes(args)
+    received = {'a': [], 'b': []}
+    lock = threading.Lock()
+
+    def deliverer(name):
+        def deliver(event, payload, sid):
+            with lock:
+                received[name].append((event, payload, sid, time.perf_counter()))
+        return deliver
+
+    node_a.start(deliverer('a'))
+    node_b.start(deliverer('b'))
+    # Let the Redis listeners subscribe before anything is published
+    time.sleep(0.2)
+
+    report = {
+        'backend': type(node_a).__name__,
+        'routing': check_routing(node_a, node_b, received, args.events, args.timeout),
+        'abort': check_abort(node_a, node_b, args.aborts, args.timeout),
+        'fallback': check_fallback(node_a, node_b),
+        'is_aborted': is_aborted_cost(node_a, node_b, args.calls),
+    }
+    print(json.dumps(report, indent=2))
+    if not all(report[check]['ok'] for check in ('routing', 'abort', 'fallback')):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
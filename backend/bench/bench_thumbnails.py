@@ -0,0 +1,138 @@
+"""
+Thumbnail loading for a channel grid page, direct versus through the proxy.
+
+A local image server (fake_youtube.MediaServer) stands in for i.ytimg.com
+with --latency per request; the app runs offline as in bench_api.py with
+THUMBNAIL_UPSTREAM pointed at it. For one page of --page-size videos, the
+driver fetches every thumbnail with --connections parallel connections, like
+a browser, in four ways:
+
+    direct    the upstream URLs the listing carries (largest rendition)
+    cold      proxy URLs right after /api/info, which starts warming them
+    warm      the same proxy URLs again, now served from the disk cache
+    prefetch  a fresh page warmed by /api/thumbnails/prefetch first
+
+and reports wall time, bytes and the proxy's Cache-Control header.
+
+    python bench/bench_thumbnails.py
+    python bench/bench_thumbnails.py --latency 120 --connections 6
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import bench_api
+import fake_youtube
+
+CHANNEL = 'https://www.youtube.com/@thumbbench'
+
+def run_images(port, latency):
+    fake_youtube.MediaServer('127.0.0.1', port, 1024, thumb_latency=latency).serve_forever()
+
+def fetch_all(urls, connections):
+    """(wall seconds, total bytes, failures, last response) for fetching urls in parallel"""
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=connections))
+
+    def fetch(url):
+        return session.get(url, timeout=30)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=connections) as pool:
+        responses = list(pool.map(fetch, urls))
+    wall = time.perf_counter() - started
+    failed = sum(1 for r in responses if r.status_code != 200)
+    return wall, sum(len(r.content) for r in responses if r.status_code == 200), failed, responses[-1]
+
+def page(base_url, number):
+    return requests.post(base_url + '/api/info', json={'url': CHANNEL, 'page': number}, timeout=60).json()
+
+def result(urls, wall, nbytes, failed, **extra):
+    return dict({
+        'images': len(urls),
+        'failed': failed,
+        'wall_ms': round(wall * 1000, 1),
+        'kb': round(nbytes / 1024, 1),
+    }, **extra)
+
+def run(args):
+    ctx = multiprocessing.get_context('spawn')
+    image_port, app_port = bench_api.free_port(), bench_api.free_port()
+    image_url = f"http://127.0.0.1:{image_port}"
+    base_url = f"http://127.0.0.1:{app_port}"
+    # Inherited by the spawned app server
+    os.environ['THUMBNAIL_UPSTREAM'] = image_url + '/vi/{id}/{variant}.jpg'
+    config = {
+        'server': 'werkzeug',
+        'threads': 0,
+        'channel_size': args.page_size * 4,
+        'media_bytes': 1024,
+        'extract_delay': 0,
+        'verbose': args.verbose,
+    }
+
+    images = ctx.Process(target=run_images, args=(image_port, args.latency / 1000), daemon=True)
+    server = ctx.Process(target=bench_api.run_server, args=(app_port, image_url, config), daemon=True)
+    images.start()
+    server.start()
+    try:
+        bench_api.wait_ready(base_url, server)
+        report = {'config': vars(args)}
+
+        # The same listing the app sees, for the upstream URLs and the ids of pages not browsed yet
+        entries = list(fake_youtube.FakeSite(image_url, config['channel_size']).channel(CHANNEL)['entries'])
+        size = args.page_size
+
+        page(base_url, 1)
+        # The largest rendition, which the grid used to load straight from upstream
+        direct_urls = [e['thumbnails'][-1]['url'] for e in entries[:size]]
+        wall, nbytes, failed, _ = fetch_all(direct_urls, args.connections)
+        report['direct'] = result(direct_urls, wall, nbytes, failed)
+
+        second = page(base_url, 2)
+        proxy_urls = [video['thumbnail'] for video in second['videos']]
+        wall, nbytes, failed, _ = fetch_all(proxy_urls, args.connections)
+        report['cold'] = result(proxy_urls, wall, nbytes, failed)
+
+        wall, nbytes, failed, last = fetch_all(proxy_urls, args.connections)
+        report['warm'] = result(proxy_urls, wall, nbytes, failed, cache_control=last.headers.get('Cache-Control'))
+
+        # /api/info already warms its own page, so the endpoint is measured on a page not browsed yet
+        ids = [e['id'] for e in entries[3 * size:4 * size]]
+        started = time.perf_counter()
+        prefetched = requests.post(base_url + '/api/thumbnails/prefetch', json={'ids': ids}, timeout=60).json()
+        prefetch_wall = time.perf_counter() - started
+        prefetch_urls = list(prefetched['thumbnails'].values())
+        wall, nbytes, failed, _ = fetch_all(prefetch_urls, args.connections)
+        report['prefetch'] = result(prefetch_urls, wall, nbytes, failed,
+                                    prefetch_ms=round(prefetch_wall * 1000, 1), prefetch_failed=len(prefetched['failed']),
+                                    variant=prefetched['variant'])
+
+        report['cache'] = requests.get(base_url + '/api/cache_stats', timeout=10).json().get('thumbnails')
+        return report
+    finally:
+        server.kill()
+        images.kill()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--page-size', type=int, default=50, help="must match get_info's PAGE_SIZE")
+    parser.add_argument('--latency', type=float, default=60, help='ms the image server takes per request')
+    parser.add_argument('--connections', type=int, default=6, help='parallel connections per host, as in a browser')
+    parser.add_argument('--output', help='write the JSON report here as well')
+    parser.add_argument('--verbose', action='store_true', help="keep the app server's output")
+    args = parser.parse_args()
+
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
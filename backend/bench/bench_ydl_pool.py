@@ -0,0 +1,76 @@
+"""
+Per-request YoutubeDL overhead: a fresh instance per request (the old
+behaviour) versus checking one out of app.ydl_pool.
+
+extract_info is replaced with a stub that returns a synthetic video, so no
+network is touched and the numbers are pure setup/teardown cost.
+
+    python bench/bench_ydl_pool.py --requests 200
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import yt_dlp
+
+def stub_extract_info(self, url, download=False, **kwargs):
+    return {
+        'id': 'benchvideo0',
+        'title': 'Bench Video',
+        'formats': [{'format_id': '18', 'ext': 'mp4', 'height': 360, 'url': 'http://127.0.0.1/video.mp4'}],
+    }
+
+yt_dlp.YoutubeDL.extract_info = stub_extract_info
+
+# app clears its download folder on import, so give it a scratch directory
+os.chdir(tempfile.mkdtemp(prefix='ydl-pool-bench-'))
+import app
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'mean_ms': round(statistics.mean(samples) * 1000, 3),
+        'p50_ms': round(samples[len(samples) // 2] * 1000, 3),
+        'p99_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000, 3),
+    }
+
+def run(requests, profile):
+    url = 'https://www.youtube.com/watch?v=benchvideo0'
+
+    fresh = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        with yt_dlp.YoutubeDL(dict(app.YDL_PROFILES[profile])) as ydl:
+            ydl.extract_info(url, download=False)
+        fresh.append(time.perf_counter() - start)
+
+    app.ydl_pool.warm(profile)
+    pooled = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        with app.ydl_pool.checkout(profile) as ydl:
+            ydl.extract_info(url, download=False)
+        pooled.append(time.perf_counter() - start)
+
+    before, after = summarize(fresh), summarize(pooled)
+    return {
+        'profile': profile,
+        'requests': requests,
+        'fresh_instance': before,
+        'pooled_instance': after,
+        'speedup': round(before['mean_ms'] / after['mean_ms'], 1) if after['mean_ms'] else None,
+        'pool': app.ydl_pool.stats(),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--profile', default='video', choices=sorted(app.YDL_PROFILES))
+    args = parser.parse_args()
+    print(json.dumps(run(args.requests, args.profile), indent=2))
@@ -0,0 +1,260 @@
+"""
+Offline stand-in for YouTube, used by the benchmarks.
+
+install() replaces YoutubeDL.extract_info with a synthetic extractor:
+channel and playlist URLs return lazy flat listings, watch URLs return a
+video whose formats point at a MediaServer. Format selection, downloading
+(yt-dlp's own HTTP downloader), progress hooks and post-processing all run
+for real; only the site extraction is faked.
+
+Formats are progressive (audio and video in one file), so downloads need
+no ffmpeg merge. MediaServer generates each file on the fly: a small
+faststart MP4 or WebM header followed by filler, with Range support and an
+optional per-connection rate limit. It also serves thumbnails the way
+i.ytimg.com lays them out, /vi/<video id>/<variant>.jpg, with a per-request
+latency; maxresdefault is missing for every other video, as it often is.
+"""
+import hashlib
+import re
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+CHANNEL_URL = re.compile(r'youtube\.com/(@[\w.-]+|channel/[\w-]+|playlist\?list=[\w-]+)')
+VIDEO_URL = re.compile(r'(?:v=|youtu\.be/|/shorts/)([\w-]{6,})')
+MEDIA_PATH = re.compile(r'^/media/([\w-]+)/(\d+)\.(mp4|webm)$')
+THUMB_PATH = re.compile(r'^/vi/([\w-]+)/(\w+)\.jpg$')
+
+# variant -> (width, height), as served by i.ytimg.com
+THUMBNAIL_SIZES = {
+    'default': (120, 90),
+    'mqdefault': (320, 180),
+    'hqdefault': (480, 360),
+    'sddefault': (640, 480),
+    'maxresdefault': (1280, 720),
+}
+
+# format_id -> (ext, height, vcodec, acodec, size multiplier)
+FORMATS = {
+    '18': ('mp4', 360, 'avc1.42001E', 'mp4a.40.2', 1),
+    '43': ('webm', 480, 'vp8', 'vorbis', 2),
+    '22': ('mp4', 720, 'avc1.64001F', 'mp4a.40.2', 4),
+}
+
+def _box(kind, payload=b''):
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+def media_header(ext, size):
+    """Leading bytes of a generated file of size bytes; the rest is filler"""
+    if ext == 'mp4':
+        # ftyp, moov, then an mdat spanning the rest: already faststart, so optimize_video leaves it alone
+        head = _box(b'ftyp', b'isom\0\0\x02\0isomiso2avc1mp41') + _box(b'moov', _box(b'mvhd', b'\0' * 100))
+        return head + struct.pack('>I4s', size - len(head), b'mdat')
+    # EBML header with DocType "webm"
+    return bytes.fromhex('1a45dfa3') + bytes([0x80 | 15]) + bytes.fromhex('4282') + bytes([0x80 | 4]) + b'webm' + b'\0' * 8
+
+class FakeSite:
+    def __init__(self, media_url, channel_size=200, media_bytes=1024 * 1024, extract_delay=0.0):
+        self.media_url = media_url.rstrip('/')
+        self.channel_size = channel_size
+        self.media_bytes = media_bytes
+        self.extract_delay = extract_delay
+        self.extractions = 0
+        self._lock = threading.Lock()
+
+    def _count(self):
+        with self._lock:
+            self.extractions += 1
+        if self.extract_delay:
+            # Stands in for the extractor's round trips to the site
+            time.sleep(self.extract_delay)
+
+    def channel(self, url):
+        name = CHANNEL_URL.search(url).group(1)
+        prefix = hashlib.md5(name.encode()).hexdigest()[:5]
+
+        def entries():
+            for i in range(self.channel_size):
+                video_id = f"{prefix}{i:06d}"
+                yield {
+                    '_type': 'url',
+                    'ie_key': 'Youtube',
+                    'id': video_id,
+                    'url': f"https://www.youtube.com/watch?v={video_id}",
+                    'title': f"Bench video {i}",
+                    'duration': 60 + i % 600,
+                    'view_count': 1000 + i,
+                    # What YouTube's flat tab entries carry: resized hqdefault renditions, largest last
+                    'thumbnails': [{'url': f"{self.media_url}/vi/{video_id}/hqdefault.jpg?sqp={width}", 'width': width,
+                                    'height': width * 9 // 16} for width in (168, 196, 246, 336)],
+                }
+
+        return {
+            '_type': 'playlist',
+            'id': name,
+            'title': f"Bench channel {name}",
+            'webpage_url': url,
+            'extractor': 'youtube:tab',
+            'extractor_key': 'YoutubeTab',
+            'entries': entries(),
+        }
+
+    def video(self, video_id):
+        formats = []
+        for format_id, (ext, height, vcodec, acodec, scale) in FORMATS.items():
+            formats.append({
+                'format_id': format_id,
+                'url': f"{self.media_url}/media/{video_id}/{format_id}.{ext}",
+                'ext': ext,
+                'height': height,
+                'width': height * 16 // 9,
+                'vcodec': vcodec,
+                'acodec': acodec,
+                'protocol': 'http',
+                'filesize': self.media_bytes * scale,
+            })
+        return {
+            'id': video_id,
+            'title': f"Bench video {video_id}",
+            'duration': 120,
+            'thumbnail': f"{self.media_url}/thumb/{video_id}.jpg",
+            'webpage_url': f"https://www.youtube.com/watch?v={video_id}",
+            'extractor': 'youtube',
+            'extractor_key': 'Youtube',
+            'formats': formats,
+        }
+
+    def extract(self, url):
+        self._count()
+        if CHANNEL_URL.search(url):
+            return self.channel(url)
+        match = VIDEO_URL.search(url)
+        if not match:
+            import yt_dlp
+            raise yt_dlp.utils.DownloadError(f"ERROR: Unsupported URL: {url}")
+        return self.video(match.group(1))
+
+def install(site):
+    """Routes every YoutubeDL.extract_info in this process to site"""
+    # Imported here so the media server and bench_startup.py's app process don't load yt-dlp up front
+    import yt_dlp
+
+    def extract_info(self, url, download=True, ie_key=None, extra_info=None, process=True, force_generic_extractor=False):
+        result = site.extract(url)
+        if not process:
+            return result
+        return self.process_ie_result(result, download=download, extra_info=extra_info or {})
+
+    yt_dlp.YoutubeDL.extract_info = extract_info
+    return site
+
+def media_size(site_bytes, format_id):
+    return site_bytes * FORMATS[format_id][4]
+
+class MediaServer:
+    """Serves generated media at /media/<video id>/<format id>.<ext>, rate-limited per connection"""
+    def __init__(self, host, port, media_bytes, rate=0, chunk_size=64 * 1024, thumb_latency=0.0):
+        self.media_bytes = media_bytes
+        self.rate = rate
+        self.thumb_latency = thumb_latency
+        self.chunk_size = chunk_size
+        self.filler = bytes(range(256)) * (chunk_size // 256)
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self.do_GET(body=False)
+
+            def do_GET(self, body=True):
+                path = urlsplit(self.path).path
+                if path.startswith('/thumb/'):
+                    self._send(200, 'image/jpeg', b'\xff\xd8\xff\xe0' + b'\0' * 2048, body)
+                    return
+                thumb = THUMB_PATH.match(path)
+                if thumb:
+                    server.serve_thumbnail(self, thumb.group(1), thumb.group(2), body)
+                    return
+                match = MEDIA_PATH.match(path)
+                if not match or match.group(2) not in FORMATS:
+                    self._send(404, 'text/plain', b'not found', body)
+                    return
+                server.serve_media(self, match.group(3), media_size(server.media_bytes, match.group(2)), body)
+
+            def _send(self, status, content_type, payload, body):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                if body:
+                    self.wfile.write(payload)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    def serve_thumbnail(self, handler, video_id, variant, body):
+        if self.thumb_latency:
+            time.sleep(self.thumb_latency)
+        size = THUMBNAIL_SIZES.get(variant)
+        if size is None or variant == 'maxresdefault' and int(hashlib.md5(video_id.encode()).hexdigest(), 16) % 2:
+            handler._send(404, 'text/plain', b'not found', body)
+            return
+        # Roughly what a JPEG of that size weighs
+        handler._send(200, 'image/jpeg', b'\xff\xd8\xff\xe0' + bytes(size[0] * size[1] // 8), body)
+
+    def serve_media(self, handler, ext, size, body):
+        start, end = 0, size - 1
+        status = 200
+        requested = handler.headers.get('Range')
+        match = re.match(r'bytes=(\d*)-(\d*)$', requested or '')
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(0, size - int(match.group(2)))
+            if start >= size:
+                handler.send_response(416)
+                handler.send_header('Content-Range', f'bytes */{size}')
+                handler.send_header('Content-Length', '0')
+                handler.end_headers()
+                return
+            status = 206
+
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'video/mp4' if ext == 'mp4' else 'video/webm')
+        handler.send_header('Accept-Ranges', 'bytes')
+        handler.send_header('Content-Length', str(end - start + 1))
+        if status == 206:
+            handler.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        handler.end_headers()
+        if not body:
+            return
+
+        header = media_header(ext, size)
+        position = start
+        began = time.monotonic()
+        try:
+            while position <= end:
+                if position < len(header):
+                    block = header[position:min(len(header), end + 1)]
+                else:
+                    block = self.filler[:min(self.chunk_size, end - position + 1)]
+                handler.wfile.write(block)
+                position += len(block)
+                if self.rate:
+                    # Sleep off whatever we're ahead of the per-connection rate
+                    ahead = (position - start) / self.rate - (time.monotonic() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except ConnectionError:
+            pass
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
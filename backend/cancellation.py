@@ -0,0 +1,235 @@
+"""
+Cancellation tokens for download tasks.
+
+A task's token collects what it's blocked on or holds: open HTTP responses,
+subprocesses (yt-dlp's merger, our ffmpeg remux) and the files it's writing.
+cancel() interrupts all of it right away instead of waiting for the next
+progress hook: sockets are shut down so a blocked read returns at once,
+processes get SIGTERM and then SIGKILL after a grace period, and callbacks
+registered with on_cancel() run (e.g. to release a queue wait). The task's
+thread then unwinds with Cancelled and removes its partial files.
+
+Tokens are per process. Aborts raised in another worker reach them through
+the shared task state (see the cancel watcher in app.py).
+"""
+import glob
+import os
+import signal
+import socket
+import subprocess
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+# Seconds between SIGTERM and SIGKILL for a cancelled subprocess
+PROCESS_KILL_GRACE = float(os.environ.get('PROCESS_KILL_GRACE', 2))
+# Where sockets hide inside the response wrappers of urllib, http.client, urllib3 and requests
+_SOCKET_PATH_ATTRS = ('fp', '_fp', 'raw', '_sock', 'sock', '_connection', 'connection', '_original_response', 'response')
+
+class Cancelled(Exception):
+    # Same wording as the progress hook's abort, which callers match on
+    def __init__(self, message="Download Aborted by User"):
+        super().__init__(message)
+
+def _find_socket(obj, depth=6):
+    """The socket under a (possibly nested) HTTP response object, if one can be found"""
+    seen = set()
+    frontier = [obj]
+    for _ in range(depth):
+        next_frontier = []
+        for item in frontier:
+            if item is None or id(item) in seen:
+                continue
+            seen.add(id(item))
+            if isinstance(item, socket.socket):
+                return item
+            for attr in _SOCKET_PATH_ATTRS:
+                child = getattr(item, attr, None)
+                if child is not None and not callable(child):
+                    next_frontier.append(child)
+        frontier = next_frontier
+    return None
+
+def interrupt_response(response):
+    """Unblocks any thread reading from response, then closes it"""
+    sock = _find_socket(response)
+    if sock is not None:
+        try:
+            # Unlike close(), shutdown wakes a recv() blocked in another thread
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    try:
+        response.close()
+    except Exception:
+        pass
+
+def _signal(process, sig):
+    """Signals process, and its children too when it leads its own process group"""
+    try:
+        if hasattr(os, 'killpg') and os.getpgid(process.pid) == process.pid:
+            os.killpg(process.pid, sig)
+        else:
+            process.send_signal(sig)
+    except OSError:
+        pass
+
+def stop_process(process, grace=PROCESS_KILL_GRACE):
+    if process.poll() is not None:
+        return
+    _signal(process, signal.SIGTERM)
+
+    def kill():
+        if process.poll() is None:
+            _signal(process, getattr(signal, 'SIGKILL', signal.SIGTERM))
+
+    timer = threading.Timer(grace, kill)
+    timer.daemon = True
+    timer.start()
+
+def partial_files(path):
+    """Files yt-dlp may leave for an output path: .part, .ytdl, fragments and the merger's .temp"""
+    root, ext = os.path.splitext(path)
+    candidates = [path, path + '.part', path + '.ytdl', f"{root}.temp{ext}"]
+    candidates += glob.glob(glob.escape(path) + '.part-Frag*') + glob.glob(glob.escape(path) + '-Frag*')
+    return candidates
+
+class CancelToken:
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.cancelled_at = None
+        self.files = []  # outputs and temp files to remove if the task is cancelled
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._responses = weakref.WeakSet()
+        self._processes = weakref.WeakSet()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise Cancelled()
+
+    def on_cancel(self, callback):
+        """Runs callback on cancel, or right away if that already happened"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def track_response(self, response):
+        with self._lock:
+            if not self._event.is_set():
+                self._responses.add(response)
+                return
+        interrupt_response(response)
+
+    def track_process(self, process):
+        with self._lock:
+            if not self._event.is_set():
+                self._processes.add(process)
+                return
+        stop_process(process)
+
+    def track_file(self, path):
+        with self._lock:
+            if path and path not in self.files:
+                self.files.append(path)
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.cancelled_at = time.monotonic()
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+            responses = list(self._responses)
+            processes = list(self._processes)
+        for response in responses:
+            interrupt_response(response)
+        for process in processes:
+            stop_process(process)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Cancel callback error for {self.task_id}: {e}")
+        return True
+
+    def remove_files(self, skip=None):
+        """Deletes what the task wrote, except paths skip(path) is true for; returns the bytes freed"""
+        with self._lock:
+            files = list(self.files)
+        freed = 0
+        for path in files:
+            if skip is not None and skip(path):
+                continue
+            for candidate in partial_files(path):
+                try:
+                    size = os.path.getsize(candidate)
+                    os.remove(candidate)
+                    freed += size
+                except OSError:
+                    pass
+        return freed
+
+class CancelRegistry:
+    def __init__(self):
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get(self, task_id):
+        with self._lock:
+            token = self._tokens.get(task_id)
+            if token is None:
+                token = self._tokens[task_id] = CancelToken(task_id)
+            return token
+
+    def lookup(self, task_id):
+        with self._lock:
+            return self._tokens.get(task_id)
+
+    def cancel(self, task_id):
+        """Cancels a live token; False if this process isn't running the task"""
+        token = self.lookup(task_id)
+        return token.cancel() if token else False
+
+    def discard(self, task_id):
+        with self._lock:
+            self._tokens.pop(task_id, None)
+
+    def live(self):
+        with self._lock:
+            return [task_id for task_id, token in self._tokens.items() if not token.cancelled]
+
+_current = threading.local()
+
+@contextmanager
+def bound(token):
+    """Makes token the current thread's token, for code that can't be handed one (yt-dlp internals)"""
+    previous = getattr(_current, 'token', None)
+    _current.token = token
+    try:
+        yield token
+    finally:
+        _current.token = previous
+
+def current():
+    return getattr(_current, 'token', None)
+
+def run_process(cmd, token=None):
+    """subprocess.run(capture_output, text) that a cancel stops; raises Cancelled if it did"""
+    # In its own process group, so a cancel also reaches anything it spawned
+    process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                               start_new_session=os.name == 'posix')
+    if token is not None:
+        token.track_process(process)
+    stdout, stderr = process.communicate()
+    if token is not None and token.cancelled:
+        raise Cancelled()
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
@@ -0,0 +1,246 @@
+"""
+Local index of channel listings in SQLite, so browsing, searching and the
+resolution histogram don't need a crawl of the channel tab each time.
+
+Each (channel, tab) holds its videos in listing order (newest first) as a
+descending rank. The first sync walks the whole tab in the background,
+committing as it goes, and requests are answered as soon as the rows for
+their page exist. Later syncs are deltas: they walk from the top and stop at
+the first video that's already indexed, so they cost one upstream page in
+the common case. New videos are ranked above everything indexed before, and
+committed together once the walk reaches that first indexed video: a delta
+that fails partway leaves nothing behind, so the next one starts over from
+the same point instead of stopping at the newest row it managed to write.
+
+Max heights come from format probes (record_heights) and are kept per video
+id across channels and tabs.
+"""
+import sqlite3
+import threading
+import time
+
+# Rank offset for each delta sync; new entries of one sync must number fewer than this
+DELTA_RANK_STEP = 1_000_000
+RESOLUTION_BUCKETS = (('2160p', 2160), ('1440p', 1440), ('1080p', 1080), ('720p', 720), ('480p', 480), ('360p', 1))
+
+class _Sync:
+    def __init__(self, indexed, prepending):
+        self.indexed = indexed
+        # A delta sync puts new rows above old ones; pages aren't final until it reaches indexed rows
+        self.head_done = not prepending
+        self.done = False
+        self.error = None
+
+class ChannelIndex:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS channels (
+            channel TEXT NOT NULL, tab TEXT NOT NULL, title TEXT, synced_at REAL,
+            complete INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (channel, tab));
+        CREATE TABLE IF NOT EXISTS videos (
+            channel TEXT NOT NULL, tab TEXT NOT NULL, id TEXT NOT NULL, rank INTEGER NOT NULL,
+            title TEXT, duration REAL, url TEXT, thumbnail TEXT, is_short INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (channel, tab, id));
+        CREATE INDEX IF NOT EXISTS videos_by_rank ON videos (channel, tab, rank DESC);
+        CREATE TABLE IF NOT EXISTS heights (id TEXT PRIMARY KEY, max_height INTEGER NOT NULL);
+    """
+
+    def __init__(self, path, sync_interval=600, retry_interval=60, batch_size=50):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.retry_interval = retry_interval
+        self.batch_size = batch_size
+        self._local = threading.local()
+        self._cond = threading.Condition()
+        self._syncs = {}  # (channel, tab) -> running or last _Sync
+        self.syncs_started = 0
+        self.entries_fetched = 0
+        with self._db() as db:
+            db.executescript(self.SCHEMA)
+
+    def _db(self):
+        """One connection per thread; used as a context manager it's one transaction"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def _channel_row(self, channel, tab):
+        return self._db().execute(
+            'SELECT title, synced_at, complete FROM channels WHERE channel = ? AND tab = ?', (channel, tab)).fetchone()
+
+    def _count(self, channel, tab):
+        return self._db().execute('SELECT COUNT(*) FROM videos WHERE channel = ? AND tab = ?', (channel, tab)).fetchone()[0]
+
+    def ensure(self, channel, tab, fetch_entries, need=None, timeout=30):
+        """
+        Starts a sync if the index for this tab is missing or stale, then waits
+        until need rows can be served (None: until the sync is done) or timeout.
+        fetch_entries() -> (title, iterable of flat entries, newest first).
+        Returns whether a sync is still running; raises if there's nothing to
+        serve because the sync failed.
+        """
+        key = (channel, tab)
+        with self._cond:
+            sync = self._syncs.get(key)
+            if sync is None or sync.done:
+                row = self._channel_row(channel, tab)
+                if row is None or row[1] is None or time.time() - row[1] > (self.sync_interval if row[2] else self.retry_interval):
+                    indexed = self._count(channel, tab)
+                    sync = self._syncs[key] = _Sync(indexed, prepending=indexed > 0)
+                    self.syncs_started += 1
+                    threading.Thread(target=self._run_sync, args=(channel, tab, fetch_entries, sync),
+                                     name="channel-sync", daemon=True).start()
+
+            if sync is not None:
+                self._cond.wait_for(lambda: sync.done or (need is not None and sync.head_done and sync.indexed >= need), timeout)
+                if sync.done and sync.error is not None and sync.indexed == 0:
+                    raise Exception(sync.error)
+            return sync is not None and not sync.done
+
+    def _run_sync(self, channel, tab, fetch_entries, sync):
+        try:
+            self._sync(channel, tab, fetch_entries, sync)
+        except Exception as e:
+            print(f"Channel sync error for {channel} ({tab}): {e}")
+            sync.error = str(e)
+        finally:
+            with self._db() as db:
+                db.execute('INSERT INTO channels (channel, tab, synced_at) VALUES (?, ?, ?) '
+                           'ON CONFLICT (channel, tab) DO UPDATE SET synced_at = excluded.synced_at',
+                           (channel, tab, time.time()))
+            with self._cond:
+                sync.done = True
+                sync.head_done = True
+                self._cond.notify_all()
+
+    def _sync(self, channel, tab, fetch_entries, sync):
+        db = self._db()
+        known = {row[0] for row in db.execute('SELECT id FROM videos WHERE channel = ? AND tab = ?', (channel, tab))}
+        row = self._channel_row(channel, tab)
+        complete = bool(row and row[2])
+        top, bottom = db.execute('SELECT MAX(rank), MIN(rank) FROM videos WHERE channel = ? AND tab = ?', (channel, tab)).fetchone()
+        base = top + DELTA_RANK_STEP if known else 0
+
+        title, entries = fetch_entries()
+        with db:
+            db.execute('INSERT INTO channels (channel, tab, title) VALUES (?, ?, ?) '
+                       'ON CONFLICT (channel, tab) DO UPDATE SET title = excluded.title', (channel, tab, title))
+
+        pending = []
+        in_head = True
+        tail = bottom if bottom is not None else 0
+        walked_to_end = True
+        for position, entry in enumerate(entries):
+            self.entries_fetched += 1
+            video_id = entry.get('id')
+            if not video_id:
+                continue
+            if video_id in known:
+                if complete:
+                    # Everything from here down is indexed already
+                    walked_to_end = False
+                    break
+                # An interrupted first crawl: skip the indexed stretch and keep appending below it
+                if in_head:
+                    in_head = False
+                    self._flush(channel, tab, pending, sync, head_done=True)
+                    pending = []
+                continue
+            if in_head:
+                rank = base - position
+            else:
+                tail -= 1
+                rank = tail
+            known.add(video_id)
+            pending.append((channel, tab, video_id, rank, entry.get('title'), entry.get('duration'),
+                            entry.get('url'), entry.get('thumbnail'), int(bool(entry.get('is_short')))))
+            # A delta's head waits for the known id that proves it has no gap below it
+            if len(pending) >= self.batch_size and not complete:
+                self._flush(channel, tab, pending, sync, head_done=not in_head)
+                pending = []
+        self._flush(channel, tab, pending, sync, head_done=True)
+        if walked_to_end and not complete:
+            with db:
+                db.execute('UPDATE channels SET complete = 1 WHERE channel = ? AND tab = ?', (channel, tab))
+
+    def _flush(self, channel, tab, rows, sync, head_done):
+        if rows:
+            with self._db() as db:
+                db.executemany('INSERT OR IGNORE INTO videos (channel, tab, id, rank, title, duration, url, thumbnail, is_short) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        with self._cond:
+            sync.indexed += len(rows)
+            sync.head_done = sync.head_done or head_done
+            self._cond.notify_all()
+
+    @staticmethod
+    def _search_clause(search, column='v.title'):
+        if not search:
+            return '', ()
+        escaped = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return f" AND {column} LIKE ? ESCAPE '\\'", (f'%{escaped}%',)
+
+    def page(self, channel, tab, page, page_size, search=None):
+        """Returns (videos, has_more) for a 1-based page, optionally only titles containing search"""
+        clause, params = self._search_clause(search)
+        rows = self._db().execute(
+            'SELECT v.id, v.title, v.duration, v.url, v.thumbnail, v.is_short, COALESCE(h.max_height, 0) '
+            'FROM videos v LEFT JOIN heights h ON h.id = v.id '
+            f'WHERE v.channel = ? AND v.tab = ?{clause} '
+            'ORDER BY v.rank DESC LIMIT ? OFFSET ?',
+            (channel, tab, *params, page_size + 1, (page - 1) * page_size)).fetchall()
+        videos = [{
+            'id': video_id, 'title': title, 'duration': duration, 'url': url, 'thumbnail': thumbnail,
+            'is_short': bool(is_short), 'max_height': max_height
+        } for video_id, title, duration, url, thumbnail, is_short, max_height in rows[:page_size]]
+        return videos, len(rows) > page_size
+
+    def summary(self, channel, tab, search=None):
+        """Title, row count and resolution histogram of an indexed tab"""
+        clause, params = self._search_clause(search)
+        db = self._db()
+        row = self._channel_row(channel, tab)
+        total = db.execute(f'SELECT COUNT(*) FROM videos v WHERE v.channel = ? AND v.tab = ?{clause}', (channel, tab, *params)).fetchone()[0]
+        histogram = {label: 0 for label, _ in RESOLUTION_BUCKETS}
+        histogram['unknown'] = total
+        heights = db.execute(
+            'SELECT h.max_height, COUNT(*) FROM videos v JOIN heights h ON h.id = v.id '
+            f'WHERE v.channel = ? AND v.tab = ?{clause} GROUP BY h.max_height',
+            (channel, tab, *params)).fetchall()
+        for height, count in heights:
+            for label, minimum in RESOLUTION_BUCKETS:
+                if height >= minimum:
+                    histogram[label] += count
+                    histogram['unknown'] -= count
+                    break
+        return {
+            'title': row[0] if row else None,
+            'synced_at': row[1] if row else None,
+            'complete': bool(row and row[2]),
+            'indexed': total,
+            'stats': histogram,
+        }
+
+    def record_heights(self, heights):
+        """Stores probed max heights, {video_id: height}; zero (failed probe) is ignored"""
+        rows = [(video_id, height) for video_id, height in heights.items() if video_id and height]
+        if rows:
+            with self._db() as db:
+                db.executemany('INSERT INTO heights (id, max_height) VALUES (?, ?) '
+                               'ON CONFLICT (id) DO UPDATE SET max_height = excluded.max_height', rows)
+
+    def stats(self):
+        db = self._db()
+        with self._cond:
+            running = sum(1 for sync in self._syncs.values() if not sync.done)
+        return {
+            'channels': db.execute('SELECT COUNT(*) FROM channels').fetchone()[0],
+            'videos': db.execute('SELECT COUNT(*) FROM videos').fetchone()[0],
+            'heights': db.execute('SELECT COUNT(*) FROM heights').fetchone()[0],
+            'syncs_started': self.syncs_started,
+            'syncs_running': running,
+            'entries_fetched': self.entries_fetched,
+        }
@@ -0,0 +1,349 @@
+"""
+Adaptive download concurrency and bandwidth caps.
+
+AdaptiveConcurrency runs AIMD over the number of download slots: it probes
+one slot up while there's queued work and the last increase paid off in
+aggregate throughput, backs off by one when an extra slot bought nothing or
+disk is running out, and halves on rate limiting (HTTP 429) or a burst of
+errors. TokenBucket enforces optional bandwidth caps from the progress hook.
+DiskAdmission holds downloads back until there's disk space for them.
+"""
+import collections
+import re
+import threading
+import time
+
+# Errors that mean the upstream is pushing back rather than the job being broken
+THROTTLE_ERROR = re.compile(r'\b(429|Too Many Requests|rate.?limit)', re.IGNORECASE)
+
+class TokenBucket:
+    """rate bytes/s with a burst of one second; consume() blocks until the bytes are covered"""
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self, amount):
+        """Takes amount (possibly going negative) and returns how long the caller must wait"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def consume(self, amount):
+        delay = self._reserve(amount)
+        if delay > 0:
+            self.waited += delay
+            time.sleep(delay)
+
+class AdaptiveConcurrency:
+    def __init__(self, initial, minimum, maximum, interval, demand, apply_limit, free_bytes=None,
+                 min_free_bytes=0, stall_speed=0, gain=0.05, error_rate=0.25, cooldown=6):
+        """
+        demand() -> (active, queued) from the scheduler; apply_limit(n) sets its slot count.
+        free_bytes() reports free disk for the download folder.
+        """
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.interval = interval
+        self.demand = demand
+        self.apply_limit = apply_limit
+        self.free_bytes = free_bytes
+        self.min_free_bytes = min_free_bytes
+        self.stall_speed = stall_speed
+        self.gain = gain
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._last_downloaded = {}  # task_id -> downloaded_bytes at the last hook call
+        self._speeds = {}  # task_id -> latest speed of a running download
+        self._completed = 0
+        self._errors = 0
+        self._throttled = 0
+        # Throughput before the last increase, to judge whether the extra slot helped
+        self._baseline = None
+        self._hold = 0  # steps left before probing again after an increase that didn't pay off
+        self.throughput = 0.0
+        self.decisions = collections.deque(maxlen=50)
+        self._thread = None
+
+    def start(self):
+        self.apply_limit(self.limit)
+        self._thread = threading.Thread(target=self._loop, name="concurrency-controller", daemon=True)
+        self._thread.start()
+        return self
+
+    def record_progress(self, task_id, downloaded_bytes, speed=None):
+        """Returns the bytes downloaded since the previous call for this task"""
+        with self._lock:
+            last = self._last_downloaded.get(task_id, 0)
+            # A new stream of the same task (video then audio) starts again from zero
+            delta = downloaded_bytes - last if downloaded_bytes >= last else downloaded_bytes
+            self._last_downloaded[task_id] = downloaded_bytes
+            self._bytes += delta
+            if speed is not None:
+                self._speeds[task_id] = speed
+            return delta
+
+    def record_outcome(self, task_id, error=None):
+        with self._lock:
+            self._last_downloaded.pop(task_id, None)
+            self._speeds.pop(task_id, None)
+            self._completed += 1
+            if error is not None:
+                self._errors += 1
+                if THROTTLE_ERROR.search(str(error)):
+                    self._throttled += 1
+
+    def forget(self, task_id):
+        """Drops a task's progress state without counting an outcome, for tasks that ended some other way"""
+        with self._lock:
+            self._last_downloaded.pop(task_id, None)
+            self._speeds.pop(task_id, None)
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.step()
+            except Exception as e:
+                print(f"Concurrency controller error: {e}")
+
+    def step(self):
+        """One control decision from the counters gathered since the previous step"""
+        with self._lock:
+            window_bytes, self._bytes = self._bytes, 0
+            completed, self._completed = self._completed, 0
+            errors, self._errors = self._errors, 0
+            throttled, self._throttled = self._throttled, 0
+            speeds = list(self._speeds.values())
+        self.throughput = window_bytes / self.interval
+        active, queued = self.demand()
+        free = self.free_bytes() if self.free_bytes else None
+
+        limit, reason = self.limit, 'hold'
+        stalled = self.stall_speed and speeds and all(s < self.stall_speed for s in speeds)
+        if throttled or (completed and errors / completed >= self.error_rate):
+            limit = max(self.minimum, limit // 2)
+            reason = 'throttled' if throttled else 'errors'
+            self._baseline = None
+        elif free is not None and free < self.min_free_bytes:
+            limit = max(self.minimum, min(limit, active) - 1)
+            reason = 'low_disk'
+        elif stalled and active > self.minimum:
+            # Every running download is crawling: more connections won't help
+            limit = max(self.minimum, active - 1)
+            reason = 'stalled'
+        elif self._baseline is not None and active >= limit:
+            # Judge the previous increase once its slot has been in use for a full window
+            if self.throughput < self._baseline * (1 + self.gain):
+                limit = max(self.minimum, limit - 1)
+                reason = 'no_gain'
+                self._hold = self.cooldown
+            self._baseline = None
+        elif self._hold:
+            self._hold -= 1
+        elif queued and active >= limit and limit < self.maximum:
+            self._baseline = self.throughput
+            limit += 1
+            reason = 'probe'
+
+        decision = {
+            'time': round(time.time(), 3),
+            'limit': limit,
+            'previous': self.limit,
+            'reason': reason,
+            'throughput': round(self.throughput),
+            'active': active,
+            'queued': queued,
+            'errors': errors,
+            'throttled': throttled,
+            'free_bytes': free
+        }
+        if limit != self.limit:
+            self.limit = limit
+            self.apply_limit(limit)
+            self.decisions.append(decision)
+        return decision
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'min': self.minimum,
+            'max': self.maximum,
+            'throughput': round(self.throughput),
+            'decisions': list(self.decisions)
+        }
+
+class DiskAdmission:
+    """
+    Reserves disk space for downloads before they start. A job is admitted
+    when free space, less the watermark and whatever running jobs reserved
+    but haven't written yet, covers its footprint. Jobs that don't fit wait
+    in FIFO order and are handed back through on_space() once admitted;
+    evict(nbytes) is asked to free finished files before anyone waits, and
+    evictable() says how much it could free at most.
+    """
+    def __init__(self, free_bytes, watermark, evict=None, evictable=None, interval=5):
+        self.free_bytes = free_bytes
+        self.watermark = watermark
+        self.evict = evict
+        self.evictable = evictable
+        self.interval = interval
+        self._reservations = {}  # task_id -> [footprint, bytes written so far]
+        self._waiting = collections.OrderedDict()  # task_id -> (footprint, on_space)
+        self._rejected = set()
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.deferred = 0
+        self.rejected = 0
+        self.evicted_bytes = 0
+
+    def start(self):
+        # Space also frees up without a release (janitor, operators), so waiters are rechecked
+        threading.Thread(target=self._loop, name="disk-admission", daemon=True).start()
+        return self
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                if self._waiting:
+                    self._wake()
+            except Exception as e:
+                print(f"Disk admission error: {e}")
+
+    def _headroom_locked(self):
+        outstanding = sum(max(0, footprint - written) for footprint, written in self._reservations.values())
+        return self.free_bytes() - self.watermark - outstanding
+
+    def _hopeless_locked(self, shortfall):
+        """Whether a job can't fit even once nothing else is reserved and everything evictable is gone"""
+        if self._reservations:
+            return False
+        return self.evictable is not None and shortfall > self.evictable()
+
+    def _make_room(self, nbytes):
+        if self.evict is None or nbytes <= 0:
+            return 0
+        freed = self.evict(nbytes)
+        with self._lock:
+            self.evicted_bytes += freed
+        return freed
+
+    def reserve(self, task_id, footprint, on_space):
+        """
+        True if the job may start now. Otherwise it waits and on_space() is
+        called once it's admitted. Raises when it can't fit even with nothing
+        else on disk.
+        """
+        with self._lock:
+            if task_id in self._reservations:
+                # Admitted while it waited
+                return True
+            if task_id in self._rejected:
+                self._rejected.discard(task_id)
+                raise Exception("Not enough disk space for this download")
+            shortfall = footprint - self._headroom_locked()
+            if not self._waiting and shortfall <= 0:
+                self._reservations[task_id] = [footprint, 0]
+                self.admitted += 1
+                return True
+            if self._hopeless_locked(shortfall):
+                self.rejected += 1
+                raise Exception("Not enough disk space for this download")
+
+        if not self._waiting and self._make_room(shortfall):
+            with self._lock:
+                if not self._waiting and footprint <= self._headroom_locked():
+                    self._reservations[task_id] = [footprint, 0]
+                    self.admitted += 1
+                    return True
+
+        with self._lock:
+            if not self._reservations and not self._waiting:
+                # Nothing running is going to free space for it
+                self.rejected += 1
+                raise Exception("Not enough disk space for this download")
+            self._waiting[task_id] = (footprint, on_space)
+            self.deferred += 1
+        return False
+
+    def wrote(self, task_id, nbytes):
+        """Counts bytes a running job has put on disk against its reservation"""
+        with self._lock:
+            reservation = self._reservations.get(task_id)
+            if reservation is not None:
+                reservation[1] += nbytes
+
+    def update(self, task_id, footprint, written):
+        """Replaces the estimate once real sizes are known"""
+        with self._lock:
+            if task_id in self._reservations:
+                self._reservations[task_id] = [footprint, written]
+        self._wake()
+
+    def release(self, task_id):
+        with self._lock:
+            self._reservations.pop(task_id, None)
+            self._waiting.pop(task_id, None)
+            self._rejected.discard(task_id)
+        self._wake()
+
+    def withdraw(self, task_id):
+        """Takes a waiting job out of line; False if it was already admitted or never waited"""
+        with self._lock:
+            waiting = self._waiting.pop(task_id, None) is not None
+        if waiting:
+            self._wake()
+        return waiting
+
+    def _wake(self):
+        ready = []
+        evicted = False
+        while True:
+            with self._lock:
+                shortfall = 0
+                while self._waiting:
+                    task_id, (footprint, on_space) = next(iter(self._waiting.items()))
+                    shortfall = footprint - self._headroom_locked()
+                    if shortfall <= 0:
+                        self._reservations[task_id] = [footprint, 0]
+                        self.admitted += 1
+                    elif evicted and not self._reservations or self._hopeless_locked(shortfall):
+                        # Too big for the volume even with everything else gone
+                        self._rejected.add(task_id)
+                        self.rejected += 1
+                    else:
+                        break
+                    del self._waiting[task_id]
+                    ready.append(on_space)
+                    shortfall = 0
+            if shortfall <= 0 or evicted:
+                break
+            self._make_room(shortfall)
+            evicted = True
+        for on_space in ready:
+            on_space()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'watermark': self.watermark,
+                'reserved': sum(footprint for footprint, _ in self._reservations.values()),
+                'outstanding': sum(max(0, footprint - written) for footprint, written in self._reservations.values()),
+                'running': len(self._reservations),
+                'waiting': len(self._waiting),
+                'admitted': self.admitted,
+                'deferred': self.deferred,
+                'rejected': self.rejected,
+                'evicted_bytes': self.evicted_bytes
+            }
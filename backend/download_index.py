@@ -0,0 +1,67 @@
+"""
+On-disk record of the download cache (DownloadCache in app.py), in SQLite.
+
+Finished files are renamed after their title, so a cache key can't be read
+back from a filename. LRU order, pins and in-flight downloads stay in each
+process; this keeps what has to outlive one, the file each key was finished
+into. On boot the cache is rebuilt from it and the startup wipe leaves the
+files it lists in place. Processes sharing the download folder look up each
+other's entries here on a miss.
+"""
+import json
+import sqlite3
+import threading
+import time
+
+class DownloadIndex:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY, filename TEXT NOT NULL, used_at REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS entries_by_file ON entries (filename);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._db() as db:
+            db.executescript(self.SCHEMA)
+
+    def _db(self):
+        """One connection per thread; used as a context manager it's one transaction"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    @staticmethod
+    def _encode(key):
+        return json.dumps(list(key))
+
+    def record(self, key, filename):
+        with self._db() as db:
+            db.execute('INSERT OR REPLACE INTO entries (key, filename, used_at) VALUES (?, ?, ?)',
+                       (self._encode(key), filename, time.time()))
+
+    def touch(self, key):
+        with self._db() as db:
+            db.execute('UPDATE entries SET used_at = ? WHERE key = ?', (time.time(), self._encode(key)))
+
+    def lookup(self, key):
+        """Filename a key was finished into, or None"""
+        row = self._db().execute('SELECT filename FROM entries WHERE key = ?', (self._encode(key),)).fetchone()
+        return row[0] if row else None
+
+    def forget(self, key):
+        with self._db() as db:
+            db.execute('DELETE FROM entries WHERE key = ?', (self._encode(key),))
+
+    def entries(self):
+        """(key, filename) pairs, least recently used first"""
+        rows = self._db().execute('SELECT key, filename FROM entries ORDER BY used_at').fetchall()
+        return [(tuple(json.loads(key)), filename) for key, filename in rows]
+
+    def filenames(self):
+        return {row[0] for row in self._db().execute('SELECT DISTINCT filename FROM entries')}
@@ -0,0 +1,136 @@
+"""
+MP4 box inspection and in-place moov relocation.
+
+Only box headers are read to decide whether a file is already "faststart"
+(moov before mdat). Relocation moves the moov box in front of the media data
+inside the same file, patching the stco/co64 chunk offsets, so it needs no
+second copy of the file on disk.
+"""
+import os
+import struct
+
+# Boxes on the path from moov down to the chunk offset tables
+CONTAINER_BOXES = {b'moov', b'trak', b'mdia', b'minf', b'stbl'}
+COPY_CHUNK_SIZE = 4 * 1024 * 1024
+
+class FaststartError(Exception):
+    """The file layout isn't one we can relocate in place"""
+
+def iter_boxes(f, start, end):
+    """Yields (type, offset, header_size, size) for the boxes in [start, end)"""
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            raise FaststartError(f"Corrupt box {box_type!r} at {offset}")
+        yield box_type, offset, header_size, size
+        offset += size
+
+def inspect(path):
+    """
+    Top-level layout of an MP4 file, reading only box headers.
+    Returns None for anything that isn't an ISO BMFF file (e.g. webm).
+    """
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        boxes = list(iter_boxes(f, 0, file_size))
+
+    if not boxes or boxes[0][0] != b'ftyp':
+        return None
+
+    layout = {'size': file_size, 'moov': None, 'mdat': None, 'fragmented': False}
+    for box_type, offset, _, size in boxes:
+        if box_type == b'moov' and layout['moov'] is None:
+            layout['moov'] = (offset, size)
+        elif box_type == b'mdat' and layout['mdat'] is None:
+            layout['mdat'] = (offset, size)
+        elif box_type == b'moof':
+            layout['fragmented'] = True
+    return layout
+
+def needs_faststart(layout):
+    if layout is None or layout['fragmented']:
+        # Not MP4, or fragmented MP4 which streams fine as-is
+        return False
+    if layout['moov'] is None or layout['mdat'] is None:
+        return False
+    return layout['moov'][0] > layout['mdat'][0]
+
+def _patch_chunk_offsets(moov, delta, below):
+    """Adds delta to every stco/co64 entry below the given file offset, inside a moov box held in memory"""
+    def walk(start, end):
+        offset = start
+        while offset + 8 <= end:
+            size, box_type = struct.unpack_from('>I4s', moov, offset)
+            header_size = 8
+            if size == 1:
+                size = struct.unpack_from('>Q', moov, offset + 8)[0]
+                header_size = 16
+            elif size == 0:
+                size = end - offset
+            if size < header_size or offset + size > end:
+                raise FaststartError(f"Corrupt box {box_type!r} inside moov")
+
+            if box_type in CONTAINER_BOXES:
+                walk(offset + header_size, offset + size)
+            elif box_type == b'cmov':
+                raise FaststartError("Compressed moov")
+            elif box_type in (b'stco', b'co64'):
+                body = offset + header_size
+                count = struct.unpack_from('>I', moov, body + 4)[0]
+                entries = body + 8
+                if box_type == b'stco':
+                    values = [v + delta if v < below else v for v in struct.unpack_from(f'>{count}I', moov, entries)]
+                    if values and max(values) > 0xFFFFFFFF:
+                        raise FaststartError("Chunk offsets would overflow stco")
+                    struct.pack_into(f'>{count}I', moov, entries, *values)
+                else:
+                    values = [v + delta if v < below else v for v in struct.unpack_from(f'>{count}Q', moov, entries)]
+                    struct.pack_into(f'>{count}Q', moov, entries, *values)
+            offset += size
+
+    walk(0, len(moov))
+
+def relocate_moov(path, layout):
+    """
+    Moves moov in front of the first mdat inside the file itself.
+    Returns the number of bytes written. Raises FaststartError when the
+    layout can't be handled, leaving the file untouched.
+    """
+    moov_offset, moov_size = layout['moov']
+    insert_at = layout['mdat'][0]
+
+    with open(path, 'r+b') as f:
+        f.seek(moov_offset)
+        moov = bytearray(f.read(moov_size))
+        if len(moov) != moov_size:
+            raise FaststartError("Truncated moov")
+        # Everything in [insert_at, moov_offset) slides forward by moov_size
+        _patch_chunk_offsets(moov, moov_size, moov_offset)
+
+        # Shift back to front so nothing is overwritten before it's copied
+        written = 0
+        end = moov_offset
+        while end > insert_at:
+            start = max(insert_at, end - COPY_CHUNK_SIZE)
+            f.seek(start)
+            block = f.read(end - start)
+            f.seek(start + moov_size)
+            f.write(block)
+            written += len(block)
+            end = start
+
+        f.seek(insert_at)
+        f.write(moov)
+        written += moov_size
+    return written
@@ -0,0 +1,184 @@
+"""
+Append-only journal of download jobs, so work interrupted by a restart or
+crash is picked up again on the next boot.
+
+Each process appends JSON lines to its own file in the journal directory and
+holds an flock on it while alive; a job's state is all of its records merged
+in order. Records are appended as a job moves through
+queued -> downloading -> processing -> finished/failed/aborted, plus the
+yt-dlp temp files it has started writing, which must survive the startup
+wipe so the re-queued download can continue from them.
+
+On boot, journals whose lock can be taken belong to dead processes: their
+unfinished jobs are carried over into this process's journal and returned
+for re-queueing. With several workers booting at once, each dead journal is
+claimed by exactly one of them.
+"""
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+
+TERMINAL_STATES = {'finished', 'failed', 'aborted'}
+# The journal is rewritten down to the live jobs once it grows past this
+COMPACT_BYTES = int(os.environ.get('JOB_JOURNAL_COMPACT_BYTES', 4 * 1024 * 1024))
+
+class JobJournal:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"jobs-{os.getpid()}-{uuid.uuid4().hex[:8]}.jsonl")
+        self._lock = threading.Lock()
+        self._live = {}  # task_id -> {'job': queued record, 'partials': [paths]}
+        self._file = self._open(self.path)
+        self.compactions = 0
+
+    @staticmethod
+    def _open(path):
+        f = open(path, 'a', encoding='utf-8')
+        # Held for the life of the process; a lockable journal is an orphaned one
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return f
+
+    def _write(self, record, sync=False):
+        record['ts'] = round(time.time(), 3)
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def submitted(self, task_id, url, format_id, priority, owner=None, sync=True):
+        """Records a new job; it's fsync'd since the client is about to be told it exists"""
+        record = {'taskId': task_id, 'state': 'queued', 'url': url, 'format': format_id, 'priority': priority,
+                  'owner': owner}
+        with self._lock:
+            self._live[task_id] = {'job': dict(record), 'partials': []}
+            self._write(record, sync)
+
+    def sync(self):
+        """fsync after a run of submitted(..., sync=False)"""
+        with self._lock:
+            os.fsync(self._file.fileno())
+
+    def update(self, task_id, state):
+        with self._lock:
+            if task_id in self._live:
+                self._write({'taskId': task_id, 'state': state})
+
+    def partial(self, task_id, path):
+        """Notes a temp file a job is writing; repeated calls for the same file are no-ops"""
+        with self._lock:
+            live = self._live.get(task_id)
+            if live is None or path in live['partials']:
+                return
+            live['partials'].append(path)
+            self._write({'taskId': task_id, 'partial': path})
+
+    def finish(self, task_id, state='finished'):
+        with self._lock:
+            if self._live.pop(task_id, None) is None:
+                return
+            self._write({'taskId': task_id, 'state': state})
+            if self._file.tell() > COMPACT_BYTES:
+                self._compact()
+
+    def _compact(self):
+        """Rewrites the journal as just the live jobs; called with the lock held"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as tmp:
+            for task_id, live in self._live.items():
+                tmp.write(json.dumps(live['job']) + '\n')
+                for path in live['partials']:
+                    tmp.write(json.dumps({'taskId': task_id, 'partial': path}) + '\n')
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        new_file = open(tmp_path, 'a', encoding='utf-8')
+        fcntl.flock(new_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.replace(tmp_path, self.path)
+        self._file.close()
+        self._file = new_file
+        self.compactions += 1
+
+    @staticmethod
+    def _replay(f):
+        jobs = {}
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Torn last line from a crash mid-write
+                continue
+            job = jobs.setdefault(record['taskId'], {'taskId': record['taskId'], 'partials': []})
+            if 'partial' in record:
+                job['partials'].append(record['partial'])
+            else:
+                job.update({k: v for k, v in record.items() if k != 'ts'})
+        return [job for job in jobs.values() if job.get('url') and job.get('state') not in TERMINAL_STATES]
+
+    def _journal_paths(self):
+        def mtime(path):
+            try:
+                return os.path.getmtime(path)
+            except FileNotFoundError:
+                return 0
+        return sorted(glob.glob(os.path.join(self.directory, 'jobs-*.jsonl')), key=mtime)
+
+    def pending_partials(self):
+        """
+        Temp files of every unfinished job in any journal, live or orphaned.
+        Readers see each job in at least one file while it's being carried
+        over, so this is safe to use while other workers are recovering.
+        """
+        partials = []
+        for path in self._journal_paths():
+            try:
+                with open(path, encoding='utf-8') as f:
+                    for job in self._replay(f):
+                        partials.extend(job['partials'])
+            except FileNotFoundError:
+                continue
+        return partials
+
+    def recover(self):
+        """
+        Unfinished jobs from journals of processes that are gone, in
+        submission order, each with 'partials' listing its temp files.
+        """
+        recovered = []
+        for path in self._journal_paths():
+            if path == self.path:
+                continue
+            try:
+                f = open(path, encoding='utf-8')
+            except FileNotFoundError:
+                continue
+            with f:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Its process is still running
+                    continue
+                try:
+                    if os.stat(path).st_ino != os.fstat(f.fileno()).st_ino:
+                        # Replaced by a compaction while we were opening it
+                        continue
+                except FileNotFoundError:
+                    # Another booting worker claimed it first
+                    continue
+                jobs = self._replay(f)
+                for job in jobs:
+                    self.submitted(job['taskId'], job['url'], job.get('format', 'best'), job.get('priority', 0),
+                                   job.get('owner'), sync=False)
+                    for partial in job['partials']:
+                        self.partial(job['taskId'], partial)
+                self.sync()
+                os.remove(path)
+                recovered.extend(jobs)
+        return recovered
+
+    def stats(self):
+        with self._lock:
+            return {'path': self.path, 'live': len(self._live), 'compactions': self.compactions}
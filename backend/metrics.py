@@ -0,0 +1,144 @@
+"""
+Counters, gauges and histograms rendered in the Prometheus text format.
+
+Instruments are cheap enough for hot paths: one lock and a dict lookup per
+update. Metrics whose value already lives elsewhere (cache stats, queue
+depth) are registered with a callback and read only when scraped.
+Values are per process; under several workers each one is scraped on its own.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds; wide enough for a metadata lookup and for a long download
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), fn=None):
+        """fn, if given, returns {label values tuple: value} at scrape time instead of tracked values"""
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        if self.fn is not None:
+            values = self.fn()
+        else:
+            with self._lock:
+                values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name, _format_labels(self.labelnames, key), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {_format_value(value)}")
+        return '\n'.join(lines)
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (non-cumulative) counts, then sum and count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield self.name + '_bucket', _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))]), cumulative
+            yield self.name + '_sum', _format_labels(self.labelnames, key), total
+            yield self.name + '_count', _format_labels(self.labelnames, key), count
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=(), fn=None):
+        return self._add(Counter(name, documentation, labelnames, fn))
+
+    def gauge(self, name, documentation, labelnames=(), fn=None):
+        return self._add(Gauge(name, documentation, labelnames, fn))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        blocks = []
+        for metric in self._metrics:
+            try:
+                blocks.append(metric.render())
+            except Exception as e:
+                # One broken callback shouldn't take the whole scrape down
+                print(f"Metrics error in {metric.name}: {e}")
+        return '\n'.join(blocks) + '\n'
@@ -0,0 +1,206 @@
+"""
+Multi-connection ranged fetching for the /api/stream proxy.
+
+The upstream media URL is split into fixed-size byte ranges that are fetched
+in parallel over pooled keep-alive connections, then yielded strictly in
+order. At most `connections` parts are in flight or buffered per stream, so
+memory per stream is bounded by connections * part_size.
+
+Every stream fetches on its own connection. The extra connections come out
+of a process-wide budget of FETCH_WORKERS, which is also the fetch pool's
+size, so a stream's parts never queue behind another stream's; under load
+streams fall back towards one connection each instead of waiting.
+"""
+import concurrent.futures
+import re
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+PART_SIZE = 1024 * 1024
+CONNECTIONS_PER_STREAM = 4
+FETCH_WORKERS = 32  # parallel part fetches across all streams
+PART_RETRIES = 2
+PART_TIMEOUT = 30
+
+_session = None
+_session_lock = threading.Lock()
+_executor = None
+_budget_lock = threading.Lock()
+_connections_free = FETCH_WORKERS
+
+class RangeNotSatisfiable(Exception):
+    def __init__(self, message, total_size=None):
+        super().__init__(message)
+        self.total_size = total_size  # for the 416's Content-Range, when upstream told us
+
+def _take_connections(wanted):
+    """Takes up to wanted extra connections from the budget without waiting; returns how many"""
+    global _connections_free
+    with _budget_lock:
+        granted = min(wanted, _connections_free)
+        _connections_free -= granted
+        return granted
+
+def _return_connections(count):
+    global _connections_free
+    with _budget_lock:
+        _connections_free += count
+
+def budget_stats():
+    with _budget_lock:
+        return {'connections': FETCH_WORKERS, 'free': _connections_free}
+
+def get_session():
+    """Process-wide Session so range requests reuse keep-alive connections"""
+    global _session, _executor
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            # Room for the budget's fetches plus the streams' own inline ones
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=FETCH_WORKERS * 2)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix='range-fetch')
+        return _session
+
+def parse_range_header(value):
+    """
+    (start, end) for a single 'bytes=start-[end]' range, end being None when
+    open-ended. Returns None when there's no usable range; suffix and
+    multi-range requests are answered with the full body, which RFC 9110 allows.
+    """
+    if not value:
+        return None
+    match = re.fullmatch(r'\s*bytes=(\d+)-(\d*)\s*', value)
+    if not match:
+        return None
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) else None
+    if end is not None and end < start:
+        return None
+    return start, end
+
+class RangedStream:
+    """
+    Iterable over bytes [start, end] of a URL. The first part is fetched on
+    open to learn the total size (from Content-Range) and whether the origin
+    honours ranges at all.
+    """
+    def __init__(self, url, headers=None, start=0, end=None, part_size=PART_SIZE, connections=CONNECTIONS_PER_STREAM):
+        self.session = get_session()
+        self.url = url
+        self.headers = dict(headers or {})
+        self.part_size = part_size
+        self.connections = connections
+        self.content_type = None
+        self.total_size = None
+        self.ranged = True
+        self._closed = False
+        self._fallback = None
+
+        first_end = start + part_size - 1 if end is None else min(end, start + part_size - 1)
+        resp = self.session.get(url, headers=dict(self.headers, Range=f'bytes={start}-{first_end}'), stream=True, timeout=PART_TIMEOUT)
+        self.content_type = resp.headers.get('Content-Type')
+
+        if resp.status_code == 206:
+            match = re.search(r'/(\d+)$', resp.headers.get('Content-Range', ''))
+            self.total_size = int(match.group(1)) if match else None
+            self._first = resp.content
+            resp.close()
+        elif resp.status_code == 200:
+            # Origin ignores Range: fall back to one plain streamed response
+            self.ranged = False
+            self.total_size = int(resp.headers.get('Content-Length', 0)) or None
+            self._fallback = resp
+            self._first = b''
+            start = 0
+        elif resp.status_code == 416:
+            match = re.search(r'/(\d+)$', resp.headers.get('Content-Range', ''))
+            resp.close()
+            raise RangeNotSatisfiable(f'bytes={start}-', int(match.group(1)) if match else None)
+        else:
+            resp.close()
+            resp.raise_for_status()
+            raise Exception(f"Unexpected upstream status {resp.status_code}")
+
+        self.start = start
+        if self.total_size is not None and start >= self.total_size:
+            self.close()
+            raise RangeNotSatisfiable(f'bytes={start}-', self.total_size)
+        if end is None or (self.total_size and end >= self.total_size):
+            end = (self.total_size - 1) if self.total_size else None
+        self.end = end
+
+    @property
+    def length(self):
+        if self.end is None:
+            return None
+        return self.end - self.start + 1
+
+    def _fetch(self, part_start, part_end):
+        headers = dict(self.headers, Range=f'bytes={part_start}-{part_end}')
+        for attempt in range(PART_RETRIES + 1):
+            if self._closed:
+                return b''
+            try:
+                resp = self.session.get(self.url, headers=headers, timeout=PART_TIMEOUT)
+                if resp.status_code != 206:
+                    raise Exception(f"Range request returned {resp.status_code}")
+                data = resp.content
+                if len(data) != part_end - part_start + 1:
+                    raise Exception("Short range response")
+                return data
+            except Exception:
+                if attempt == PART_RETRIES:
+                    raise
+
+    def __iter__(self):
+        if not self.ranged:
+            try:
+                for chunk in self._fallback.iter_content(chunk_size=256 * 1024):
+                    if self._closed:
+                        break
+                    if chunk:
+                        yield chunk
+            finally:
+                self._fallback.close()
+            return
+
+        yield self._first
+        position = self.start + len(self._first)
+        if self.end is None or position > self.end:
+            return
+
+        # One part at a time is fetched inline on the stream's own connection; the rest of the
+        # window goes to budget connections whenever some are free, so a stream that starts
+        # while the budget is spent still moves and picks up more connections as others finish
+        window = []  # [part_start, part_end, future or None], in the order their bytes are yielded
+        next_start = position
+        try:
+            while True:
+                while next_start <= self.end and len(window) < self.connections:
+                    part_end = min(next_start + self.part_size - 1, self.end)
+                    window.append([next_start, part_end, None])
+                    next_start = part_end + 1
+                for part in window[1:]:
+                    if part[2] is None and _take_connections(1):
+                        part[2] = _executor.submit(self._fetch, part[0], part[1])
+                        part[2].add_done_callback(lambda _: _return_connections(1))
+                if not window or self._closed:
+                    break
+                part_start, part_end, future = window.pop(0)
+                yield future.result() if future is not None else self._fetch(part_start, part_end)
+        finally:
+            self.close()
+            # A part that's already running holds its connection until it finishes
+            for _, _, future in window:
+                if future is not None:
+                    future.cancel()
+
+    def close(self):
+        self._closed = True
+        if self._fallback is not None:
+            self._fallback.close()
@@ -0,0 +1,542 @@
+"""
+Task registry, abort flags, sid -> task ownership and event fan-out, behind
+one interface so several gunicorn workers (or hosts) can share them.
+
+    memory://                 (default) one process, plain dicts
+    sqlite:////path/tasks.db  processes on one host, events polled from a table
+    redis://host:6379/0       processes on any host, events over pub/sub
+
+Socket.IO events are addressed to a sid, and a sid is only reachable from the
+process holding its connection. publish() therefore goes through the backend,
+and every process delivers just the events for sids connected to it.
+
+is_aborted() runs on every progress hook, so the shared backends answer it
+from memory for the tasks registered in their process: abort() notifies every
+process over the same channel as events, and refresh_aborts() re-reads the
+flags in one batch in case a notification was missed.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+# Subscriptions of finished tasks are kept this long so trailing progress still reaches clients
+FINISHED_TASK_TTL = 300
+EVENT_POLL_INTERVAL = float(os.environ.get('TASK_STATE_POLL_INTERVAL', 0.05))
+EVENT_RETENTION = 60
+# Redis keys of clients and running tasks expire unless their process keeps refreshing them
+KEY_TTL = int(os.environ.get('TASK_STATE_KEY_TTL', 3600))
+# Carries abort flags between processes alongside the Socket.IO events
+ABORT_EVENT = 'task-state:abort'
+
+class TaskState:
+    """In-process backend, and the local half (connected sids, delivery) of the shared ones"""
+    def __init__(self):
+        self.node_id = uuid.uuid4().hex[:12]
+        self.local_sids = set()
+        self.deliver = None
+        self.published = 0
+        self.delivered = 0
+        self._lock = threading.Lock()
+        self._tasks = {}        # task_id -> {'abort': bool, 'finished': timestamp or None}
+        self._clients = {}      # sid -> [task_ids]
+        self._subscribers = {}  # task_id -> {sids}
+        # Shared backends: running tasks registered here and which of them are flagged
+        self._local_tasks = set()
+        self._local_aborts = set()
+
+    def start(self, deliver):
+        """deliver(event, payload, sid) emits to a sid connected to this process"""
+        self.deliver = deliver
+        return self
+
+    def _deliver(self, event, payload, sid):
+        if self.deliver and sid in self.local_sids:
+            self.delivered += 1
+            self.deliver(event, payload, sid)
+
+    # Clients
+    def add_client(self, sid):
+        self.local_sids.add(sid)
+        with self._lock:
+            self._clients.setdefault(sid, [])
+
+    def remove_client(self, sid):
+        """Forgets a disconnected sid and returns the tasks it owned"""
+        self.local_sids.discard(sid)
+        with self._lock:
+            task_ids = self._clients.pop(sid, [])
+            for tid in task_ids:
+                if tid in self._subscribers:
+                    self._subscribers[tid].discard(sid)
+        return task_ids
+
+    def has_client(self, sid):
+        with self._lock:
+            return sid in self._clients
+
+    # Tasks
+    def register_task(self, task_id, sid):
+        with self._lock:
+            self._prune()
+            self._tasks[task_id] = {'abort': False, 'finished': None}
+            if sid and sid in self._clients:
+                self._clients[sid].append(task_id)
+                self._subscribers.setdefault(task_id, set()).add(sid)
+
+    def has_task(self, task_id):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            return task is not None and task['finished'] is None
+
+    def is_aborted(self, task_id):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            return bool(task and task['abort'])
+
+    def abort(self, task_id):
+        """Flags a running task; returns False if it isn't known (any more)"""
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None or task['finished'] is not None:
+                return False
+            task['abort'] = True
+            return True
+
+    def finish_task(self, task_id):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is not None:
+                task['finished'] = time.time()
+
+    def refresh_aborts(self):
+        """Re-reads abort flags of the tasks running here; nothing to do when the flags live here"""
+
+    def _track(self, task_id):
+        with self._lock:
+            self._local_tasks.add(task_id)
+            self._local_aborts.discard(task_id)
+
+    def _untrack(self, task_id):
+        with self._lock:
+            self._local_tasks.discard(task_id)
+            self._local_aborts.discard(task_id)
+
+    def _note_abort(self, task_id):
+        """Records an abort flag set by any process; only tasks running here are kept"""
+        with self._lock:
+            if task_id in self._local_tasks:
+                self._local_aborts.add(task_id)
+
+    def _running_unflagged(self):
+        with self._lock:
+            return list(self._local_tasks - self._local_aborts)
+
+    def _prune(self):
+        cutoff = time.time() - FINISHED_TASK_TTL
+        for tid in [tid for tid, task in self._tasks.items() if task['finished'] and task['finished'] < cutoff]:
+            del self._tasks[tid]
+            self._subscribers.pop(tid, None)
+
+    # Subscriptions
+    def subscribe(self, task_id, sid):
+        """Attaches sid to a running task; False when there's nothing to attach to"""
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None or task['finished'] is not None:
+                return False
+            self._subscribers.setdefault(task_id, set()).add(sid)
+            owned = self._clients.get(sid)
+            if owned is not None and task_id not in owned:
+                owned.append(task_id)
+            return True
+
+    def unsubscribe(self, task_id, sid):
+        with self._lock:
+            if task_id in self._subscribers:
+                self._subscribers[task_id].discard(sid)
+            owned = self._clients.get(sid)
+            if owned is not None and task_id in owned:
+                owned.remove(task_id)
+
+    def task_sids(self, task_id):
+        with self._lock:
+            return list(self._subscribers.get(task_id, ()))
+
+    def release_if_orphaned(self, task_id):
+        """Drops a task's subscriptions unless someone reattached; True if it was orphaned"""
+        with self._lock:
+            if self._subscribers.get(task_id):
+                return False
+            self._subscribers.pop(task_id, None)
+            return True
+
+    # Events
+    def publish(self, event, payload, sid):
+        self.published += 1
+        self._deliver(event, payload, sid)
+
+    def stats(self):
+        with self._lock:
+            tasks = sum(1 for task in self._tasks.values() if task['finished'] is None)
+            clients = len(self._clients)
+        return {
+            'backend': type(self).__name__,
+            'node': self.node_id,
+            'tasks': tasks,
+            'clients': clients,
+            'local_clients': len(self.local_sids),
+            'published': self.published,
+            'delivered': self.delivered
+        }
+
+class SQLiteTaskState(TaskState):
+    """Shared through one SQLite file (WAL), for several workers on one host"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tasks (task_id TEXT PRIMARY KEY, abort INTEGER NOT NULL DEFAULT 0, finished REAL);
+        CREATE TABLE IF NOT EXISTS clients (sid TEXT PRIMARY KEY, node TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS client_tasks (sid TEXT NOT NULL, task_id TEXT NOT NULL, PRIMARY KEY (sid, task_id));
+        CREATE TABLE IF NOT EXISTS subscribers (task_id TEXT NOT NULL, sid TEXT NOT NULL, PRIMARY KEY (task_id, sid));
+        CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, sid TEXT NOT NULL, event TEXT NOT NULL, payload TEXT NOT NULL, created REAL NOT NULL);
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._local = threading.local()
+        with self._db() as db:
+            db.executescript(self.SCHEMA)
+
+    def _db(self):
+        """One connection per thread; used as a context manager it's one transaction"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def start(self, deliver):
+        super().start(deliver)
+        with self._db() as db:
+            last_id = db.execute('SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
+        threading.Thread(target=self._poll_loop, args=(last_id,), name="task-state-events", daemon=True).start()
+        return self
+
+    def _poll_loop(self, last_id):
+        last_prune = time.time()
+        while True:
+            time.sleep(EVENT_POLL_INTERVAL)
+            try:
+                with self._db() as db:
+                    rows = db.execute('SELECT id, sid, event, payload FROM events WHERE id > ? ORDER BY id', (last_id,)).fetchall()
+                for event_id, sid, event, payload in rows:
+                    last_id = event_id
+                    if event == ABORT_EVENT:
+                        self._note_abort(json.loads(payload)['taskId'])
+                    else:
+                        self._deliver(event, json.loads(payload), sid)
+                if time.time() - last_prune > EVENT_RETENTION:
+                    last_prune = time.time()
+                    self._prune_shared()
+            except Exception as e:
+                print(f"Task state poll error: {e}")
+
+    def _prune_shared(self):
+        now = time.time()
+        with self._db() as db:
+            db.execute('DELETE FROM events WHERE created < ?', (now - EVENT_RETENTION,))
+            expired = [row[0] for row in db.execute('SELECT task_id FROM tasks WHERE finished IS NOT NULL AND finished < ?', (now - FINISHED_TASK_TTL,))]
+            db.executemany('DELETE FROM subscribers WHERE task_id = ?', [(tid,) for tid in expired])
+            db.executemany('DELETE FROM tasks WHERE task_id = ?', [(tid,) for tid in expired])
+
+    def add_client(self, sid):
+        self.local_sids.add(sid)
+        with self._db() as db:
+            db.execute('INSERT OR REPLACE INTO clients (sid, node) VALUES (?, ?)', (sid, self.node_id))
+
+    def remove_client(self, sid):
+        self.local_sids.discard(sid)
+        with self._db() as db:
+            task_ids = [row[0] for row in db.execute('SELECT task_id FROM client_tasks WHERE sid = ?', (sid,))]
+            db.execute('DELETE FROM clients WHERE sid = ?', (sid,))
+            db.execute('DELETE FROM client_tasks WHERE sid = ?', (sid,))
+            db.execute('DELETE FROM subscribers WHERE sid = ?', (sid,))
+        return task_ids
+
+    def has_client(self, sid):
+        with self._db() as db:
+            return db.execute('SELECT 1 FROM clients WHERE sid = ?', (sid,)).fetchone() is not None
+
+    def register_task(self, task_id, sid):
+        self._track(task_id)
+        with self._db() as db:
+            db.execute('INSERT OR REPLACE INTO tasks (task_id, abort, finished) VALUES (?, 0, NULL)', (task_id,))
+            if sid and db.execute('SELECT 1 FROM clients WHERE sid = ?', (sid,)).fetchone():
+                db.execute('INSERT OR IGNORE INTO client_tasks (sid, task_id) VALUES (?, ?)', (sid, task_id))
+                db.execute('INSERT OR IGNORE INTO subscribers (task_id, sid) VALUES (?, ?)', (task_id, sid))
+
+    def has_task(self, task_id):
+        with self._db() as db:
+            return db.execute('SELECT 1 FROM tasks WHERE task_id = ? AND finished IS NULL', (task_id,)).fetchone() is not None
+
+    def is_aborted(self, task_id):
+        with self._lock:
+            if task_id in self._local_tasks:
+                return task_id in self._local_aborts
+        with self._db() as db:
+            row = db.execute('SELECT abort FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+        return bool(row and row[0])
+
+    def abort(self, task_id):
+        with self._db() as db:
+            if db.execute('UPDATE tasks SET abort = 1 WHERE task_id = ? AND finished IS NULL', (task_id,)).rowcount == 0:
+                return False
+            db.execute('INSERT INTO events (sid, event, payload, created) VALUES (?, ?, ?, ?)',
+                       ('', ABORT_EVENT, json.dumps({'taskId': task_id}), time.time()))
+        self._note_abort(task_id)
+        return True
+
+    def refresh_aborts(self):
+        task_ids = self._running_unflagged()
+        with self._db() as db:
+            # Batches stay under SQLite's bound-parameter limit
+            for i in range(0, len(task_ids), 500):
+                batch = task_ids[i:i + 500]
+                marks = ','.join('?' * len(batch))
+                for row in db.execute(f'SELECT task_id FROM tasks WHERE abort = 1 AND task_id IN ({marks})', batch):
+                    self._note_abort(row[0])
+
+    def finish_task(self, task_id):
+        with self._db() as db:
+            db.execute('UPDATE tasks SET finished = ? WHERE task_id = ?', (time.time(), task_id))
+        self._untrack(task_id)
+
+    def subscribe(self, task_id, sid):
+        with self._db() as db:
+            if not db.execute('SELECT 1 FROM tasks WHERE task_id = ? AND finished IS NULL', (task_id,)).fetchone():
+                return False
+            db.execute('INSERT OR IGNORE INTO subscribers (task_id, sid) VALUES (?, ?)', (task_id, sid))
+            if db.execute('SELECT 1 FROM clients WHERE sid = ?', (sid,)).fetchone():
+                db.execute('INSERT OR IGNORE INTO client_tasks (sid, task_id) VALUES (?, ?)', (sid, task_id))
+            return True
+
+    def unsubscribe(self, task_id, sid):
+        with self._db() as db:
+            db.execute('DELETE FROM subscribers WHERE task_id = ? AND sid = ?', (task_id, sid))
+            db.execute('DELETE FROM client_tasks WHERE sid = ? AND task_id = ?', (sid, task_id))
+
+    def task_sids(self, task_id):
+        with self._db() as db:
+            return [row[0] for row in db.execute('SELECT sid FROM subscribers WHERE task_id = ?', (task_id,))]
+
+    def release_if_orphaned(self, task_id):
+        with self._db() as db:
+            return db.execute('SELECT 1 FROM subscribers WHERE task_id = ? LIMIT 1', (task_id,)).fetchone() is None
+
+    def publish(self, event, payload, sid):
+        self.published += 1
+        if sid in self.local_sids:
+            # Connected here: skip the round trip through the table
+            self._deliver(event, payload, sid)
+            return
+        with self._db() as db:
+            db.execute('INSERT INTO events (sid, event, payload, created) VALUES (?, ?, ?, ?)',
+                       (sid, event, json.dumps(payload), time.time()))
+
+    def stats(self):
+        with self._db() as db:
+            tasks = db.execute('SELECT COUNT(*) FROM tasks WHERE finished IS NULL').fetchone()[0]
+            clients = db.execute('SELECT COUNT(*) FROM clients').fetchone()[0]
+        return {
+            'backend': type(self).__name__,
+            'node': self.node_id,
+            'tasks': tasks,
+            'clients': clients,
+            'local_clients': len(self.local_sids),
+            'published': self.published,
+            'delivered': self.delivered
+        }
+
+class RedisTaskState(TaskState):
+    """
+    Shared through Redis (or anything speaking its protocol). Takes a client
+    object, so a stand-in such as fakeredis.FakeRedis() works the same way.
+    """
+    def __init__(self, client, prefix='ytdown:'):
+        super().__init__()
+        self.redis = client
+        self.prefix = prefix
+        self.channel = prefix + 'events'
+
+    def _key(self, kind, name):
+        return f'{self.prefix}{kind}:{name}'
+
+    def start(self, deliver):
+        super().start(deliver)
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        threading.Thread(target=self._listen, args=(pubsub,), name="task-state-events", daemon=True).start()
+        threading.Thread(target=self._refresh_loop, name="task-state-keys", daemon=True).start()
+        return self
+
+    def _listen(self, pubsub):
+        while True:
+            try:
+                for message in pubsub.listen():
+                    data = json.loads(message['data'])
+                    if data['event'] == ABORT_EVENT:
+                        self._note_abort(data['payload']['taskId'])
+                    elif data['node'] != self.node_id:
+                        self._deliver(data['event'], data['payload'], data['sid'])
+            except Exception as e:
+                print(f"Task state listen error: {e}")
+                time.sleep(1)
+
+    def _refresh_loop(self):
+        """Keeps the keys of this process's clients and tasks alive; a crashed process's keys expire"""
+        while True:
+            time.sleep(KEY_TTL / 4)
+            try:
+                with self._lock:
+                    task_ids = list(self._local_tasks)
+                pipe = self.redis.pipeline()
+                for sid in list(self.local_sids):
+                    pipe.expire(self._key('client', sid), KEY_TTL)
+                    pipe.expire(self._key('owned', sid), KEY_TTL)
+                for tid in task_ids:
+                    pipe.expire(self._key('task', tid), KEY_TTL)
+                    pipe.expire(self._key('subs', tid), KEY_TTL)
+                pipe.execute()
+            except Exception as e:
+                print(f"Task state key refresh error: {e}")
+
+    def add_client(self, sid):
+        self.local_sids.add(sid)
+        self.redis.set(self._key('client', sid), self.node_id, ex=KEY_TTL)
+
+    def remove_client(self, sid):
+        self.local_sids.discard(sid)
+        owned_key = self._key('owned', sid)
+        task_ids = [tid.decode() if isinstance(tid, bytes) else tid for tid in self.redis.smembers(owned_key)]
+        pipe = self.redis.pipeline()
+        for tid in task_ids:
+            pipe.srem(self._key('subs', tid), sid)
+        pipe.delete(owned_key, self._key('client', sid))
+        pipe.execute()
+        return task_ids
+
+    def has_client(self, sid):
+        return bool(self.redis.exists(self._key('client', sid)))
+
+    def register_task(self, task_id, sid):
+        self._track(task_id)
+        pipe = self.redis.pipeline()
+        pipe.delete(self._key('task', task_id))
+        pipe.hset(self._key('task', task_id), mapping={'abort': 0, 'finished': 0})
+        pipe.expire(self._key('task', task_id), KEY_TTL)
+        if sid and self.has_client(sid):
+            pipe.sadd(self._key('owned', sid), task_id)
+            pipe.sadd(self._key('subs', task_id), sid)
+            pipe.expire(self._key('owned', sid), KEY_TTL)
+            pipe.expire(self._key('subs', task_id), KEY_TTL)
+        pipe.execute()
+
+    def _task(self, task_id):
+        task = self.redis.hgetall(self._key('task', task_id))
+        return {(k.decode() if isinstance(k, bytes) else k): int(v) for k, v in task.items()} if task else None
+
+    def has_task(self, task_id):
+        task = self._task(task_id)
+        return bool(task) and not task['finished']
+
+    def is_aborted(self, task_id):
+        with self._lock:
+            if task_id in self._local_tasks:
+                return task_id in self._local_aborts
+        task = self._task(task_id)
+        return bool(task and task['abort'])
+
+    def abort(self, task_id):
+        if not self.has_task(task_id):
+            return False
+        pipe = self.redis.pipeline()
+        pipe.hset(self._key('task', task_id), 'abort', 1)
+        pipe.publish(self.channel, json.dumps({'node': self.node_id, 'sid': None, 'event': ABORT_EVENT,
+                                               'payload': {'taskId': task_id}}))
+        pipe.execute()
+        self._note_abort(task_id)
+        return True
+
+    def refresh_aborts(self):
+        task_ids = self._running_unflagged()
+        if not task_ids:
+            return
+        pipe = self.redis.pipeline()
+        for tid in task_ids:
+            pipe.hget(self._key('task', tid), 'abort')
+        for tid, flag in zip(task_ids, pipe.execute()):
+            if flag is not None and int(flag):
+                self._note_abort(tid)
+
+    def finish_task(self, task_id):
+        pipe = self.redis.pipeline()
+        pipe.hset(self._key('task', task_id), 'finished', int(time.time()))
+        pipe.expire(self._key('task', task_id), FINISHED_TASK_TTL)
+        pipe.expire(self._key('subs', task_id), FINISHED_TASK_TTL)
+        pipe.execute()
+        self._untrack(task_id)
+
+    def subscribe(self, task_id, sid):
+        if not self.has_task(task_id):
+            return False
+        pipe = self.redis.pipeline()
+        pipe.sadd(self._key('subs', task_id), sid)
+        pipe.expire(self._key('subs', task_id), KEY_TTL)
+        if self.has_client(sid):
+            pipe.sadd(self._key('owned', sid), task_id)
+            pipe.expire(self._key('owned', sid), KEY_TTL)
+        pipe.execute()
+        return True
+
+    def unsubscribe(self, task_id, sid):
+        pipe = self.redis.pipeline()
+        pipe.srem(self._key('subs', task_id), sid)
+        pipe.srem(self._key('owned', sid), task_id)
+        pipe.execute()
+
+    def task_sids(self, task_id):
+        return [sid.decode() if isinstance(sid, bytes) else sid for sid in self.redis.smembers(self._key('subs', task_id))]
+
+    def release_if_orphaned(self, task_id):
+        return self.redis.scard(self._key('subs', task_id)) == 0
+
+    def publish(self, event, payload, sid):
+        self.published += 1
+        if sid in self.local_sids:
+            self._deliver(event, payload, sid)
+            return
+        self.redis.publish(self.channel, json.dumps({'node': self.node_id, 'sid': sid, 'event': event, 'payload': payload}))
+
+    def stats(self):
+        return {
+            'backend': type(self).__name__,
+            'node': self.node_id,
+            'local_clients': len(self.local_sids),
+            'published': self.published,
+            'delivered': self.delivered
+        }
+
+def create_task_state(url):
+    """Backend for a TASK_STATE_URL"""
+    if not url or url.startswith('memory://'):
+        return TaskState()
+    if url.startswith('sqlite:///'):
+        return SQLiteTaskState(url[len('sqlite:///'):])
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        import redis
+        return RedisTaskState(redis.Redis.from_url(url))
+    raise ValueError(f"Unsupported TASK_STATE_URL: {url}")
@@ -0,0 +1,177 @@
+"""
+On-disk cache behind the /api/thumbnail proxy.
+
+Thumbnails are keyed by video id and variant, YouTube's fixed sizes
+(default, mqdefault, hqdefault, sddefault, maxresdefault), and fetched from
+an upstream URL template. Concurrent requests for the same thumbnail share
+one fetch, a variant the video doesn't have falls back to the next smaller
+one, and the folder is bounded by size with LRU eviction. warm() fetches a
+whole page's thumbnails in parallel on a shared pool.
+"""
+import concurrent.futures
+import os
+import threading
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Variant -> width; all are 4:3 except mqdefault and maxresdefault (16:9)
+VARIANTS = OrderedDict([('default', 120), ('mqdefault', 320), ('hqdefault', 480), ('sddefault', 640), ('maxresdefault', 1280)])
+
+class ThumbnailNotFound(Exception):
+    pass
+
+def variant_for_width(width):
+    """Smallest variant at least width pixels wide, or the largest there is"""
+    for variant, variant_width in VARIANTS.items():
+        if variant_width >= width:
+            return variant
+    return next(reversed(VARIANTS))
+
+def pick_thumbnail(thumbnails, width):
+    """URL of the smallest listed thumbnail at least width wide; the last (largest) one when none is or sizes are missing"""
+    sized = [t for t in thumbnails if t.get('url') and t.get('width')]
+    fitting = [t for t in sized if t['width'] >= width]
+    if fitting:
+        return min(fitting, key=lambda t: t['width'])['url']
+    return thumbnails[-1].get('url') if thumbnails else None
+
+class _Fetch:
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+class ThumbnailCache:
+    def __init__(self, folder, upstream, max_bytes, timeout=10, workers=16):
+        """upstream is a URL template with {id} and {variant}"""
+        self.folder = folder
+        self.upstream = upstream
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._files = OrderedDict()  # filename -> size, least recently used first
+        self._fetches = {}  # filename -> _Fetch in flight
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.evictions = 0
+        self.fetched_bytes = 0
+
+        os.makedirs(folder, exist_ok=True)
+        existing = []
+        for entry in os.scandir(folder):
+            if entry.is_file() and entry.name.endswith('.jpg'):
+                stat = entry.stat()
+                existing.append((stat.st_mtime, entry.name, stat.st_size))
+            elif entry.is_file() and entry.name.endswith('.tmp'):
+                os.remove(entry.path)
+        for _, name, size in sorted(existing):
+            self._files[name] = size
+            self.total_bytes += size
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnail-fetch')
+
+    def get(self, video_id, variant):
+        """Path of the cached thumbnail, fetching it first if needed; raises ThumbnailNotFound"""
+        filename = f"{video_id}_{variant}.jpg"
+        with self._lock:
+            if filename in self._files:
+                self._files.move_to_end(filename)
+                self.hits += 1
+                return os.path.join(self.folder, filename)
+            fetch = self._fetches.get(filename)
+            leader = fetch is None
+            if leader:
+                fetch = self._fetches[filename] = _Fetch()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if not fetch.done.wait(self.timeout * len(VARIANTS)):
+                raise ThumbnailNotFound(f"Timed out waiting for {filename}")
+            if fetch.error is not None:
+                raise fetch.error
+            return os.path.join(self.folder, filename)
+
+        try:
+            self._fetch(video_id, variant, filename)
+        except Exception as e:
+            fetch.error = e if isinstance(e, ThumbnailNotFound) else ThumbnailNotFound(str(e))
+            with self._lock:
+                self.errors += 1
+            raise fetch.error
+        finally:
+            with self._lock:
+                self._fetches.pop(filename, None)
+            fetch.done.set()
+        return os.path.join(self.folder, filename)
+
+    def _fetch(self, video_id, variant, filename):
+        # Not every video has the large variants; the next smaller one stands in under the same key
+        variants = list(VARIANTS)
+        for candidate in reversed(variants[:variants.index(variant) + 1]):
+            response = self.session.get(self.upstream.format(id=video_id, variant=candidate), timeout=self.timeout)
+            if response.status_code == 404:
+                continue
+            response.raise_for_status()
+            self._store(filename, response.content)
+            return
+        raise ThumbnailNotFound(f"No thumbnail for {video_id}")
+
+    def _store(self, filename, data):
+        path = os.path.join(self.folder, filename)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if filename in self._files:
+                self.total_bytes -= self._files.pop(filename)
+            self._files[filename] = len(data)
+            self.total_bytes += len(data)
+            self.fetched_bytes += len(data)
+            self._evict_locked()
+
+    def _evict_locked(self):
+        while self.total_bytes > self.max_bytes and len(self._files) > 1:
+            filename, size = self._files.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.folder, filename))
+            except OSError:
+                pass
+
+    def _get_quietly(self, video_id, variant):
+        try:
+            self.get(video_id, variant)
+            return True
+        except ThumbnailNotFound:
+            return False
+
+    def warm(self, video_ids, variant):
+        """Starts fetching the thumbnails in parallel; returns {video_id: future of whether it's cached}"""
+        return {video_id: self._executor.submit(self._get_quietly, video_id, variant) for video_id in dict.fromkeys(video_ids)}
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._files),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'inflight': len(self._fetches),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'errors': self.errors,
+                'evictions': self.evictions,
+                'fetched_bytes': self.fetched_bytes
+            }
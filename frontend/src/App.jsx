@@ -20,6 +20,9 @@ function App() {
     const [activeTab, setActiveTab] = useState('dashboard');
     const [data, setData] = useState(null);
     const [tasks, setTasks] = useState({});
+    // Latest tasks for socket handlers registered once per connection
+    const tasksRef = useRef(tasks);
+    tasksRef.current = tasks;
 
     // Initialize Socket when apiUrl changes
     useEffect(() => {
@@ -32,6 +35,14 @@ function App() {
         newSocket.on('connect', () => {
             console.log("Socket connected:", newSocket.id);
             setIsConnected(true);
+
+            // Events are routed per client, so reattach running tasks after a reconnect
+            const running = Object.values(tasksRef.current)
+                .filter(t => t.status !== 'finished' && t.status !== 'error')
+                .map(t => t.taskId);
+            if (running.length > 0) {
+                newSocket.emit('subscribe', { taskIds: running });
+            }
         });
 
         newSocket.on('disconnect', () => setIsConnected(false));
@@ -43,6 +54,28 @@ function App() {
             }));
         });
 
+        // Coalesced updates flushed by the backend on a fixed tick
+        newSocket.on('progress_batch', (msg) => {
+            setTasks(prev => {
+                const next = { ...prev };
+                msg.updates.forEach(update => {
+                    next[update.taskId] = { ...next[update.taskId], ...update };
+                });
+                return next;
+            });
+        });
+
+        // Scheduler queue positions for tasks that haven't started yet
+        newSocket.on('queue', (msg) => {
+            setTasks(prev => {
+                const next = { ...prev };
+                Object.entries(msg.positions).forEach(([taskId, position]) => {
+                    if (next[taskId]) next[taskId] = { ...next[taskId], queue_position: position };
+                });
+                return next;
+            });
+        });
+
         setSocket(newSocket);
 
         return () => {
@@ -3,7 +3,7 @@ import { Download, Loader, CheckCircle, AlertCircle, File, Clock, Wifi, Box, Arr
 
 const ProcessingTab = ({ tasks, markAsDownloaded }) => {
     const taskList = Object.values(tasks);
-    const activeTasks = taskList.filter(t => t.status === 'downloading' || t.status === 'optimizing' || t.status === 'queued').length;
+    const activeTasks = taskList.filter(t => t.status === 'downloading' || t.status === 'processing' || t.status === 'optimizing' || t.status === 'queued').length;
     const completedTasks = taskList.filter(t => t.status === 'finished').length;
     const [scrolled, setScrolled] = useState(false);
 
@@ -165,6 +165,8 @@ const ProcessingTab = ({ tasks, markAsDownloaded }) => {
                                                 <span className="text-green-500">
                                                     Download Complete
                                                 </span>
+                                            ) : task.status === 'queued' && task.queue_position ? (
+                                                <span>Queued #{task.queue_position}</span>
                                             ) : (
                                                 <span>Processing...</span>
                                             )}